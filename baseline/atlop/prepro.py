@@ -13,12 +13,34 @@ def chunks(l, n):
     return res
 
 
-def read_docred(file_in, tokenizer, data_dir, max_seq_length=1024):
+def build_type_pair_table(file_in, data_dir):
+    """Relations of rel_info.json taken by each (head type, tail type) pair of entities in file_in."""
+    rel_info = json.load(open(f'{data_dir}/rel_info.json', 'r'))
+    with open(file_in, "r") as fh:
+        data = json.load(fh)
+
+    type_pairs = {}
+    for sample in data:
+        entities = sample['entities']
+        for label in sample.get('relations', []):
+            if label['r'] not in rel_info:
+                continue
+            key = (entities[label['h']].get('type'), entities[label['t']].get('type'))
+            type_pairs.setdefault(key, set()).add(label['r'])
+    print("# of type pairs with relations {}.".format(len(type_pairs)))
+    return type_pairs
+
+
+def read_docred(file_in, tokenizer, data_dir, max_seq_length=1024, type_pairs=None):
+    """type_pairs: if given (see build_type_pair_table), entity pairs whose types never take a relation are pruned."""
     docred_rel2id = json.load(open(f'{data_dir}/meta/rel2id.json', 'r'))
     
     i_line = 0
     pos_samples = 0
     neg_samples = 0
+    pruned_samples = 0
+    pruned_relations = 0
+    tot_relations = 0
     features = []
     if file_in == "":
         return None
@@ -70,8 +92,17 @@ def read_docred(file_in, tokenizer, data_dir, max_seq_length=1024):
                 end = sent_map[m["sent_id"]][m["pos"][1]]
                 entity_pos[-1].append((start, end,))
 
+        def compatible(h, t):
+            return type_pairs is None or (entities[h].get('type'), entities[t].get('type')) in type_pairs
+
         relations, hts = [], []
+        doc_pruned = 0
         for h, t in train_triple.keys():
+            tot_relations += len(train_triple[h, t])
+            if not compatible(h, t):
+                pruned_relations += len(train_triple[h, t])
+                doc_pruned += 1
+                continue
             relation = [0] * len(docred_rel2id)
             for mention in train_triple[h, t]:
                 relation[mention["relation"]] = 1
@@ -82,13 +113,17 @@ def read_docred(file_in, tokenizer, data_dir, max_seq_length=1024):
 
         for h in range(len(entities)):
             for t in range(len(entities)):
-                if h != t and [h, t] not in hts:
+                if h != t and (h, t) not in train_triple:
+                    if not compatible(h, t):
+                        doc_pruned += 1
+                        continue
                     relation = [1] + [0] * (len(docred_rel2id) - 1)
                     relations.append(relation)
                     hts.append([h, t])
                     neg_samples += 1
 
-        assert len(relations) == len(entities) * (len(entities) - 1)
+        assert len(relations) + doc_pruned == len(entities) * (len(entities) - 1)
+        pruned_samples += doc_pruned
 
         sents = sents[:max_seq_length - 2]
         input_ids = tokenizer.convert_tokens_to_ids(sents)
@@ -106,6 +141,10 @@ def read_docred(file_in, tokenizer, data_dir, max_seq_length=1024):
     print("# of documents {}.".format(i_line))
     print("# of positive examples {}.".format(pos_samples))
     print("# of negative examples {}.".format(neg_samples))
+    if type_pairs is not None:
+        print("# of pruned examples {}.".format(pruned_samples))
+        print("# of pruned relations {} / {} (recall ceiling {:.2f}%).".format(
+            pruned_relations, tot_relations, (1 - pruned_relations / max(tot_relations, 1)) * 100))
     return features
 
 
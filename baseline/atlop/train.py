@@ -10,7 +10,7 @@ from transformers import AutoConfig, AutoModel, AutoTokenizer
 from transformers.optimization import AdamW, get_linear_schedule_with_warmup
 from model import DocREModel
 from utils import set_seed, collate_fn
-from prepro import read_docred
+from prepro import read_docred, build_type_pair_table
 from evaluation import to_official, official_evaluate
 import wandb
 from tqdm.auto import tqdm
@@ -142,6 +142,10 @@ def main():
     parser.add_argument("--train_file", default="train_annotated.json", type=str)
     parser.add_argument("--dev_file", default="dev.json", type=str)
     parser.add_argument("--test_file", default="test.json", type=str)
+    parser.add_argument("--prune_type_pairs", action="store_true",
+                        help="Drop the entity pairs whose types never take a relation in type_pairs_file.")
+    parser.add_argument("--type_pairs_file", default="train_annotated.json", type=str,
+                        help="File from which the (head type, tail type) pairs taking relations are collected.")
     parser.add_argument("--save_path", default="", type=str)
     parser.add_argument("--load_path", default="", type=str)
 
@@ -198,9 +202,10 @@ def main():
     train_file = os.path.join(args.data_dir, args.train_file)
     dev_file = os.path.join(args.data_dir, args.dev_file)
     test_file = os.path.join(args.data_dir, args.test_file)
-    train_features = read(train_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length)
-    dev_features = read(dev_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length)
-    test_features = read(test_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length)
+    type_pairs = build_type_pair_table(os.path.join(args.data_dir, args.type_pairs_file), args.data_dir) if args.prune_type_pairs else None
+    train_features = read(train_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length, type_pairs=type_pairs)
+    dev_features = read(dev_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length, type_pairs=type_pairs)
+    test_features = read(test_file, tokenizer, args.data_dir, max_seq_length=args.max_seq_length, type_pairs=type_pairs)
 
     model = AutoModel.from_pretrained(
         args.model_name_or_path,
@@ -9,13 +9,15 @@ from allennlp.modules import FeedForward
 import numpy as np
 import math
 
-from transformers import BertTokenizer, BertPreTrainedModel, BertModel
+from transformers import BertTokenizerFast, BertPreTrainedModel, BertModel
 from transformers import AlbertTokenizer, AlbertPreTrainedModel, AlbertModel
-from transformers import LongformerTokenizer, LongformerModel
+from transformers import LongformerTokenizerFast, LongformerModel
 
 import os
 import json
+import hashlib
 import logging
+import contextlib
 
 logger = logging.getLogger('root')
 
@@ -237,22 +239,48 @@ class EntityModel():
             logger.info('Loading BERT model from {}'.format(bert_model_name))
 
         if args.use_longformer:
-            self.tokenizer = LongformerTokenizer.from_pretrained(vocab_name)
+            self.tokenizer = LongformerTokenizerFast.from_pretrained(vocab_name)
             self.bert_model = LongformerForEntity.from_pretrained(bert_model_name, num_ner_labels=num_ner_labels, max_span_length=args.max_span_length)
         elif args.use_albert:
             self.tokenizer = AlbertTokenizer.from_pretrained(vocab_name)
             self.bert_model = AlbertForEntity.from_pretrained(bert_model_name, num_ner_labels=num_ner_labels, max_span_length=args.max_span_length)
         else:
-            self.tokenizer = BertTokenizer.from_pretrained(vocab_name)
+            self.tokenizer = BertTokenizerFast.from_pretrained(vocab_name)
             self.bert_model = BertForEntity.from_pretrained(bert_model_name, num_ner_labels=num_ner_labels, max_span_length=args.max_span_length)
 
+        # Longformer pads its inputs to a multiple of its attention window: padding them beforehand costs nothing more
+        self.pad_to_multiple = 1
+        if args.use_longformer:
+            attention_window = self.bert_model.config.attention_window
+            self.pad_to_multiple = max(attention_window) if isinstance(attention_window, (list, tuple)) else attention_window
+
         self._model_device = 'cpu'
-        self.move_model_to_cuda()
+        self.bf16 = getattr(args, 'bf16', False)
+        if self.bf16 and not hasattr(torch, 'autocast'):
+            # torch.autocast (with bfloat16 on CPU) requires torch >= 1.10
+            logger.warning('bfloat16 autocast requires torch >= 1.10 (found %s), running in float32'%(torch.__version__))
+            self.bf16 = False
+        self.move_model_to_device(getattr(args, 'device', 'auto'), getattr(args, 'num_threads', None))
+
+    def move_model_to_device(self, device='auto', num_threads=None):
+        """
+        Move the model to 'cuda' or keep it on 'cpu' ('auto': cuda if available)
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            if device == 'cpu':
+                logger.warning('No CUDA found, running on CPU')
+        if device == 'cuda':
+            self.move_model_to_cuda()
+        else:
+            logger.info('Running on CPU with %d threads'%(torch.get_num_threads()))
 
     def move_model_to_cuda(self):
         if not torch.cuda.is_available():
             logger.error('No CUDA found!')
-            exit(-1)
+            raise RuntimeError('No CUDA found, use --device cpu to run on CPU')
         logger.info('Moving to CUDA...')
         self._model_device = 'cuda'
         self.bert_model.cuda()
@@ -260,105 +288,141 @@ class EntityModel():
         if torch.cuda.device_count() > 1:
             self.bert_model = torch.nn.DataParallel(self.bert_model)
 
-    def _get_input_tensors(self, tokens, spans, spans_ner_label):
-        start2idx = []
-        end2idx = []
-        
-        bert_tokens = []
-        bert_tokens.append(self.tokenizer.cls_token)
-        for token in tokens:
-            start2idx.append(len(bert_tokens))
-            sub_tokens = self.tokenizer.tokenize(token)
-            bert_tokens += sub_tokens
-            end2idx.append(len(bert_tokens)-1)
-        bert_tokens.append(self.tokenizer.sep_token)
+    def quantize(self):
+        """
+        Dynamic int8 quantization of the linear layers, for inference on CPU
+        """
+        if self._model_device != 'cpu':
+            logger.warning('Dynamic quantization is only available on CPU, the model is not quantized')
+            return
+        logger.info('Quantizing the linear layers to int8...')
+        self.bert_model = torch.quantization.quantize_dynamic(self.bert_model, {nn.Linear}, dtype=torch.qint8)
 
-        indexed_tokens = self.tokenizer.convert_tokens_to_ids(bert_tokens)
-        tokens_tensor = torch.tensor([indexed_tokens])
+    def _inference_context(self):
+        """
+        No autograd during inference (inference_mode if available), with bfloat16 autocast if bf16 (torch >= 1.10)
+        """
+        context = contextlib.ExitStack()
+        context.enter_context(torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad())
+        if self.bf16:
+            context.enter_context(torch.autocast(device_type='cpu' if self._model_device == 'cpu' else 'cuda', dtype=torch.bfloat16))
+        return context
 
-        bert_spans = [[start2idx[span[0]], end2idx[span[1]], span[2]] for span in spans]
-        bert_spans_tensor = torch.tensor([bert_spans])
+    def _tokenizer_key(self):
+        """
+        Identify the tokenizer by its class and vocabulary (the same for the base model and the fine-tuned one)
+        """
+        digest = hashlib.sha1()
+        digest.update(type(self.tokenizer).__name__.encode())
+        digest.update(str(self.tokenizer.init_kwargs.get('do_lower_case')).encode())
+        digest.update(json.dumps(sorted(self.tokenizer.get_vocab().items())).encode())
+        return digest.hexdigest()
 
-        spans_ner_label_tensor = torch.tensor([spans_ner_label])
+    def tokenize_samples(self, samples, cache_dir=None):
+        """
+        Tokenize the samples once, and store in each sample its subword ids ('input_ids', with CLS and SEP)
+        and the index of the first and last subword of each word ('start2idx' and 'end2idx')
+        Each distinct word is tokenized alone, as tokenizer.tokenize(word), in one batch
+        If cache_dir is given, the result is cached there, keyed by the tokenizer and the words of the samples
+        """
+        cache_file = None
+        if cache_dir is not None:
+            digest = hashlib.sha1(self._tokenizer_key().encode())
+            for sample in samples:
+                digest.update(json.dumps(sample['tokens']).encode())
+            cache_file = os.path.join(cache_dir, 'tokens_%s.npz'%digest.hexdigest()[:16])
+            if os.path.exists(cache_file):
+                logger.info('Loading tokenized samples from %s'%cache_file)
+                with np.load(cache_file) as cache:
+                    input_ids = np.split(cache['input_ids'], np.cumsum(cache['num_input_ids'])[:-1])
+                    start2idx = np.split(cache['start2idx'], np.cumsum(cache['num_words'])[:-1])
+                    end2idx = np.split(cache['end2idx'], np.cumsum(cache['num_words'])[:-1])
+                for sample, sample_input_ids, sample_start2idx, sample_end2idx in zip(samples, input_ids, start2idx, end2idx):
+                    sample['input_ids'] = sample_input_ids
+                    sample['start2idx'] = sample_start2idx
+                    sample['end2idx'] = sample_end2idx
+                return
+
+        words = list(dict.fromkeys(word for sample in samples for word in sample['tokens']))
+        word2ids = {}
+        if len(words) > 0:
+            encoded = self.tokenizer.batch_encode_plus(words, add_special_tokens=False, return_token_type_ids=False, return_attention_mask=False)
+            word2ids = dict(zip(words, encoded['input_ids']))
+
+        for sample in samples:
+            sub_tokens = [word2ids[word] for word in sample['tokens']]
+            lengths = np.array([len(ids) for ids in sub_tokens], dtype=np.int64)
+            # subword 0 is CLS
+            sample['end2idx'] = np.cumsum(lengths)
+            sample['start2idx'] = sample['end2idx'] - lengths + 1
+            sample['input_ids'] = np.array([self.tokenizer.cls_token_id] + [i for ids in sub_tokens for i in ids] + [self.tokenizer.sep_token_id], dtype=np.int64)
+
+        if cache_file is not None:
+            logger.info('Saving tokenized samples to %s'%cache_file)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + '.%d.tmp.npz'%os.getpid()
+            np.savez(tmp_file,
+                     input_ids=np.concatenate([sample['input_ids'] for sample in samples] + [np.zeros(0, dtype=np.int64)]),
+                     num_input_ids=np.array([len(sample['input_ids']) for sample in samples], dtype=np.int64),
+                     start2idx=np.concatenate([sample['start2idx'] for sample in samples] + [np.zeros(0, dtype=np.int64)]),
+                     end2idx=np.concatenate([sample['end2idx'] for sample in samples] + [np.zeros(0, dtype=np.int64)]),
+                     num_words=np.array([len(sample['tokens']) for sample in samples], dtype=np.int64))
+            os.replace(tmp_file, cache_file)
+
+    def _get_input_tensors(self, sample):
+        if 'input_ids' not in sample:
+            self.tokenize_samples([sample])
+        tokens_tensor = torch.from_numpy(sample['input_ids']).unsqueeze(0)
+
+        # spans: int32 array of (start, end, width) in words, see entity.utils.enumerate_spans
+        spans = np.asarray(sample['spans'], dtype=np.int64).reshape(-1, 3)
+        bert_spans = np.stack([sample['start2idx'][spans[:, 0]], sample['end2idx'][spans[:, 1]], spans[:, 2]], axis=-1)
+        bert_spans_tensor = torch.from_numpy(bert_spans).unsqueeze(0)
+
+        spans_ner_label_tensor = torch.from_numpy(np.asarray(sample['spans_label'], dtype=np.int64)).unsqueeze(0)
 
         return tokens_tensor, bert_spans_tensor, spans_ner_label_tensor
 
     def _get_input_tensors_batch(self, samples_list, training=True):
-        tokens_tensor_list = []
-        bert_spans_tensor_list = []
-        spans_ner_label_tensor_list = []
-        sentence_length = []
-
+        inputs = []
         max_tokens = 0
         max_spans = 0
         for sample in samples_list:
-            tokens = sample['tokens']
-            spans = sample['spans']
-            spans_ner_label = sample['spans_label']
-
-            tokens_tensor, bert_spans_tensor, spans_ner_label_tensor = self._get_input_tensors(tokens, spans, spans_ner_label)
-            tokens_tensor_list.append(tokens_tensor)
-            bert_spans_tensor_list.append(bert_spans_tensor)
-            spans_ner_label_tensor_list.append(spans_ner_label_tensor)
+            tokens_tensor, bert_spans_tensor, spans_ner_label_tensor = self._get_input_tensors(sample)
             assert(bert_spans_tensor.shape[1] == spans_ner_label_tensor.shape[1])
-            if (tokens_tensor.shape[1] > max_tokens):
-                max_tokens = tokens_tensor.shape[1]
-            if (bert_spans_tensor.shape[1] > max_spans):
-                max_spans = bert_spans_tensor.shape[1]
-            sentence_length.append(sample['sent_length'])
-        sentence_length = torch.Tensor(sentence_length)
-
-        # apply padding and concatenate tensors
-        max_tokens = math.ceil(max_tokens / 512) * 512
-        final_tokens_tensor = None
-        final_attention_mask = None
-        final_bert_spans_tensor = None
-        final_spans_ner_label_tensor = None
-        final_spans_mask_tensor = None
-        for tokens_tensor, bert_spans_tensor, spans_ner_label_tensor in zip(tokens_tensor_list, bert_spans_tensor_list, spans_ner_label_tensor_list):
-            # padding for tokens
+            inputs.append((tokens_tensor, bert_spans_tensor, spans_ner_label_tensor))
+            max_tokens = max(max_tokens, tokens_tensor.shape[1])
+            max_spans = max(max_spans, bert_spans_tensor.shape[1])
+        sentence_length = torch.Tensor([sample['sent_length'] for sample in samples_list])
+
+        # allocate the padded tensors once, in pinned memory if they are copied to the GPU
+        max_tokens = math.ceil(max_tokens / self.pad_to_multiple) * self.pad_to_multiple
+        batch_size = len(samples_list)
+        pin_memory = self._model_device != 'cpu'
+        final_tokens_tensor = torch.full([batch_size, max_tokens], self.tokenizer.pad_token_id, dtype=torch.long, pin_memory=pin_memory)
+        final_attention_mask = torch.zeros([batch_size, max_tokens], dtype=torch.long, pin_memory=pin_memory)
+        final_bert_spans_tensor = torch.zeros([batch_size, max_spans, 3], dtype=torch.long, pin_memory=pin_memory)
+        final_spans_ner_label_tensor = torch.zeros([batch_size, max_spans], dtype=torch.long, pin_memory=pin_memory)
+        final_spans_mask_tensor = torch.zeros([batch_size, max_spans], dtype=torch.long, pin_memory=pin_memory)
+        for i, (tokens_tensor, bert_spans_tensor, spans_ner_label_tensor) in enumerate(inputs):
             num_tokens = tokens_tensor.shape[1]
-            tokens_pad_length = max_tokens - num_tokens
-            attention_tensor = torch.full([1,num_tokens], 1, dtype=torch.long)
-            if tokens_pad_length>0:
-                pad = torch.full([1,tokens_pad_length], self.tokenizer.pad_token_id, dtype=torch.long)
-                tokens_tensor = torch.cat((tokens_tensor, pad), dim=1)
-                attention_pad = torch.full([1,tokens_pad_length], 0, dtype=torch.long)
-                attention_tensor = torch.cat((attention_tensor, attention_pad), dim=1)
-
-            # padding for spans
+            final_tokens_tensor[i, :num_tokens] = tokens_tensor[0]
+            final_attention_mask[i, :num_tokens] = 1
+
             num_spans = bert_spans_tensor.shape[1]
-            spans_pad_length = max_spans - num_spans
-            spans_mask_tensor = torch.full([1,num_spans], 1, dtype=torch.long)
-            if spans_pad_length>0:
-                pad = torch.full([1,spans_pad_length,bert_spans_tensor.shape[2]], 0, dtype=torch.long)
-                bert_spans_tensor = torch.cat((bert_spans_tensor, pad), dim=1)
-                mask_pad = torch.full([1,spans_pad_length], 0, dtype=torch.long)
-                spans_mask_tensor = torch.cat((spans_mask_tensor, mask_pad), dim=1)
-                spans_ner_label_tensor = torch.cat((spans_ner_label_tensor, mask_pad), dim=1)
-
-            # update final outputs
-            if final_tokens_tensor is None:
-                final_tokens_tensor = tokens_tensor
-                final_attention_mask = attention_tensor
-                final_bert_spans_tensor = bert_spans_tensor
-                final_spans_ner_label_tensor = spans_ner_label_tensor
-                final_spans_mask_tensor = spans_mask_tensor
-            else:
-                final_tokens_tensor = torch.cat((final_tokens_tensor,tokens_tensor), dim=0)
-                final_attention_mask = torch.cat((final_attention_mask, attention_tensor), dim=0)
-                final_bert_spans_tensor = torch.cat((final_bert_spans_tensor, bert_spans_tensor), dim=0)
-                final_spans_ner_label_tensor = torch.cat((final_spans_ner_label_tensor, spans_ner_label_tensor), dim=0)
-                final_spans_mask_tensor = torch.cat((final_spans_mask_tensor, spans_mask_tensor), dim=0)
-        #logger.info(final_tokens_tensor)
-        #logger.info(final_attention_mask)
-        #logger.info(final_bert_spans_tensor)
-        #logger.info(final_bert_spans_tensor.shape)
-        #logger.info(final_spans_mask_tensor.shape)
-        #logger.info(final_spans_ner_label_tensor.shape)
+            final_bert_spans_tensor[i, :num_spans] = bert_spans_tensor[0]
+            final_spans_ner_label_tensor[i, :num_spans] = spans_ner_label_tensor[0]
+            final_spans_mask_tensor[i, :num_spans] = 1
+
         return final_tokens_tensor, final_attention_mask, final_bert_spans_tensor, final_spans_mask_tensor, final_spans_ner_label_tensor, sentence_length
 
-    def run_batch(self, samples_list, try_cuda=True, training=True):
+    def run_batch(self, samples_list, try_cuda=True, training=True, return_probs=False, return_hidden=False):
+        """
+        Run the model on a batch of samples
+        In eval mode, 'pred_ner' holds the predicted label of each span of each sample; 'ner_probs' (logits)
+        and 'ner_last_hidden' (span embeddings) are only copied from the device if return_probs/return_hidden
+        'ner_counts' holds the number of spans, correct spans, correct entities and predicted entities of the batch
+        """
         # convert samples to input tensors
         tokens_tensor, attention_mask_tensor, bert_spans_tensor, spans_mask_tensor, spans_ner_label_tensor, sentence_length = self._get_input_tensors_batch(samples_list, training)
 
@@ -369,45 +433,44 @@ class EntityModel():
         if training:
             self.bert_model.train()
             ner_loss, ner_logits, spans_embedding = self.bert_model(
-                input_ids = tokens_tensor.to(self._model_device),
-                spans = bert_spans_tensor.to(self._model_device),
-                spans_mask = spans_mask_tensor.to(self._model_device),
-                spans_ner_label = spans_ner_label_tensor.to(self._model_device),
-                attention_mask = attention_mask_tensor.to(self._model_device),
+                input_ids = tokens_tensor.to(self._model_device, non_blocking=True),
+                spans = bert_spans_tensor.to(self._model_device, non_blocking=True),
+                spans_mask = spans_mask_tensor.to(self._model_device, non_blocking=True),
+                spans_ner_label = spans_ner_label_tensor.to(self._model_device, non_blocking=True),
+                attention_mask = attention_mask_tensor.to(self._model_device, non_blocking=True),
             )
             output_dict['ner_loss'] = ner_loss.sum()
             output_dict['ner_llh'] = F.log_softmax(ner_logits, dim=-1)
         else:
             self.bert_model.eval()
-            with torch.no_grad():
+            spans_mask_tensor = spans_mask_tensor.to(self._model_device, non_blocking=True)
+            spans_ner_label_tensor = spans_ner_label_tensor.to(self._model_device, non_blocking=True)
+            with self._inference_context():
                 ner_logits, spans_embedding, last_hidden = self.bert_model(
-                    input_ids = tokens_tensor.to(self._model_device),
-                    spans = bert_spans_tensor.to(self._model_device),
-                    spans_mask = spans_mask_tensor.to(self._model_device),
+                    input_ids = tokens_tensor.to(self._model_device, non_blocking=True),
+                    spans = bert_spans_tensor.to(self._model_device, non_blocking=True),
+                    spans_mask = spans_mask_tensor,
                     spans_ner_label = None,
-                    attention_mask = attention_mask_tensor.to(self._model_device),
+                    attention_mask = attention_mask_tensor.to(self._model_device, non_blocking=True),
                 )
             _, predicted_label = ner_logits.max(2)
+
+            # reduce the span-level counts on the device, under the span mask
+            spans_mask = spans_mask_tensor.bool()
+            correct = (predicted_label == spans_ner_label_tensor) & spans_mask
+            predicted = (predicted_label != 0) & spans_mask
+            output_dict['ner_counts'] = torch.stack([
+                spans_mask.sum(), correct.sum(), (correct & predicted).sum(), predicted.sum()]).tolist()
+
+            # one copy per batch, then slice the real spans of each sample
+            num_spans = [len(sample['spans']) for sample in samples_list]
             predicted_label = predicted_label.cpu().numpy()
-            last_hidden = last_hidden.cpu().numpy()
-            
-            predicted = []
-            pred_prob = []
-            hidden = []
-            for i, sample in enumerate(samples_list):
-                ner = []
-                prob = []
-                lh = []
-                for j in range(len(sample['spans'])):
-                    ner.append(predicted_label[i][j])
-                    # prob.append(F.softmax(ner_logits[i][j], dim=-1).cpu().numpy())
-                    prob.append(ner_logits[i][j].cpu().numpy())
-                    lh.append(last_hidden[i][j])
-                predicted.append(ner)
-                pred_prob.append(prob)
-                hidden.append(lh)
-            output_dict['pred_ner'] = predicted
-            output_dict['ner_probs'] = pred_prob
-            output_dict['ner_last_hidden'] = hidden
+            output_dict['pred_ner'] = [predicted_label[i, :n] for i, n in enumerate(num_spans)]
+            if return_probs:
+                ner_logits = ner_logits.float().cpu().numpy()
+                output_dict['ner_probs'] = [ner_logits[i, :n] for i, n in enumerate(num_spans)]
+            if return_hidden:
+                last_hidden = last_hidden.float().cpu().numpy()
+                output_dict['ner_last_hidden'] = [last_hidden[i, :n] for i, n in enumerate(num_spans)]
 
         return output_dict
@@ -1,33 +1,79 @@
 import numpy as np
 import json
 import logging
+import random
 
 logger = logging.getLogger('root')
 
-def batchify(samples, batch_size):
+def _round_up(lengths, multiple):
+    return -(-lengths // multiple) * multiple
+
+def _padding_waste(lengths, batches, pad_to_multiple=1):
+    """
+    Fraction of the padded positions that are padding, when each batch (list of indices) is padded to its longest sample,
+    rounded up to a multiple of pad_to_multiple
+    """
+    padded = sum(len(batch) * _round_up(lengths[batch].max(), pad_to_multiple) for batch in batches if len(batch) > 0)
+    return 1 - lengths.sum() / padded if padded > 0 else 0.0
+
+def batchify(samples, batch_size, max_tokens=None, bucket_size=None, shuffle=False, pad_to_multiple=1):
     """
     Batchfy samples with a batch size
+    A batch holds at most batch_size samples and, with max_tokens, at most max_tokens padded tokens
+    (token sequences are padded to a multiple of pad_to_multiple, see EntityModel.pad_to_multiple)
+    Without bucket_size, batches follow the order of the samples. With bucket_size, samples are sorted by length
+    (subword tokens if tokenized, then spans) within consecutive windows of bucket_size batches, so that batches
+    need little padding while staying close to the order of the samples
+    With shuffle, samples are shuffled before being batched
     """
     num_samples = len(samples)
+    num_tokens = np.array([len(sample['input_ids']) if 'input_ids' in sample else len(sample['tokens']) for sample in samples], dtype=np.int64)
+    padded_tokens = _round_up(num_tokens, pad_to_multiple)
+    num_spans = np.array([len(sample['spans']) for sample in samples], dtype=np.int64)
 
     list_samples_batches = []
-    
+    batches = []
+
     # if a sentence is too long, make itself a batch to avoid GPU OOM
-    to_single_batch = []
+    to_single_batch = set()
     for i in range(0, len(samples)):
         if len(samples[i]['tokens']) > 350:
-            to_single_batch.append(i)
-    
-    for i in to_single_batch:
-        logger.info('Single batch sample: %s-%d', samples[i]['doc_key'], samples[i]['sentence_ix'])
-        list_samples_batches.append([samples[i]])
-    samples = [sample for i, sample in enumerate(samples) if i not in to_single_batch]
-
-    for i in range(0, len(samples), batch_size):
-        list_samples_batches.append(samples[i:i+batch_size])
+            to_single_batch.add(i)
+            logger.info('Single batch sample: %s-%d', samples[i]['doc_key'], samples[i]['sentence_ix'])
+            batches.append([i])
+    indices = [i for i in range(len(samples)) if i not in to_single_batch]
+
+    if shuffle:
+        random.shuffle(indices)
+    window_size = batch_size * bucket_size if bucket_size else max(len(indices), 1)
+    for window_start in range(0, len(indices), window_size):
+        window = np.array(indices[window_start:window_start+window_size], dtype=np.int64)
+        if bucket_size:
+            window = window[np.lexsort((num_spans[window], num_tokens[window]))]
+        batch = []
+        batch_tokens = 0
+        for i in window.tolist():
+            # padded tokens of the batch if the sample is added to it
+            tokens = (len(batch) + 1) * max(batch_tokens, padded_tokens[i])
+            if len(batch) == batch_size or (max_tokens is not None and len(batch) > 0 and tokens > max_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens = max(batch_tokens, padded_tokens[i])
+        if len(batch) > 0:
+            batches.append(batch)
+
+    for batch in batches:
+        list_samples_batches.append([samples[i] for i in batch])
 
     assert(sum([len(batch) for batch in list_samples_batches]) == num_samples)
 
+    file_order = [list(range(i, min(i+batch_size, num_samples))) for i in range(0, num_samples, batch_size)]
+    logger.info('%d samples in %d batches, padding: %.1f%% of the tokens and %.1f%% of the spans (%.1f%% and %.1f%% with batches in file order)'%(
+        num_samples, len(list_samples_batches), _padding_waste(num_tokens, batches, pad_to_multiple)*100, _padding_waste(num_spans, batches)*100,
+        _padding_waste(num_tokens, file_order, pad_to_multiple)*100, _padding_waste(num_spans, file_order)*100))
+
     return list_samples_batches
 
 def overlap(s1, s2):
@@ -37,6 +83,20 @@ def overlap(s1, s2):
         return True
     return False
 
+def enumerate_spans(sent_length, max_span_length):
+    """
+    Enumerate the spans (i, j) of a sentence with j - i < max_span_length, ordered by i then j
+    Returns an int32 array of (start, end, width) and the (sent_length, max_span_length) table of span ids (-1 if invalid)
+    """
+    starts = np.arange(sent_length, dtype=np.int32)[:, None]
+    widths = np.arange(max_span_length, dtype=np.int32)[None, :]
+    ends = starts + widths
+    valid = ends < sent_length
+    spans = np.stack([np.broadcast_to(starts, ends.shape)[valid], ends[valid], (widths + 1).repeat(sent_length, axis=0)[valid]], axis=-1)
+    span_ids = np.full((sent_length, max_span_length), -1, dtype=np.int64)
+    span_ids[valid] = np.arange(len(spans))
+    return spans, span_ids
+
 def convert_dataset_to_samples(dataset, max_span_length, ner_label2id=None, context_window=0, split=0):
     """
     Extract sentences and gold entities from a dataset
@@ -109,17 +169,17 @@ def convert_dataset_to_samples(dataset, max_span_length, ner_label2id=None, cont
             for ner in sent.ner:
                 sent_ner[ner.span.span_sent] = ner.label
 
-            span2id = {}
-            sample['spans'] = []
-            sample['spans_label'] = []
-            for i in range(len(sent.text)):
-                for j in range(i, min(len(sent.text), i+max_span_length)):
-                    sample['spans'].append((i+sent_start, j+sent_start, j-i+1))
-                    span2id[(i, j)] = len(sample['spans'])-1
-                    if (i, j) not in sent_ner:
-                        sample['spans_label'].append(0)
-                    else:
-                        sample['spans_label'].append(ner_label2id[sent_ner[(i, j)]])
+            spans, span_ids = enumerate_spans(len(sent.text), max_span_length)
+            spans[:, :2] += sent_start
+            sample['spans'] = spans
+            sample['spans_label'] = np.zeros(len(spans), dtype=np.int64)
+            if len(sent_ner) > 0:
+                # gold spans that are not candidates (too long) are ignored
+                ner_spans = np.array(list(sent_ner.keys()), dtype=np.int64).reshape(-1, 2)
+                ner_labels = np.array([ner_label2id[label] for label in sent_ner.values()], dtype=np.int64)
+                widths = ner_spans[:, 1] - ner_spans[:, 0]
+                candidate = (widths >= 0) & (widths < max_span_length) & (ner_spans[:, 0] >= 0) & (ner_spans[:, 1] < len(sent.text))
+                sample['spans_label'][span_ids[ner_spans[candidate, 0], widths[candidate]]] = ner_labels[candidate]
             samples.append(sample)
     avg_length = sum([len(sample['tokens']) for sample in samples]) / len(samples)
     max_length = max([len(sample['tokens']) for sample in samples])
@@ -143,28 +203,18 @@ def get_train_fold(data, fold):
     print('Getting train fold %d...'%fold)
     l = int(len(data) * 0.1 * fold)
     r = int(len(data) * 0.1 * (fold+1))
-    new_js = []
-    new_docs = []
-    for i in range(len(data)):
-        if i < l or i >= r:
-            new_js.append(data.js[i])
-            new_docs.append(data.documents[i])
-    print('# documents: %d --> %d'%(len(data), len(new_docs)))
-    data.js = new_js
-    data.documents = new_docs
+    # documents of the fold are built on first access
+    new_js = data.js[:l] + data.js[r:]
+    print('# documents: %d --> %d'%(len(data), len(new_js)))
+    data.update_from_js(new_js)
     return data
 
 def get_test_fold(data, fold):
     print('Getting test fold %d...'%fold)
     l = int(len(data) * 0.1 * fold)
     r = int(len(data) * 0.1 * (fold+1))
-    new_js = []
-    new_docs = []
-    for i in range(len(data)):
-        if i >= l and i < r:
-            new_js.append(data.js[i])
-            new_docs.append(data.documents[i])
-    print('# documents: %d --> %d'%(len(data), len(new_docs)))
-    data.js = new_js
-    data.documents = new_docs
+    # documents of the fold are built on first access
+    new_js = data.js[l:r]
+    print('# documents: %d --> %d'%(len(data), len(new_js)))
+    data.update_from_js(new_js)
     return data
@@ -1,75 +1,166 @@
 import argparse
 import os
 import json
+import multiprocessing
+from collections import deque
+from functools import partial
+from itertools import islice
+import ijson
 import numpy as np
 
-def process_dataset(input_file, output_file, name):
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    out_data = []
-    for doc_key, instance in enumerate(data):
-        if doc_key >= 10:
-            break
-        sents_start_pos = np.insert(np.cumsum([len(sent) for sent in instance['sents']]), 0, 0).tolist()
-        
+def iter_instances(input_file):
+    """
+    Iterate over the documents of a Linked-DocRED file, parsing it incrementally
+    """
+    with open(input_file, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
+
+def coref_links(mentions, coref):
+    """
+    COREF links between the mentions of an entity: all the pairs, or a chain through consecutive mentions
+    """
+    if coref == 'chain':
+        return list(zip(mentions, mentions[1:]))
+    return [(mentions[i], mentions[j]) for i in range(len(mentions)) for j in range(i+1, len(mentions))]
+
+def convert_instance(instance, doc_key, name, layout='document', coref='pairs'):
+    """
+    Convert a Linked-DocRED document to the PURE format.
+    With the 'document' layout, the document is a single sentence; with the 'sentence' layout, the sentences
+    are kept and only the links between mentions of the same sentence are kept (a relation links the first mentions,
+    in annotation order, of its entities in the first sentence mentioning both).
+    Returns the converted document and the number of relations dropped by the layout
+    """
+    sents_start_pos = np.insert(np.cumsum([len(sent) for sent in instance['sents']]), 0, 0).tolist()
+    if layout == 'document':
         sentences = [[word for sent in instance['sents'] for word in sent]]
+    else:
+        sentences = instance['sents']
+    ner = [[] for _ in sentences]
+    relations = [[] for _ in sentences]
+
+    def sentence_of(mention):
+        return 0 if layout == 'document' else mention['sent_id']
+
+    # Mentions as (sentence, start, end) in document offsets
+    entities = instance['entities']
+    entity_mentions = []
+    for entity in entities:
+        mentions = []
+        for mention in entity['mentions']:
+            sent_offset = sents_start_pos[mention['sent_id']]
+            pos = mention['pos']
+            mentions.append((sentence_of(mention), sent_offset + pos[0], sent_offset + pos[1] - 1))
+            ner[mentions[-1][0]].append([mentions[-1][1], mentions[-1][2], entity['type']])
+        entity_mentions.append(mentions)
+
+    # Coref
+    for mentions in entity_mentions:
+        by_sentence = {}
+        for mention in mentions:
+            by_sentence.setdefault(mention[0], []).append(mention)
+        for sent_id, sent_mentions in by_sentence.items():
+            for mention1, mention2 in coref_links(sent_mentions, coref):
+                relations[sent_id].append([*mention1[1:], *mention2[1:], 'COREF'])
+
+    # Other relations
+    n_dropped = 0
+    for relation in instance['relations']:
+        mentions1 = entity_mentions[relation['h']]
+        mentions2 = entity_mentions[relation['t']]
+        common_sentences = {mention[0] for mention in mentions1} & {mention[0] for mention in mentions2}
+        if len(common_sentences) == 0:
+            n_dropped += 1
+            continue
+        sent_id = min(common_sentences)
+        mention1 = next(mention for mention in mentions1 if mention[0] == sent_id)
+        mention2 = next(mention for mention in mentions2 if mention[0] == sent_id)
+
+        relations[sent_id].append([*mention1[1:], *mention2[1:], relation['r']])
+
+    return {
+        'doc_key': f'key-{name}-{doc_key}',
+        'sentences': sentences,
+        'ner': ner,
+        'relations': relations
+    }, n_dropped
 
-        entities = instance['entities']
-        ner = []
-        for entity in entities:
-            entity_type = entity['type']
-            for mention in entity['mentions']:
-                sent_offset = sents_start_pos[mention['sent_id']]
-                pos = mention['pos']
-                mention['doc_pos'] = (sent_offset + pos[0], sent_offset + pos[1] - 1)
-                
-                ner.append([mention['doc_pos'][0], mention['doc_pos'][1], entity_type])
-        
-        relations = []
-
-        # Coref
-        for entity in entities:
-            mentions = entity['mentions']
-            for i in range(len(mentions)):
-                for j in range(i+1, len(mentions)):
-                    mention1 = mentions[i]
-                    mention2 = mentions[j]
-                    
-                    relations.append([*mention1['doc_pos'], *mention2['doc_pos'], 'COREF'])
-
-        # Other relations
-        for relation in instance['relations']:
-            entity1 = entities[relation['h']]
-            entity2 = entities[relation['t']]
-            
-            mention1 = entity1['mentions'][0]
-            mention2 = entity2['mentions'][0]
-            
-            relations.append([*mention1['doc_pos'], *mention2['doc_pos'], relation['r']])
-        
-        out_data.append({
-            'doc_key': f'key-{name}-{doc_key}',
-            'sentences': sentences,
-            'ner': [ner],
-            'relations': [relations]
-        })
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for instance in out_data:
-            json.dump(instance, f)
+def _convert_chunk(convert, chunk):
+    """
+    Convert a chunk of (doc_key, instance) to JSON lines
+    """
+    lines = []
+    for doc_key, instance in chunk:
+        out_instance, n_dropped = convert(instance, doc_key)
+        lines.append((json.dumps(out_instance), n_dropped))
+    return lines
+
+def convert_instances(instances, convert, jobs=1, chunksize=16):
+    """
+    Convert documents, in a process pool with several jobs, yielding JSON lines in document order
+    """
+    chunks = iter(lambda: list(islice(instances, chunksize)), [])
+    if jobs <= 1:
+        for chunk in chunks:
+            yield from _convert_chunk(convert, chunk)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        # Bound the number of chunks in flight, so that the input is not loaded ahead of the workers
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_convert_chunk, (convert, chunk)))
+            if len(pending) >= 2 * jobs:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+def process_dataset(input_file, output_file, name, layout='document', coref='pairs', jobs=1, shard_size=0):
+    """
+    Convert a Linked-DocRED file to the PURE format (JSON lines).
+    With `shard_size`, the output is split in files of `shard_size` documents, numbered after `output_file`
+    """
+    convert = partial(convert_instance, name=name, layout=layout, coref=coref)
+    lines = convert_instances(enumerate(iter_instances(input_file)), convert, jobs)
+
+    output_root, output_ext = os.path.splitext(output_file)
+    def shard_path(shard):
+        return output_file if shard_size <= 0 else f'{output_root}-{shard:05d}{output_ext}'
+
+    f = open(shard_path(0), 'w', encoding='utf-8')
+    n_docs = 0
+    n_dropped = 0
+    try:
+        for line, doc_dropped in lines:
+            if shard_size > 0 and n_docs > 0 and n_docs % shard_size == 0:
+                f.close()
+                f = open(shard_path(n_docs // shard_size), 'w', encoding='utf-8')
+            f.write(line)
             f.write('\n')
+            n_docs += 1
+            n_dropped += doc_dropped
+    finally:
+        f.close()
+    print(f'{name}: {n_docs} documents, {n_dropped} relations across sentences dropped')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--input_dir', type=str, default=None, required=True, 
+    parser.add_argument('--input_dir', type=str, default=None, required=True,
                         help="path to the input dataset")
-    parser.add_argument('--output_dir', type=str, default='entity_output', 
+    parser.add_argument('--output_dir', type=str, default='entity_output',
                         help="output directory of the dataset")
-    
+    parser.add_argument('--layout', type=str, default='document', choices=['document', 'sentence'],
+                        help="whether a document is a single sentence, or keeps its sentences (links across sentences are dropped)")
+    parser.add_argument('--coref', type=str, default='pairs', choices=['pairs', 'chain'],
+                        help="COREF links between all the mention pairs of an entity, or a chain through consecutive mentions")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of processes converting documents")
+    parser.add_argument('--shard_size', type=int, default=0,
+                        help="number of documents per output file (0 for a single file per split)")
+
     args = parser.parse_args()
-    
+
     # Paths
     args.input_train_data = os.path.join(args.input_dir, 'train_annotated.json')
     args.input_dev_data = os.path.join(args.input_dir, 'dev.json')
@@ -77,11 +168,12 @@ if __name__ == '__main__':
     args.output_train_data = os.path.join(args.output_dir, 'train.json')
     args.output_dev_data = os.path.join(args.output_dir, 'dev.json')
     args.output_test_data = os.path.join(args.output_dir, 'test.json')
-    
+
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
     # Process dataset
-    process_dataset(args.input_train_data, args.output_train_data, 'train')
-    process_dataset(args.input_dev_data, args.output_dev_data, 'dev')
-    process_dataset(args.input_test_data, args.output_test_data, 'test')
\ No newline at end of file
+    for input_file, output_file, name in [(args.input_train_data, args.output_train_data, 'train'),
+                                          (args.input_dev_data, args.output_dev_data, 'dev'),
+                                          (args.input_test_data, args.output_test_data, 'test')]:
+        process_dataset(input_file, output_file, name, args.layout, args.coref, args.jobs, args.shard_size)
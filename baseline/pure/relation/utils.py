@@ -5,7 +5,7 @@ import functools
 import random
 import os
 
-from shared.data_structures import Dataset
+from shared.data_structures import Dataset, iter_documents
 
 logger = logging.getLogger('root')
 
@@ -18,15 +18,32 @@ def decode_sample_id(sample_id):
 
     return doc_sent, sub, obj
 
-def generate_relation_data(entity_data, use_gold=False, context_window=0):
+def build_type_pair_table(train_data):
+    """
+    Collect the relations taken by each (subject type, object type) pair in the training data
+    Returns a dict mapping (subject type, object type) to the set of its relation labels
+    """
+    type_pairs = {}
+    for doc in iter_documents(train_data):
+        for sent in doc:
+            ner_label = {ner.span: ner.label for ner in sent.ner}
+            for rel in sent.relations:
+                key = (ner_label.get(rel.pair[0]), ner_label.get(rel.pair[1]))
+                type_pairs.setdefault(key, set()).add(rel.label)
+    logger.info('%d type pairs take relations in %s'%(len(type_pairs), train_data))
+    return type_pairs
+
+def generate_relation_data(entity_data, use_gold=False, context_window=0, type_pairs=None):
     """
     Prepare data for the relation model
     If training: set use_gold = True
+    type_pairs: if given (see build_type_pair_table), pairs whose types never take a relation are pruned
     """
     logger.info('Generate relation data from %s'%(entity_data))
     data = Dataset(entity_data)
 
     nner, nrel = 0, 0
+    npruned, npruned_rel = 0, 0
     max_sentsample = 0
     samples = []
     for doc in data:
@@ -79,6 +96,10 @@ def generate_relation_data(entity_data, use_gold=False, context_window=0):
                     sub = sent_ner[x]
                     obj = sent_ner[y]
                     label = gold_rel.get((sub.span, obj.span), 'no_relation')
+                    if type_pairs is not None and (sub.label, obj.label) not in type_pairs:
+                        npruned += 1
+                        npruned_rel += label != 'no_relation'
+                        continue
                     sample = {}
                     sample['docid'] = doc._doc_key
                     sample['id'] = '%s@%d::(%d,%d)-(%d,%d)'%(doc._doc_key, sent.sentence_ix, sub.span.start_doc, sub.span.end_doc, obj.span.start_doc, obj.span.end_doc)
@@ -100,5 +121,8 @@ def generate_relation_data(entity_data, use_gold=False, context_window=0):
     
     tot = len(samples)
     logger.info('#samples: %d, max #sent.samples: %d'%(tot, max_sentsample))
+    if type_pairs is not None:
+        logger.info('#pruned pairs: %d (%.2f%%), #pruned gold relations: %d / %d, recall ceiling: %.2f%%'%(
+            npruned, npruned * 100.0 / max(tot + npruned, 1), npruned_rel, nrel, (1 - npruned_rel / max(nrel, 1)) * 100.0))
 
     return data, samples, nrel
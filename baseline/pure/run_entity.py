@@ -30,52 +30,69 @@ def save_model(model, args):
     model_to_save.save_pretrained(args.output_dir)
     model.tokenizer.save_pretrained(args.output_dir)
 
-def output_ner_predictions(model, batches, dataset, output_file):
+class NerPredictionWriter:
     """
-    Save the prediction as a json file
+    Write the predictions as a jsonl file, streamed during inference
+    Documents are written in the order of the dataset, as soon as all their samples are predicted, so that only the
+    documents after the first incomplete one are buffered (batches should roughly follow the documents, see batchify)
     """
-    ner_result = {}
-    span_hidden_table = {}
-    tot_pred_ett = 0
-    for i in range(len(batches)):
-        output_dict = model.run_batch(batches[i], training=False)
-        pred_ner = output_dict['pred_ner']
-        for sample, preds in zip(batches[i], pred_ner):
-            off = sample['sent_start_in_doc'] - sample['sent_start']
-            k = str(sample['doc_key']) + '-' + str(sample['sentence_ix'])
-            ner_result[k] = []
-            for span, pred in zip(sample['spans'], preds):
-                span_id = '%s::%d::(%d,%d)'%(str(sample['doc_key']), sample['sentence_ix'], span[0]+off, span[1]+off)
-                if pred == 0:
-                    continue
-                ner_result[k].append([span[0]+off, span[1]+off, ner_id2label[pred]])
-            tot_pred_ett += len(ner_result[k])
-
-    logger.info('Total pred entities: %d'%tot_pred_ett)
-
-    js = dataset.js
-    for i, doc in enumerate(js):
+    def __init__(self, dataset, output_file, samples):
+        logger.info('Output predictions to %s..'%(output_file))
+        self.js = dataset.js
+        self.f = open(output_file, 'w')
+        self.ner_result = {}
+        self.next_doc = 0
+        self.tot_pred_ett = 0
+        # number of samples still to predict in each document
+        self.doc_ix = {doc['doc_key']: i for i, doc in enumerate(self.js)}
+        self.pending = [0] * len(self.js)
+        for sample in samples:
+            self.pending[self.doc_ix[sample['doc_key']]] += 1
+
+    def add(self, sample, preds):
+        off = sample['sent_start_in_doc'] - sample['sent_start']
+        k = str(sample['doc_key']) + '-' + str(sample['sentence_ix'])
+        self.ner_result[k] = []
+        for span, pred in zip(sample['spans'], preds):
+            if pred == 0:
+                continue
+            self.ner_result[k].append([span[0]+off, span[1]+off, ner_id2label[pred]])
+        self.tot_pred_ett += len(self.ner_result[k])
+        self.pending[self.doc_ix[sample['doc_key']]] -= 1
+        self._flush()
+
+    def _sentence_keys(self, doc):
+        return [str(doc['doc_key']) + '-' + str(j) for j in range(len(doc["sentences"]))]
+
+    def _write_doc(self):
+        doc = self.js[self.next_doc]
         doc["predicted_ner"] = []
         doc["predicted_relations"] = []
-        for j in range(len(doc["sentences"])):
-            k = doc['doc_key'] + '-' + str(j)
-            if k in ner_result:
-                doc["predicted_ner"].append(ner_result[k])
+        for k in self._sentence_keys(doc):
+            if k in self.ner_result:
+                doc["predicted_ner"].append(self.ner_result.pop(k))
             else:
                 logger.info('%s not in NER results!'%k)
                 doc["predicted_ner"].append([])
-            
             doc["predicted_relations"].append([])
-
-        js[i] = doc
-
-    logger.info('Output predictions to %s..'%(output_file))
-    with open(output_file, 'w') as f:
-        f.write('\n'.join(json.dumps(doc, cls=NpEncoder) for doc in js))
-
-def evaluate(model, batches, tot_gold):
+        if self.next_doc > 0:
+            self.f.write('\n')
+        self.f.write(json.dumps(doc, cls=NpEncoder))
+        self.next_doc += 1
+
+    def _flush(self):
+        while self.next_doc < len(self.js) and self.pending[self.next_doc] == 0:
+            self._write_doc()
+
+    def close(self):
+        while self.next_doc < len(self.js):
+            self._write_doc()
+        self.f.close()
+        logger.info('Total pred entities: %d'%self.tot_pred_ett)
+
+def evaluate(model, batches, tot_gold, prediction_writer=None):
     """
-    Evaluate the entity model
+    Evaluate the entity model, and pass its predictions to prediction_writer (in the same inference pass)
     """
     logger.info('Evaluating...')
     c_time = time.time()
@@ -86,16 +103,14 @@ def evaluate(model, batches, tot_gold):
 
     for i in range(len(batches)):
         output_dict = model.run_batch(batches[i], training=False)
-        pred_ner = output_dict['pred_ner']
-        for sample, preds in zip(batches[i], pred_ner):
-            for gold, pred in zip(sample['spans_label'], preds):
-                l_tot += 1
-                if pred == gold:
-                    l_cor += 1
-                if pred != 0 and gold != 0 and pred == gold:
-                    cor += 1
-                if pred != 0:
-                    tot_pred += 1
+        batch_l_tot, batch_l_cor, batch_cor, batch_tot_pred = output_dict['ner_counts']
+        l_tot += batch_l_tot
+        l_cor += batch_l_cor
+        cor += batch_cor
+        tot_pred += batch_tot_pred
+        if prediction_writer is not None:
+            for sample, preds in zip(batches[i], output_dict['pred_ner']):
+                prediction_writer.add(sample, preds)
                    
     acc = l_cor / l_tot
     logger.info('Accuracy: %5f'%acc)
@@ -104,7 +119,10 @@ def evaluate(model, batches, tot_gold):
     r = cor / tot_gold if cor > 0 else 0.0
     f1 = 2 * (p * r) / (p + r) if cor > 0 else 0.0
     logger.info('P: %.5f, R: %.5f, F1: %.5f'%(p, r, f1))
-    logger.info('Used time: %f'%(time.time()-c_time))
+    used_time = time.time()-c_time
+    num_docs = len(set(sample['doc_key'] for batch in batches for sample in batch))
+    logger.info('Used time: %f'%used_time)
+    logger.info('Throughput: %.2f documents/s (%d documents, device=%s, bf16=%s)'%(num_docs / used_time, num_docs, model._model_device, model.bf16))
     return f1
 
 def setseed(seed):
@@ -129,6 +147,10 @@ if __name__ == '__main__':
                         help="batch size during training")
     parser.add_argument('--eval_batch_size', type=int, default=32, 
                         help="batch size during inference")
+    parser.add_argument('--max_batch_tokens', type=int, default=None,
+                        help="maximum number of padded subword tokens in a batch (batches are also capped by the batch size)")
+    parser.add_argument('--bucket_size', type=int, default=100,
+                        help="sort evaluation samples (and training samples with --train_bucketing) by length within windows of this many batches, to reduce padding (0 keeps the order of the samples)")
     parser.add_argument('--learning_rate', type=float, default=1e-5, 
                         help="learning rate for the BERT encoder")
     parser.add_argument('--task_learning_rate', type=float, default=1e-4, 
@@ -147,6 +169,8 @@ if __name__ == '__main__':
                         help="whether to run training")
     parser.add_argument('--train_shuffle', action='store_true',
                         help="whether to train with randomly shuffled data")
+    parser.add_argument('--train_bucketing', action='store_true',
+                        help="whether to batch training samples of similar length (see --bucket_size; with --train_shuffle, samples are shuffled before being bucketed)")
     parser.add_argument('--do_eval', action='store_true', 
                         help="whether to run evaluation")
     parser.add_argument('--eval_test', action='store_true', 
@@ -166,6 +190,17 @@ if __name__ == '__main__':
 
     parser.add_argument('--seed', type=int, default=0)
 
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cuda', 'cpu'],
+                        help="device of the model (auto: cuda if available, else cpu)")
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help="number of CPU threads used by torch")
+    parser.add_argument('--bf16', action='store_true',
+                        help="whether to run inference with bfloat16 autocast")
+    parser.add_argument('--quantize', action='store_true',
+                        help="whether to quantize the linear layers to int8 for evaluation (CPU only)")
+    parser.add_argument('--tokenization_cache_dir', type=str, default=None,
+                        help="directory where the tokenized samples are cached (keyed by tokenizer and data), to skip tokenization in later runs")
+
     parser.add_argument('--context_window', type=int, required=True, default=None, 
                         help="the context window size W for the entity model")
 
@@ -200,12 +235,17 @@ if __name__ == '__main__':
 
     dev_data = Dataset(args.dev_data)
     dev_samples, dev_ner = convert_dataset_to_samples(dev_data, args.max_span_length, ner_label2id=ner_label2id, context_window=args.context_window)
-    dev_batches = batchify(dev_samples, args.eval_batch_size)
+    model.tokenize_samples(dev_samples, args.tokenization_cache_dir)
+    dev_batches = batchify(dev_samples, args.eval_batch_size, max_tokens=args.max_batch_tokens, bucket_size=args.bucket_size, pad_to_multiple=model.pad_to_multiple)
 
     if args.do_train:
         train_data = Dataset(args.train_data)
         train_samples, train_ner = convert_dataset_to_samples(train_data, args.max_span_length, ner_label2id=ner_label2id, context_window=args.context_window)
-        train_batches = batchify(train_samples, args.train_batch_size)
+        model.tokenize_samples(train_samples, args.tokenization_cache_dir)
+        # batches are made once, so that the number of steps of the schedule is the same at each epoch
+        train_batches = batchify(train_samples, args.train_batch_size, max_tokens=args.max_batch_tokens,
+                                 bucket_size=args.bucket_size if args.train_bucketing else None,
+                                 shuffle=args.train_shuffle and args.train_bucketing, pad_to_multiple=model.pad_to_multiple)
         best_result = 0.0
 
         param_optimizer = list(model.bert_model.named_parameters())
@@ -253,6 +293,8 @@ if __name__ == '__main__':
     if args.do_eval:
         args.bert_model_dir = args.output_dir
         model = EntityModel(args, num_ner_labels=num_ner_labels)
+        if args.quantize:
+            model.quantize()
         if args.eval_test:
             test_data = Dataset(args.test_data)
             prediction_file = os.path.join(args.output_dir, args.test_pred_filename)
@@ -260,6 +302,8 @@ if __name__ == '__main__':
             test_data = Dataset(args.dev_data)
             prediction_file = os.path.join(args.output_dir, args.dev_pred_filename)
         test_samples, test_ner = convert_dataset_to_samples(test_data, args.max_span_length, ner_label2id=ner_label2id, context_window=args.context_window)
-        test_batches = batchify(test_samples, args.eval_batch_size)
-        evaluate(model, test_batches, test_ner)
-        output_ner_predictions(model, test_batches, test_data, output_file=prediction_file)
+        model.tokenize_samples(test_samples, args.tokenization_cache_dir)
+        test_batches = batchify(test_samples, args.eval_batch_size, max_tokens=args.max_batch_tokens, bucket_size=args.bucket_size, pad_to_multiple=model.pad_to_multiple)
+        prediction_writer = NerPredictionWriter(test_data, prediction_file, test_samples)
+        evaluate(model, test_batches, test_ner, prediction_writer=prediction_writer)
+        prediction_writer.close()
@@ -12,7 +12,7 @@ import sys
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader
 from collections import Counter
 from tqdm.auto import tqdm
 from torch.nn import CrossEntropyLoss
@@ -22,7 +22,7 @@ from relation.models import BertForRelation, AlbertForRelation, LongformerForRel
 from transformers import AutoTokenizer
 from transformers import AdamW, get_linear_schedule_with_warmup
 
-from relation.utils import generate_relation_data, decode_sample_id
+from relation.utils import build_type_pair_table, generate_relation_data, decode_sample_id
 from shared.const import task_rel_labels, task_ner_labels
 
 CLS = "[CLS]"
@@ -34,16 +34,46 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s
 logger = logging.getLogger(__name__)
 
 class InputFeatures(object):
-    """A single set of features of data."""
+    """A single set of features of data (input_ids are not padded, see collate_features)."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_id, sub_idx, obj_idx):
+    def __init__(self, input_ids, label_id, sub_idx, obj_idx):
         self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
         self.label_id = label_id
         self.sub_idx = sub_idx
         self.obj_idx = obj_idx
 
+def collate_features(features):
+    """
+    Pad a batch of features to its longest sequence
+    Returns the tensors input_ids, input_mask, segment_ids, label_ids, sub_idx and obj_idx
+    """
+    max_length = max(len(f.input_ids) for f in features)
+    input_ids = torch.zeros([len(features), max_length], dtype=torch.long)
+    input_mask = torch.zeros([len(features), max_length], dtype=torch.long)
+    for i, f in enumerate(features):
+        input_ids[i, :len(f.input_ids)] = torch.from_numpy(f.input_ids)
+        input_mask[i, :len(f.input_ids)] = 1
+    segment_ids = torch.zeros([len(features), max_length], dtype=torch.long)
+    label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
+    sub_idx = torch.tensor([f.sub_idx for f in features], dtype=torch.long)
+    obj_idx = torch.tensor([f.obj_idx for f in features], dtype=torch.long)
+    return input_ids, input_mask, segment_ids, label_ids, sub_idx, obj_idx
+
+def length_sorted_batches(features, batch_size):
+    """
+    Batches of feature indices, by increasing sequence length (a batch_sampler)
+    """
+    order = np.argsort([len(f.input_ids) for f in features], kind='stable')
+    return [order[i:i+batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+def get_dataloader(features, batch_size, sort_by_length=False):
+    """
+    Batch the features in order, or by length with sort_by_length (padded per batch)
+    """
+    if sort_by_length:
+        return DataLoader(features, batch_sampler=length_sorted_batches(features, batch_size), collate_fn=collate_features)
+    return DataLoader(features, batch_size=batch_size, collate_fn=collate_features)
+
 def add_marker_tokens(tokenizer, ner_labels):
     new_tokens = ['<SUBJ_START>', '<SUBJ_END>', '<OBJ_START>', '<OBJ_END>']
     for label in ner_labels:
@@ -57,10 +87,33 @@ def add_marker_tokens(tokenizer, ner_labels):
     tokenizer.add_tokens(new_tokens)
     logger.info('# vocab after adding markers: %d'%len(tokenizer))
 
+def insert_markers(seq, offsets, markers):
+    """
+    Insert markers in a sequence of subwords (or subword ids), as if they were added word by word
+    offsets: index in seq of the first subword of each word (and the length of seq)
+    markers: list of (word index, is_end, marker), inserted before (is_end=0) or after (is_end=1) the subwords of the word
+    Returns the new sequence and the index of each marker in it
+    """
+    # markers are ordered as in the word by word loop: by word, start markers before end markers, and by position in markers
+    order = sorted(range(len(markers)), key=lambda k: (markers[k][0], markers[k][1], k))
+    output = []
+    positions = [None] * len(markers)
+    last = 0
+    for k in order:
+        word, is_end, marker = markers[k]
+        position = offsets[word + is_end]
+        output.extend(seq[last:position])
+        last = position
+        positions[k] = len(output)
+        output.append(marker)
+    output.extend(seq[last:])
+    return output, positions
+
 def convert_examples_to_features(examples, label2id, max_seq_length, tokenizer, special_tokens, unused_tokens=True):
     """
     Loads a data file into a list of `InputBatch`s.
     unused_tokens: whether use [unused1] [unused2] as special tokens
+    The context of a sentence is tokenized once (shared by its consecutive examples), and the markers of each pair are spliced in
     """
 
     def get_special_token(w):
@@ -71,6 +124,19 @@ def convert_examples_to_features(examples, label2id, max_seq_length, tokenizer,
                 special_tokens[w] = ('<' + w + '>').lower()
         return special_tokens[w]
 
+    word_tokens = {}
+    def tokenize_context(words):
+        sub_tokens = []
+        offsets = [0]
+        for word in words:
+            if word not in word_tokens:
+                word_tokens[word] = tokenizer.tokenize(word)
+            sub_tokens.extend(word_tokens[word])
+            offsets.append(len(sub_tokens))
+        return sub_tokens, tokenizer.convert_tokens_to_ids(sub_tokens), offsets
+
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids([CLS, SEP])
+    context = None
     num_tokens = 0
     max_tokens = 0
     num_fit_examples = 0
@@ -80,7 +146,10 @@ def convert_examples_to_features(examples, label2id, max_seq_length, tokenizer,
         if ex_index % 10000 == 0:
             logger.info("Writing example %d of %d" % (ex_index, len(examples)))
 
-        tokens = [CLS]
+        if context is None or context[0] != example['token']:
+            context = (example['token'],) + tokenize_context(example['token'])
+        _, sub_tokens, context_ids, offsets = context
+
         SUBJECT_START = get_special_token("SUBJ_START")
         SUBJECT_END = get_special_token("SUBJ_END")
         OBJECT_START = get_special_token("OBJ_START")
@@ -93,26 +162,26 @@ def convert_examples_to_features(examples, label2id, max_seq_length, tokenizer,
         OBJECT_START_NER = get_special_token("OBJ_START=%s"%example['obj_type'])
         OBJECT_END_NER = get_special_token("OBJ_END=%s"%example['obj_type'])
 
-        for i, token in enumerate(example['token']):
-            if i == example['subj_start']:
-                sub_idx = len(tokens)
-                tokens.append(SUBJECT_START_NER)
-            if i == example['obj_start']:
-                obj_idx = len(tokens)
-                tokens.append(OBJECT_START_NER)
-            for sub_token in tokenizer.tokenize(token):
-                tokens.append(sub_token)
-            if i == example['subj_end']:
-                tokens.append(SUBJECT_END_NER)
-            if i == example['obj_end']:
-                tokens.append(OBJECT_END_NER)
-        tokens.append(SEP)
-
-        num_tokens += len(tokens)
-        max_tokens = max(max_tokens, len(tokens))
-
-        if len(tokens) > max_seq_length:
-            tokens = tokens[:max_seq_length]
+        # markers of words outside the context are never inserted
+        markers = [(example['subj_start'], 0, SUBJECT_START_NER), (example['obj_start'], 0, OBJECT_START_NER),
+                   (example['subj_end'], 1, SUBJECT_END_NER), (example['obj_end'], 1, OBJECT_END_NER)]
+        markers = [marker if 0 <= marker[0] < len(example['token']) else None for marker in markers]
+        inserted = [marker for marker in markers if marker is not None]
+        marker_ids = tokenizer.convert_tokens_to_ids([marker for _, _, marker in inserted])
+        input_ids, positions = insert_markers(context_ids, offsets, [(word, is_end, marker_id) for (word, is_end, _), marker_id in zip(inserted, marker_ids)])
+        input_ids = [cls_id] + input_ids + [sep_id]
+        positions = iter(positions)
+        positions = [None if marker is None else next(positions) + 1 for marker in markers]
+        if positions[0] is not None:
+            sub_idx = positions[0]
+        if positions[1] is not None:
+            obj_idx = positions[1]
+
+        num_tokens += len(input_ids)
+        max_tokens = max(max_tokens, len(input_ids))
+
+        if len(input_ids) > max_seq_length:
+            input_ids = input_ids[:max_seq_length]
             if sub_idx >= max_seq_length:
                 sub_idx = 0
             if obj_idx >= max_seq_length:
@@ -120,35 +189,23 @@ def convert_examples_to_features(examples, label2id, max_seq_length, tokenizer,
         else:
             num_fit_examples += 1
 
-        segment_ids = [0] * len(tokens)
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-        input_mask = [1] * len(input_ids)
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
+        input_ids = np.array(input_ids, dtype=np.int64)
         label_id = label2id[example['relation']]
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
 
         if num_shown_examples < 20:
             if (ex_index < 5) or (label_id > 0):
                 num_shown_examples += 1
+                tokens = [CLS] + insert_markers(sub_tokens, offsets, inserted)[0] + [SEP]
                 logger.info("*** Example ***")
                 logger.info("guid: %s" % (example['id']))
                 logger.info("tokens: %s" % " ".join(
-                        [str(x) for x in tokens]))
+                        [str(x) for x in tokens[:max_seq_length]]))
                 logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-                logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-                logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
                 logger.info("label: %s (id = %d)" % (example['relation'], label_id))
                 logger.info("sub_idx, obj_idx: %d, %d" % (sub_idx, obj_idx))
 
         features.append(
                 InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
                               label_id=label_id,
                               sub_idx=sub_idx,
                               obj_idx=obj_idx))
@@ -194,6 +251,8 @@ def evaluate(model, device, eval_dataloader, eval_label_ids, num_labels, e2e_ngo
     eval_loss = 0
     nb_eval_steps = 0
     preds = []
+    # batches may be sorted by length: put the predictions back in the order of the examples
+    order = [i for batch in eval_dataloader.batch_sampler for i in batch]
     for input_ids, input_mask, segment_ids, label_ids, sub_idx, obj_idx in eval_dataloader:
         input_ids = input_ids.to(device)
         input_mask = input_mask.to(device)
@@ -207,15 +266,13 @@ def evaluate(model, device, eval_dataloader, eval_label_ids, num_labels, e2e_ngo
         tmp_eval_loss = loss_fct(logits.view(-1, num_labels), label_ids.view(-1))
         eval_loss += tmp_eval_loss.mean().item()
         nb_eval_steps += 1
-        if len(preds) == 0:
-            preds.append(logits.detach().cpu().numpy())
-        else:
-            preds[0] = np.append(
-                preds[0], logits.detach().cpu().numpy(), axis=0)
+        preds.append(logits.detach().cpu().numpy())
 
     eval_loss = eval_loss / nb_eval_steps
-    logits = preds[0]
-    preds = np.argmax(preds[0], axis=1)
+    preds = np.concatenate(preds, axis=0)
+    logits = np.empty_like(preds)
+    logits[order] = preds
+    preds = np.argmax(logits, axis=1)
     result = compute_f1(preds, eval_label_ids.numpy(), e2e_ngold=e2e_ngold)
     result['accuracy'] = simple_accuracy(preds, eval_label_ids.numpy())
     result['eval_loss'] = eval_loss
@@ -276,15 +333,19 @@ def main(args):
     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     n_gpu = torch.cuda.device_count()
 
+    if args.prune_type_pairs and args.train_file is None:
+        raise ValueError("`prune_type_pairs` requires `train_file`, from which the type pairs are collected.")
+    # type pairs that take relations in the train set
+    type_pairs = build_type_pair_table(args.train_file) if args.prune_type_pairs else None
     # train set
     if args.do_train:
-        train_dataset, train_examples, train_nrel = generate_relation_data(args.train_file, use_gold=True, context_window=args.context_window)
+        train_dataset, train_examples, train_nrel = generate_relation_data(args.train_file, use_gold=True, context_window=args.context_window, type_pairs=type_pairs)
     # dev set
     if (args.do_eval and args.do_train) or (args.do_eval and not(args.eval_test)):
-        eval_dataset, eval_examples, eval_nrel = generate_relation_data(os.path.join(args.entity_output_dir, args.entity_predictions_dev), use_gold=args.eval_with_gold, context_window=args.context_window)
+        eval_dataset, eval_examples, eval_nrel = generate_relation_data(os.path.join(args.entity_output_dir, args.entity_predictions_dev), use_gold=args.eval_with_gold, context_window=args.context_window, type_pairs=type_pairs)
     # test set
     if args.eval_test:
-        test_dataset, test_examples, test_nrel = generate_relation_data(os.path.join(args.entity_output_dir, args.entity_predictions_test), use_gold=args.eval_with_gold, context_window=args.context_window)
+        test_dataset, test_examples, test_nrel = generate_relation_data(os.path.join(args.entity_output_dir, args.entity_predictions_test), use_gold=args.eval_with_gold, context_window=args.context_window, type_pairs=type_pairs)
 
     setseed(args.seed)
 
@@ -330,15 +391,8 @@ def main(args):
         logger.info("***** Dev *****")
         logger.info("  Num examples = %d", len(eval_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        all_sub_idx = torch.tensor([f.sub_idx for f in eval_features], dtype=torch.long)
-        all_obj_idx = torch.tensor([f.obj_idx for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_sub_idx, all_obj_idx)
-        eval_dataloader = DataLoader(eval_data, batch_size=args.eval_batch_size)
-        eval_label_ids = all_label_ids
+        eval_dataloader = get_dataloader(eval_features, args.eval_batch_size, sort_by_length=args.eval_sorted)
+        eval_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
     with open(os.path.join(args.output_dir, 'special_tokens.json'), 'w') as f:
         json.dump(special_tokens, f)
 
@@ -346,17 +400,10 @@ def main(args):
         train_features = convert_examples_to_features(
             train_examples, label2id, args.max_seq_length, tokenizer, special_tokens, unused_tokens=not(args.add_new_tokens))
         if args.train_mode == 'sorted' or args.train_mode == 'random_sorted':
-            train_features = sorted(train_features, key=lambda f: np.sum(f.input_mask))
+            train_features = sorted(train_features, key=lambda f: len(f.input_ids))
         else:
             random.shuffle(train_features)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        all_sub_idx = torch.tensor([f.sub_idx for f in train_features], dtype=torch.long)
-        all_obj_idx = torch.tensor([f.obj_idx for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_sub_idx, all_obj_idx)
-        train_dataloader = DataLoader(train_data, batch_size=args.train_batch_size)
+        train_dataloader = get_dataloader(train_features, args.train_batch_size)
         train_batches = [batch for batch in train_dataloader]
 
         num_train_optimization_steps = len(train_dataloader) * args.num_train_epochs
@@ -454,15 +501,8 @@ def main(args):
             logger.info("***** Test *****")
             logger.info("  Num examples = %d", len(test_examples))
             logger.info("  Batch size = %d", args.eval_batch_size)
-            all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-            all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-            all_sub_idx = torch.tensor([f.sub_idx for f in eval_features], dtype=torch.long)
-            all_obj_idx = torch.tensor([f.obj_idx for f in eval_features], dtype=torch.long)
-            eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_sub_idx, all_obj_idx)
-            eval_dataloader = DataLoader(eval_data, batch_size=args.eval_batch_size)
-            eval_label_ids = all_label_ids
+            eval_dataloader = get_dataloader(eval_features, args.eval_batch_size, sort_by_length=args.eval_sorted)
+            eval_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
         model = RelationModel.from_pretrained(args.output_dir, num_rel_labels=num_labels)
         model.to(device)
         preds, result, logits = evaluate(model, device, eval_dataloader, eval_label_ids, num_labels, e2e_ngold=eval_nrel)
@@ -482,8 +522,8 @@ if __name__ == "__main__":
                         help="How many times it evaluates on dev set per epoch")
     parser.add_argument("--max_seq_length", default=128, type=int,
                         help="The maximum total input sequence length after WordPiece tokenization. \n"
-                             "Sequences longer than this will be truncated, and sequences shorter \n"
-                             "than this will be padded.")
+                             "Sequences longer than this will be truncated, and batches are padded \n"
+                             "to their longest sequence.")
     parser.add_argument("--negative_label", default="no_relation", type=str)
     parser.add_argument("--do_train", action='store_true', help="Whether to run training.")
     parser.add_argument("--train_file", default=None, type=str, help="The path of the training data.")
@@ -491,6 +531,8 @@ if __name__ == "__main__":
     parser.add_argument("--do_eval", action='store_true', help="Whether to run eval on the dev set.")
     parser.add_argument("--do_lower_case", action='store_true', help="Set this flag if you are using an uncased model.")
     parser.add_argument("--eval_test", action="store_true", help="Whether to evaluate on final test set.")
+    parser.add_argument("--prune_type_pairs", action="store_true", help="Whether to drop the pairs whose entity types never take a relation in the training data.")
+    parser.add_argument("--eval_sorted", action="store_true", help="Whether to batch the evaluation examples by length, to reduce padding.")
     parser.add_argument("--eval_with_gold", action="store_true", help="Whether to evaluate the relation model with gold entities provided.")
     parser.add_argument("--train_batch_size", default=32, type=int,
                         help="Total batch size for training.")
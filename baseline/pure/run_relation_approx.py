@@ -9,7 +9,6 @@ import random
 import time
 import json
 import sys
-import gc
 
 import numpy as np
 import torch
@@ -54,29 +53,45 @@ class InputFeatures(object):
         sub_obj_masks += label_padding
         sub_obj_ids += ids_padding
 
-        # Compute the attention mask matrix
-        attention_mask = []
-        for _, from_mask in enumerate(input_mask):
-            attention_mask_i = []
-            for to_mask in input_mask:
-                if to_mask <= 1:
-                    attention_mask_i.append(to_mask)
-                elif from_mask == to_mask and from_mask > 0:
-                    attention_mask_i.append(1)
-                else:
-                    attention_mask_i.append(0)
-            attention_mask.append(attention_mask_i)
-
+        # The attention mask matrix is built per batch from the marker groups (see build_attention_mask)
         self.input_ids = input_ids
         self.position_ids = position_ids
-        self.original_input_mask = input_mask
-        self.input_mask = attention_mask
-        self.segment_ids = [0] * len(input_ids)
+        self.input_mask = input_mask
         self.labels = labels
         self.sub_obj_ids = sub_obj_ids
         self.sub_obj_masks = sub_obj_masks
         self.meta = meta
 
+def build_attention_mask(input_mask):
+    """
+    Attention mask matrix [batch_size, from_seq_length, to_seq_length] of a batch, from its input_mask
+    input_mask: 0 for padding, 1 for the text (attended by all tokens) and a group id > 1 for the markers of each pair (attended by their group only)
+    """
+    from_mask = input_mask.unsqueeze(2)
+    to_mask = input_mask.unsqueeze(1)
+    return torch.where(to_mask <= 1, to_mask, (from_mask == to_mask).long())
+
+def attention_mask_size(input_mask):
+    """
+    Number of ones in the attention mask matrix of a feature, from its input_mask
+    """
+    input_mask = np.asarray(input_mask)
+    return len(input_mask) * np.sum(input_mask == 1) + np.sum(np.bincount(input_mask[input_mask > 1]) ** 2)
+
+def get_dataloader(features, batch_size):
+    """
+    Batch the features in order
+    """
+    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
+    all_position_ids = torch.tensor([f.position_ids for f in features], dtype=torch.long)
+    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
+    all_segment_ids = torch.zeros_like(all_input_ids)
+    all_labels = torch.tensor([f.labels for f in features], dtype=torch.long)
+    all_sub_obj_ids = torch.tensor([f.sub_obj_ids for f in features], dtype=torch.long)
+    all_sub_obj_masks = torch.tensor([f.sub_obj_masks for f in features], dtype=torch.long)
+    data = TensorDataset(all_input_ids, all_position_ids, all_input_mask, all_segment_ids, all_labels, all_sub_obj_ids, all_sub_obj_masks)
+    return DataLoader(data, batch_size=batch_size)
+
 def add_marker_tokens(tokenizer, ner_labels):
     new_tokens = ['<SUBJ_START>', '<SUBJ_END>', '<OBJ_START>', '<OBJ_END>']
     for label in ner_labels:
@@ -229,13 +244,11 @@ def get_features_from_file(filename, label2id, max_seq_length, tokenizer, specia
                 logger.info("tokens: %s" % " ".join([str(x) for x in tokens]))
                 logger.info("input_ids: %s" % " ".join([str(x) for x in features[-1].input_ids]))
                 logger.info("position_ids: %s" % " ".join([str(x) for x in features[-1].position_ids]))
-                logger.info("input_mask: %s" % " ".join([str(x) for x in features[-1].original_input_mask]))
+                logger.info("input_mask: %s" % " ".join([str(x) for x in features[-1].input_mask]))
                 logger.info("labels: %s" % " ".join([str(x) for x in features[-1].labels]))
                 logger.info("sub_obj_ids: %s" % " ".join(['(%d, %d)'%(x[0], x[1]) for x in features[-1].sub_obj_ids]))
                 logger.info("sub_obj_masks: %s" % " ".join([str(x) for x in features[-1].sub_obj_masks]))
                 logger.info("sub_obj_spans: %s" % " ".join([str(x) for x in features[-1].meta['sub_obj_pairs']]))
-                
-            gc.collect()
  
     max_num_tokens = 0
     max_num_pairs = 0
@@ -299,7 +312,7 @@ def evaluate(model, device, eval_dataloader, e2e_ngold=None, verbose=True):
         batch_masks = sub_obj_masks
         input_ids = input_ids.to(device)
         input_position = input_position.to(device)
-        input_mask = input_mask.to(device)
+        input_mask = build_attention_mask(input_mask.to(device))
         segment_ids = segment_ids.to(device)
         labels = labels.to(device)
         sub_obj_ids = sub_obj_ids.to(device)
@@ -438,17 +451,7 @@ def main(args):
         logger.info("***** Dev *****")
         logger.info("  Num examples = %d", len(eval_features))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_position_ids = torch.tensor([f.position_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_labels = torch.tensor([f.labels for f in eval_features], dtype=torch.long)
-        all_sub_obj_ids = torch.tensor([f.sub_obj_ids for f in eval_features], dtype=torch.long)
-        all_sub_obj_masks = torch.tensor([f.sub_obj_masks for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_position_ids, all_input_mask, all_segment_ids, all_labels, all_sub_obj_ids, all_sub_obj_masks)
-        eval_dataloader = DataLoader(eval_data, batch_size=args.eval_batch_size)
-
-        gc.collect()
+        eval_dataloader = get_dataloader(eval_features, args.eval_batch_size)
     with open(os.path.join(args.output_dir, 'special_tokens.json'), 'w') as f:
         json.dump(special_tokens, f)
 
@@ -456,22 +459,12 @@ def main(args):
         train_dataset, train_features, train_nrel = get_features_from_file(
             args.train_file, label2id, args.max_seq_length, tokenizer, special_tokens, use_gold=True, context_window=args.context_window, batch_computation=args.batch_computation, unused_tokens=not(args.add_new_tokens))
         if args.train_mode == 'sorted' or args.train_mode == 'random_sorted':
-            train_features = sorted(train_features, key=lambda f: np.sum(f.input_mask))
+            train_features = sorted(train_features, key=lambda f: attention_mask_size(f.input_mask))
         else:
             random.shuffle(train_features)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_position_ids = torch.tensor([f.position_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_labels = torch.tensor([f.labels for f in train_features], dtype=torch.long)
-        all_sub_obj_ids = torch.tensor([f.sub_obj_ids for f in train_features], dtype=torch.long)
-        all_sub_obj_masks = torch.tensor([f.sub_obj_masks for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_position_ids, all_input_mask, all_segment_ids, all_labels, all_sub_obj_ids, all_sub_obj_masks)
-        train_dataloader = DataLoader(train_data, batch_size=args.train_batch_size)
+        train_dataloader = get_dataloader(train_features, args.train_batch_size)
         train_batches = [batch for batch in train_dataloader]
-        
-        gc.collect()
-        
+
         num_train_optimization_steps = len(train_dataloader) * args.num_train_epochs
 
         logger.info("***** Training *****")
@@ -521,6 +514,7 @@ def main(args):
                 print(0)
                 batch = tuple(t.to(device) for t in batch)
                 input_ids, input_position, input_mask, segment_ids, labels, sub_obj_ids, sub_obj_masks = batch
+                input_mask = build_attention_mask(input_mask)
                 print(1)
                 loss = model(input_ids, segment_ids, input_mask, labels=labels, sub_obj_ids=sub_obj_ids, sub_obj_masks=sub_obj_masks, input_position=input_position)
                 print(2)
@@ -565,15 +559,7 @@ def main(args):
             logger.info("***** Test *****")
             logger.info("  Num examples = %d", len(eval_features))
             logger.info("  Batch size = %d", args.eval_batch_size)
-            all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-            all_position_ids = torch.tensor([f.position_ids for f in eval_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-            all_labels = torch.tensor([f.labels for f in eval_features], dtype=torch.long)
-            all_sub_obj_ids = torch.tensor([f.sub_obj_ids for f in eval_features], dtype=torch.long)
-            all_sub_obj_masks = torch.tensor([f.sub_obj_masks for f in eval_features], dtype=torch.long)
-            eval_data = TensorDataset(all_input_ids, all_position_ids, all_input_mask, all_segment_ids, all_labels, all_sub_obj_ids, all_sub_obj_masks)
-            eval_dataloader = DataLoader(eval_data, batch_size=args.eval_batch_size)
+            eval_dataloader = get_dataloader(eval_features, args.eval_batch_size)
         model = RelationModel.from_pretrained(args.output_dir, num_rel_labels=num_labels)
         model.to(device)
         preds, result = evaluate(model, device, eval_dataloader, e2e_ngold=eval_nrel)
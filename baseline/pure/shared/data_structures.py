@@ -1,8 +1,9 @@
 """
 This code is based on DYGIE++'s codebase
 """
+import glob
 import json
-import copy
+import multiprocessing
 import os
 from collections import Counter
 import numpy as np
@@ -22,52 +23,105 @@ def get_sentence_of_span(span, sentence_starts, doc_tokens):
     """
     Return the index of the sentence that the span is part of.
     """
-    # Inclusive sentence ends
-    sentence_ends = [x - 1 for x in sentence_starts[1:]] + [doc_tokens - 1]
-    in_between = [span[0] >= start and span[1] <= end
-                  for start, end in zip(sentence_starts, sentence_ends)]
-    assert sum(in_between) == 1
-    the_sentence = in_between.index(True)
+    # The last sentence starting at or before the span (empty sentences are skipped)
+    the_sentence = int(np.searchsorted(sentence_starts, span[0], side='right')) - 1
+    # Inclusive sentence end
+    sentence_end = sentence_starts[the_sentence + 1] - 1 if the_sentence + 1 < len(sentence_starts) else doc_tokens - 1
+    assert the_sentence >= 0 and span[0] >= sentence_starts[the_sentence] and span[1] <= sentence_end
     return the_sentence
 
 
+def jsonl_files(json_file):
+    """
+    Files of a jsonl file: the file itself or, if it does not exist, its shards written by prepare_dataset.py
+    (e.g., train-00000.json, train-00001.json, ... for train.json)
+    """
+    if os.path.exists(json_file):
+        return [json_file]
+    root, ext = os.path.splitext(json_file)
+    shards = sorted(glob.glob(glob.escape(root) + '-[0-9][0-9][0-9][0-9][0-9]' + glob.escape(ext)))
+    # a missing file is reported when it is opened
+    return shards if len(shards) > 0 else [json_file]
+
+def _read_lines(json_file):
+    for path in jsonl_files(json_file):
+        with open(path) as f:
+            yield from f
+
+def read_jsonl(json_file, pred_file=None):
+    """
+    Iterate over the documents (json) of a jsonl file (or of its shards, see jsonl_files), one line at a time
+    With pred_file, the keys of its documents containing "predicted" are set on (shallow copies of) the documents of json_file
+    """
+    if pred_file is None:
+        for line in _read_lines(json_file):
+            yield json.loads(line)
+        return
+
+    for gold_line, pred_line in zip(_read_lines(json_file), _read_lines(pred_file)):
+        gold = json.loads(gold_line)
+        pred = json.loads(pred_line)
+        assert gold["doc_key"] == pred["doc_key"]
+        assert gold["sentences"] == pred["sentences"]
+        # gold is only referenced by merged: no need for a deep copy
+        merged = dict(gold)
+        for k, v in pred.items():
+            if "predicted" in k:
+                merged[k] = v
+        yield merged
+
+def iter_documents(json_file, pred_file=None):
+    """
+    Iterate over the documents of a jsonl file (see read_jsonl), without keeping them in memory
+    """
+    for js in read_jsonl(json_file, pred_file):
+        yield Document(js)
+
+
 class Dataset:
+    """
+    Documents of a jsonl file, built from their json on first access
+    """
     def __init__(self, json_file, pred_file=None, doc_range=None):
         self.js = self._read(json_file, pred_file)
         if doc_range is not None:
             self.js = self.js[doc_range[0]:doc_range[1]]
-        self.documents = [Document(js) for js in self.js]
+        self._documents = [None] * len(self.js)
 
     def update_from_js(self, js):
         self.js = js
-        self.documents = [Document(js) for js in self.js]
+        self._documents = [None] * len(self.js)
+
+    @property
+    def documents(self):
+        return [self[ix] for ix in range(len(self))]
+
+    @documents.setter
+    def documents(self, documents):
+        self._documents = list(documents)
 
     def _read(self, json_file, pred_file=None):
-        gold_docs = [json.loads(line) for line in open(json_file)]
-        if pred_file is None:
-            return gold_docs
-
-        pred_docs = [json.loads(line) for line in open(pred_file)]
-        merged_docs = []
-        for gold, pred in zip(gold_docs, pred_docs):
-            assert gold["doc_key"] == pred["doc_key"]
-            assert gold["sentences"] == pred["sentences"]
-            merged = copy.deepcopy(gold)
-            for k, v in pred.items():
-                if "predicted" in k:
-                    merged[k] = v
-            merged_docs.append(merged)
-
-        return merged_docs
+        return list(read_jsonl(json_file, pred_file))
 
     def __getitem__(self, ix):
-        return self.documents[ix]
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(len(self)))]
+        document = self._documents[ix]
+        if document is None:
+            document = self._documents[ix] = Document(self.js[ix])
+        return document
+
+    def __iter__(self):
+        for ix in range(len(self)):
+            yield self[ix]
 
     def __len__(self):
-        return len(self.documents)
+        return len(self._documents)
 
 
 class Document:
+    __slots__ = ['_doc_key', 'sentence_starts', 'sentences', 'clusters', 'predicted_clusters', '_n_tokens', '_ner_by_span']
+
     def __init__(self, js):
         self._doc_key = js["doc_key"]
         entries = fields_to_batches(js, ["doc_key", "clusters", "predicted_clusters", "section_starts"])
@@ -79,6 +133,8 @@ class Document:
         self.sentences = [Sentence(entry, sentence_start, sentence_ix)
                           for sentence_ix, (entry, sentence_start)
                           in enumerate(zip(entries, sentence_starts))]
+        self._n_tokens = sum(sentence_lengths)
+        self._ner_by_span = {}
         if "clusters" in js:
             self.clusters = [Cluster(entry, i, self)
                              for i, entry in enumerate(js["clusters"])]
@@ -115,10 +171,24 @@ class Document:
 
     @property
     def n_tokens(self):
-        return sum([len(sent) for sent in self.sentences])
+        return self._n_tokens
+
+    def ners_of_span(self, sentence_ix, span):
+        """
+        Gold NERs of a sentence with the given span (indexed on first call)
+        """
+        if sentence_ix not in self._ner_by_span:
+            ner_by_span = {}
+            for ner in self.sentences[sentence_ix].ner:
+                ner_by_span.setdefault(ner.span, []).append(ner)
+            self._ner_by_span[sentence_ix] = ner_by_span
+        return self._ner_by_span[sentence_ix].get(span, [])
 
 
 class Sentence:
+    __slots__ = ['sentence_start', 'text', 'sentence_ix', 'ner', 'relations', 'events',
+                 'predicted_ner', 'predicted_relations', 'predicted_events', 'top_spans']
+
     def __init__(self, entry, sentence_start, sentence_ix):
         self.sentence_start = sentence_start
         self.text = entry["sentences"]
@@ -177,29 +247,46 @@ class Sentence:
 
 
 class Span:
+    """
+    Span of a sentence; its text is sliced from the sentence tokens on access, and its hash is computed from its offsets
+    """
+    __slots__ = ['start_doc', 'end_doc', 'start_sent', 'end_sent', '_sentence_text', '_hash']
+
     def __init__(self, start, end, text, sentence_start):
-        self.start_doc = start
-        self.end_doc = end
-        self.span_doc = (self.start_doc, self.end_doc)
-        self.start_sent = start - sentence_start
-        self.end_sent = end - sentence_start
-        self.span_sent = (self.start_sent, self.end_sent)
-        self.text = text[self.start_sent:self.end_sent + 1]
+        self.start_doc = int(start)
+        self.end_doc = int(end)
+        self.start_sent = int(start - sentence_start)
+        self.end_sent = int(end - sentence_start)
+        self._sentence_text = text
+        self._hash = hash((self.start_doc, self.end_doc, self.start_sent, self.end_sent))
+
+    @property
+    def span_doc(self):
+        return (self.start_doc, self.end_doc)
+
+    @property
+    def span_sent(self):
+        return (self.start_sent, self.end_sent)
+
+    @property
+    def text(self):
+        return self._sentence_text[self.start_sent:self.end_sent + 1]
 
     def __repr__(self):
         return str((self.start_sent, self.end_sent, self.text))
 
     def __eq__(self, other):
-        return (self.span_doc == other.span_doc and
-                self.span_sent == other.span_sent and
+        return (self.start_doc == other.start_doc and self.end_doc == other.end_doc and
+                self.start_sent == other.start_sent and self.end_sent == other.end_sent and
                 self.text == other.text)
 
     def __hash__(self):
-        tup = self.span_doc + self.span_sent + (" ".join(self.text),)
-        return hash(tup)
+        return self._hash
 
 
 class Token:
+    __slots__ = ['ix_doc', 'ix_sent', 'text']
+
     def __init__(self, ix, text, sentence_start):
         self.ix_doc = ix
         self.ix_sent = ix - sentence_start
@@ -210,6 +297,8 @@ class Token:
 
 
 class Trigger:
+    __slots__ = ['token', 'label']
+
     def __init__(self, token, label):
         self.token = token
         self.label = label
@@ -219,6 +308,8 @@ class Trigger:
 
 
 class Argument:
+    __slots__ = ['span', 'role', 'event_type']
+
     def __init__(self, span, role, event_type):
         self.span = span
         self.role = role
@@ -237,6 +328,8 @@ class Argument:
 
 
 class NER:
+    __slots__ = ['span', 'label', 'flavor']
+
     def __init__(self, ner, text, sentence_start, flavor=None):
         self.span = Span(ner[0], ner[1], text, sentence_start)
         self.label = ner[2]
@@ -252,6 +345,8 @@ class NER:
 
 
 class Relation:
+    __slots__ = ['pair', 'label']
+
     def __init__(self, relation, text, sentence_start):
         start1, end1 = relation[0], relation[1]
         start2, end2 = relation[2], relation[3]
@@ -350,7 +445,7 @@ class Cluster:
             sentence_ix = get_sentence_of_span(entry, document.sentence_starts, document.n_tokens)
             sentence = document[sentence_ix]
             span = Span(entry[0], entry[1], sentence.text, sentence.sentence_start)
-            ners = [x for x in sentence.ner if x.span == span]
+            ners = document.ners_of_span(sentence_ix, span)
             assert len(ners) <= 1
             ner = ners[0] if len(ners) == 1 else None
             to_append = ClusterMember(span, ner, sentence, cluster_id)
@@ -367,6 +462,8 @@ class Cluster:
 
 
 class ClusterMember:
+    __slots__ = ['span', 'ner', 'sentence', 'cluster_id']
+
     def __init__(self, span, ner, sentence, cluster_id):
         self.span = span
         self.ner = ner
@@ -398,19 +495,21 @@ def compute_f1(predicted, gold, matched):
 
 def evaluate_sent(sent, counts):
     correct_ner = set()
-    # Entities.
+    # Entities (NER.__eq__ compares the span, label and flavor).
+    gold_ner = set((actual.span, actual.label, actual.flavor) for actual in sent.ner)
     counts["ner_gold"] += len(sent.ner)
     counts["ner_predicted"] += len(sent.predicted_ner)
     for prediction in sent.predicted_ner:
-        if any([prediction == actual for actual in sent.ner]):
+        if (prediction.span, prediction.label, prediction.flavor) in gold_ner:
             counts["ner_matched"] += 1
             correct_ner.add(prediction.span)
 
-    # Relations.
+    # Relations (Relation.__eq__ compares the pair and label).
+    gold_relations = set((actual.pair, actual.label) for actual in sent.relations)
     counts["relations_gold"] += len(sent.relations)
     counts["relations_predicted"] += len(sent.predicted_relations)
     for prediction in sent.predicted_relations:
-        if any([prediction == actual for actual in sent.relations]):
+        if (prediction.pair, prediction.label) in gold_relations:
             counts["relations_matched"] += 1
             if (prediction.pair[0] in correct_ner) and (prediction.pair[1] in correct_ner):
                 counts["strict_relations_matched"] += 1
@@ -418,12 +517,29 @@ def evaluate_sent(sent, counts):
     # Return the updated counts.
     return counts
 
-def evaluate_predictions(dataset):
+def evaluate_document(js):
+    """
+    Counts of a document, from its json (picklable, for a process pool)
+    """
+    counts = Counter()
+    for sent in Document(js):
+        counts = evaluate_sent(sent, counts)
+    return counts
+
+def evaluate_predictions(dataset, jobs=1):
+    """
+    Evaluate the predictions of a dataset; with several jobs, documents are evaluated in a process pool
+    """
     counts = Counter()
 
-    for doc in dataset:
-        for sent in doc:
-            counts = evaluate_sent(sent, counts)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            for doc_counts in pool.imap(evaluate_document, dataset.js, chunksize=16):
+                counts.update(doc_counts)
+    else:
+        for doc in dataset:
+            for sent in doc:
+                counts = evaluate_sent(sent, counts)
 
     scores_ner = compute_f1(
         counts["ner_predicted"], counts["ner_gold"], counts["ner_matched"])
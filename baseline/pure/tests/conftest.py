@@ -0,0 +1,32 @@
+import os
+import sys
+
+# The scripts of PURE import its packages (entity, relation, shared) from the root of the baseline
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import pytest
+
+N_DOCS = 40
+
+def make_document(i):
+    # 3 sentences, with document offsets
+    return {
+        'doc_key': 'key-dev-%d'%i,
+        'sentences': [['a', 'b', 'c', 'd'], ['e', 'f', 'g'], ['h', 'i', 'j', 'k']],
+        'ner': [[[0, 0, 'PER'], [2, 3, 'PER'], [1, 1, 'ORG']], [[4, 6, 'LOC']], [[7, 7, 'PER'], [9, 9, 'ORG']]],
+        'relations': [[[0, 0, 2, 3, 'COREF'], [0, 0, 1, 1, 'P1']], [], []],
+    }
+
+@pytest.fixture
+def pure_file(tmp_path):
+    """
+    PURE file of N_DOCS documents with predictions: the gold entities of even documents, the first entity of each sentence otherwise
+    """
+    with open(tmp_path / 'dev.json', 'w') as f:
+        for i in range(N_DOCS):
+            doc = make_document(i)
+            doc['predicted_ner'] = [ner if i % 2 == 0 else ner[:1] for ner in doc['ner']]
+            doc['predicted_relations'] = [[] for _ in doc['relations']]
+            f.write(json.dumps(doc) + '\n')
+    return str(tmp_path / 'dev.json')
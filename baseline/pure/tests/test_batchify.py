@@ -0,0 +1,103 @@
+"""
+Invariants of the batching of the entity samples
+"""
+import random
+import numpy as np
+import pytest
+
+from entity.utils import batchify, _padding_waste
+
+N_SAMPLES = 500
+
+def make_samples(n_samples=N_SAMPLES, seed=0):
+    rng = random.Random(seed)
+    samples = []
+    for i in range(n_samples):
+        # short and long sentences, and a few longer than 350 words (single batches)
+        r = rng.random()
+        n_words = rng.randint(351, 400) if r < 0.03 else rng.randint(5, 60) if r < 0.5 else rng.randint(100, 300)
+        samples.append({
+            'doc_key': 'doc-%d'%(i // 10),
+            'sentence_ix': i % 10,
+            'tokens': ['w'] * n_words,
+            'input_ids': np.zeros(n_words + rng.randint(2, 40), dtype=np.int64),
+            'spans': np.zeros((n_words * 3, 3), dtype=np.int32),
+            'id': i,
+        })
+    return samples
+
+def ids(batches):
+    return [[sample['id'] for sample in batch] for batch in batches]
+
+def is_single(sample):
+    return len(sample['tokens']) > 350
+
+def padded_tokens(batch, pad_to_multiple):
+    longest = max(len(sample['input_ids']) for sample in batch)
+    return len(batch) * (-(-longest // pad_to_multiple) * pad_to_multiple)
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'max_tokens': 2000},
+    {'bucket_size': 4},
+    {'bucket_size': 4, 'shuffle': True},
+    {'bucket_size': 4, 'max_tokens': 2000},
+    {'bucket_size': 2, 'max_tokens': 8192, 'pad_to_multiple': 512},
+    {'shuffle': True, 'max_tokens': 3000},
+])
+def test_invariants(kwargs):
+    samples = make_samples()
+    random.seed(0)
+    batches = batchify(samples, 16, **kwargs)
+    # every sample is in exactly one batch
+    assert sorted(i for batch in ids(batches) for i in batch) == list(range(N_SAMPLES))
+    for batch in batches:
+        assert 0 < len(batch) <= 16
+        # long samples are alone in their batch
+        assert len(batch) == 1 or not any(is_single(sample) for sample in batch)
+        if 'max_tokens' in kwargs and len(batch) > 1:
+            assert padded_tokens(batch, kwargs.get('pad_to_multiple', 1)) <= kwargs['max_tokens']
+
+def test_file_order():
+    # without bucketing, batches are consecutive samples (long samples first, in their own batch)
+    samples = make_samples()
+    batches = ids(batchify(samples, 16))
+    singles = [sample['id'] for sample in samples if is_single(sample)]
+    others = [sample['id'] for sample in samples if not is_single(sample)]
+    assert batches == [[i] for i in singles] + [others[k:k+16] for k in range(0, len(others), 16)]
+
+def test_buckets_follow_file_order():
+    # with bucketing, samples are only reordered within windows of bucket_size batches
+    samples = make_samples()
+    bucket_size = 3
+    batches = [batch for batch in ids(batchify(samples, 16, bucket_size=bucket_size)) if not is_single(samples[batch[0]])]
+    others = [sample['id'] for sample in samples if not is_single(sample)]
+    window = {i: k // (16 * bucket_size) for k, i in enumerate(others)}
+    assert all(len({window[i] for i in batch}) == 1 for batch in batches)
+    batch_windows = [window[batch[0]] for batch in batches]
+    assert batch_windows == sorted(batch_windows)
+    # and sorted by length within a window
+    first_window = [samples[i] for batch in batches for i in batch if window[i] == 0]
+    lengths = [len(sample['input_ids']) for sample in first_window]
+    assert lengths == sorted(lengths)
+
+def test_buckets_reduce_padding():
+    samples = make_samples()
+    lengths = np.array([len(sample['input_ids']) for sample in samples])
+    file_order = [[sample['id'] for sample in batch] for batch in batchify(samples, 16)]
+    bucketed = [[sample['id'] for sample in batch] for batch in batchify(samples, 16, bucket_size=100)]
+    assert _padding_waste(lengths, bucketed) < _padding_waste(lengths, file_order)
+
+def test_padding_waste():
+    lengths = np.array([2, 4, 3])
+    assert _padding_waste(lengths, [[0, 1], [2]]) == pytest.approx(1 - 9 / 11)
+    assert _padding_waste(lengths, [[0, 1], [2]], pad_to_multiple=4) == pytest.approx(1 - 9 / 12)
+    assert _padding_waste(lengths, []) == 0.0
+
+def test_shuffle_is_seeded():
+    samples = make_samples()
+    random.seed(1)
+    a = ids(batchify(samples, 16, bucket_size=4, shuffle=True))
+    random.seed(1)
+    b = ids(batchify(samples, 16, bucket_size=4, shuffle=True))
+    assert a == b
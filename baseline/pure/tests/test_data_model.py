@@ -0,0 +1,36 @@
+"""
+Lazy building of PURE documents
+"""
+import pytest
+
+pytest.importorskip('torch')
+
+from conftest import N_DOCS
+from shared.data_structures import Dataset, get_sentence_of_span
+from entity.utils import get_train_fold, get_test_fold
+
+def test_sentence_of_span():
+    # the second sentence is empty
+    sentence_starts = [0, 4, 4, 7]
+    assert get_sentence_of_span((0, 3), sentence_starts, 10) == 0
+    assert get_sentence_of_span((4, 6), sentence_starts, 10) == 2
+    assert get_sentence_of_span((7, 9), sentence_starts, 10) == 3
+    with pytest.raises(AssertionError):
+        get_sentence_of_span((3, 4), sentence_starts, 10)
+
+def test_lazy_dataset(pure_file):
+    data = Dataset(pure_file)
+    assert len(data) == N_DOCS
+    assert data._documents.count(None) == N_DOCS
+    doc = data[5]
+    assert doc._doc_key == 'key-dev-5' and data[5] is doc
+    assert data._documents.count(None) == N_DOCS - 1
+    assert [d._doc_key for d in data[3:6]] == ['key-dev-3', 'key-dev-4', 'key-dev-5']
+
+def test_folds(pure_file):
+    train = get_train_fold(Dataset(pure_file), 2)
+    test = get_test_fold(Dataset(pure_file), 2)
+    assert train._documents.count(None) == len(train)
+    keys = sorted(doc._doc_key for doc in train) + sorted(doc._doc_key for doc in test)
+    assert sorted(keys) == sorted('key-dev-%d'%i for i in range(N_DOCS))
+    assert [doc._doc_key for doc in test] == ['key-dev-%d'%i for i in range(8, 12)]
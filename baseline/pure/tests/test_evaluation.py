@@ -0,0 +1,16 @@
+"""
+Evaluation of PURE predictions
+"""
+import pytest
+
+pytest.importorskip('torch')
+
+from shared.data_structures import Dataset, evaluate_predictions
+
+def test_evaluate_predictions(pure_file):
+    data = Dataset(pure_file)
+    scores = evaluate_predictions(data)
+    assert scores == evaluate_predictions(data, jobs=2)
+    # 6 entities per document, all predicted in even documents, one per sentence (3) in odd ones
+    assert scores['ner']['precision'] == 1.0
+    assert scores['ner']['recall'] == pytest.approx((6 + 3) / 12)
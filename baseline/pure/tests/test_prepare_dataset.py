@@ -0,0 +1,77 @@
+"""
+Conversion of Linked-DocRED documents to the PURE format
+"""
+import json
+import pytest
+
+from prepare_dataset import convert_instance, process_dataset
+
+def make_instance():
+    # 3 sentences; entity 0 is mentioned in sentences 2, 0 and 0 (in this annotation order)
+    return {
+        'title': 'doc',
+        'sents': [['a', 'b', 'c', 'd'], ['e', 'f', 'g'], ['h', 'i', 'j', 'k']],
+        'entities': [
+            {'type': 'PER', 'mentions': [{'sent_id': 2, 'pos': [0, 1]}, {'sent_id': 0, 'pos': [0, 1]},
+                                         {'sent_id': 0, 'pos': [2, 4]}]},
+            {'type': 'ORG', 'mentions': [{'sent_id': 2, 'pos': [2, 3]}, {'sent_id': 0, 'pos': [1, 2]}]},
+            {'type': 'LOC', 'mentions': [{'sent_id': 1, 'pos': [0, 3]}]},
+        ],
+        'relations': [{'h': 0, 't': 1, 'r': 'P1'}, {'h': 0, 't': 2, 'r': 'P2'}],
+    }
+
+def test_document_layout():
+    out, n_dropped = convert_instance(make_instance(), 3, 'dev')
+    assert n_dropped == 0
+    assert out['doc_key'] == 'key-dev-3'
+    assert out['sentences'] == [list('abcdefghijk')]
+    assert out['ner'] == [[[7, 7, 'PER'], [0, 0, 'PER'], [2, 3, 'PER'], [9, 9, 'ORG'], [1, 1, 'ORG'], [4, 6, 'LOC']]]
+    assert out['relations'] == [[
+        [7, 7, 0, 0, 'COREF'], [7, 7, 2, 3, 'COREF'], [0, 0, 2, 3, 'COREF'], [9, 9, 1, 1, 'COREF'],
+        # relations link the first mentions of the entities
+        [7, 7, 9, 9, 'P1'], [7, 7, 4, 6, 'P2'],
+    ]]
+
+def test_coref_chain():
+    instance = make_instance()
+    instance['entities'][0]['mentions'] += [{'sent_id': 1, 'pos': [k, k + 1]} for k in range(3)]
+    n_mentions = len(instance['entities'][0]['mentions'])
+    pairs, _ = convert_instance(instance, 0, 'dev', coref='pairs')
+    chain, _ = convert_instance(instance, 0, 'dev', coref='chain')
+    count = lambda out: sum(r[4] == 'COREF' for rels in out['relations'] for r in rels)
+    assert count(pairs) == n_mentions * (n_mentions - 1) // 2 + 1
+    assert count(chain) == n_mentions - 1 + 1
+    assert chain['relations'][0][:2] == [[7, 7, 0, 0, 'COREF'], [0, 0, 2, 3, 'COREF']]
+
+def test_sentence_layout():
+    out, n_dropped = convert_instance(make_instance(), 0, 'dev', layout='sentence')
+    assert out['sentences'] == make_instance()['sents']
+    # offsets stay document offsets
+    assert out['ner'] == [[[0, 0, 'PER'], [2, 3, 'PER'], [1, 1, 'ORG']], [[4, 6, 'LOC']], [[7, 7, 'PER'], [9, 9, 'ORG']]]
+    # the relation is placed in the first sentence mentioning both entities, the other one is dropped
+    assert out['relations'] == [[[0, 0, 2, 3, 'COREF'], [0, 0, 1, 1, 'P1']], [], []]
+    assert n_dropped == 1
+
+@pytest.mark.parametrize('layout', ['document', 'sentence'])
+def test_process_dataset(tmp_path, layout):
+    instances = []
+    for i in range(50):
+        instance = make_instance()
+        instance['title'] = 'doc%d'%i
+        instance['sents'][1].append('x%d'%i)
+        instances.append(instance)
+    input_file = tmp_path / 'dev.json'
+    input_file.write_text(json.dumps(instances))
+
+    expected = [json.dumps(convert_instance(instance, i, 'dev', layout=layout)[0]) for i, instance in enumerate(instances)]
+    process_dataset(str(input_file), str(tmp_path / 'serial.json'), 'dev', layout=layout)
+    assert (tmp_path / 'serial.json').read_text().splitlines() == expected
+
+    process_dataset(str(input_file), str(tmp_path / 'parallel.json'), 'dev', layout=layout, jobs=2)
+    assert (tmp_path / 'parallel.json').read_text() == (tmp_path / 'serial.json').read_text()
+
+    process_dataset(str(input_file), str(tmp_path / 'sharded.json'), 'dev', layout=layout, jobs=2, shard_size=20)
+    shards = [tmp_path / ('sharded-%05d.json'%k) for k in range(3)]
+    assert not (tmp_path / 'sharded.json').exists() and not (tmp_path / 'sharded-00003.json').exists()
+    assert [len(shard.read_text().splitlines()) for shard in shards] == [20, 20, 10]
+    assert ''.join(shard.read_text() for shard in shards) == (tmp_path / 'serial.json').read_text()
@@ -0,0 +1,42 @@
+"""
+Reading of PURE files (or of their shards), merged with their predictions
+"""
+import json
+import pytest
+
+pytest.importorskip('torch')
+
+from conftest import N_DOCS, make_document
+from shared.data_structures import read_jsonl
+
+@pytest.fixture
+def gold_file(tmp_path):
+    with open(tmp_path / 'gold.json', 'w') as f:
+        for i in range(N_DOCS):
+            f.write(json.dumps(make_document(i)) + '\n')
+    return str(tmp_path / 'gold.json')
+
+def test_read_predictions(gold_file, pure_file):
+    merged = list(read_jsonl(gold_file, pure_file))
+    predicted = list(read_jsonl(pure_file))
+    assert len(merged) == N_DOCS
+    # the keys containing "predicted" are taken from the predictions, the others from the gold file
+    assert merged == predicted
+    assert list(read_jsonl(gold_file)) == [make_document(i) for i in range(N_DOCS)]
+
+def test_read_mismatched_predictions(gold_file, tmp_path):
+    with open(tmp_path / 'pred.json', 'w') as f:
+        for i in range(N_DOCS):
+            f.write(json.dumps(make_document(i + 1)) + '\n')
+    with pytest.raises(AssertionError):
+        list(read_jsonl(gold_file, str(tmp_path / 'pred.json')))
+
+def test_read_shards(pure_file, tmp_path):
+    lines = open(pure_file).read().splitlines(True)
+    for k in range(0, N_DOCS, 15):
+        with open(tmp_path / ('shard-%05d.json'%(k // 15)), 'w') as f:
+            f.writelines(lines[k:k+15])
+    assert list(read_jsonl(str(tmp_path / 'shard.json'))) == list(read_jsonl(pure_file))
+    # predictions merged from a sharded file
+    merged = list(read_jsonl(pure_file, str(tmp_path / 'shard.json')))
+    assert [doc['predicted_ner'] for doc in merged] == [doc['predicted_ner'] for doc in read_jsonl(pure_file)]
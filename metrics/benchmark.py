@@ -0,0 +1,302 @@
+"""Benchmark of the metrics on synthetic Linked-DocRED data
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import random
+import resource
+import sys
+import tempfile
+import time
+import traceback
+from bootstrap import METRICS, get_accumulator
+from entity_f1 import TAGS as ENTITY_TAGS
+from relation_f1 import TAGS as RELATION_TAGS
+
+
+def generate_document(rng: random.Random, doc_id: int, n_entities: int, n_mentions: int, n_relations: int,
+                      n_sentences: int = 8, sentence_length: int = 30) -> dict:
+    """Generate a ground truth document
+    Args:
+        rng (random.Random): random generator
+        doc_id (int): index of the document
+        n_entities (int): number of entities
+        n_mentions (int): number of mentions per entity
+        n_relations (int): number of relations
+        n_sentences (int, optional): number of sentences. Defaults to 8.
+        sentence_length (int, optional): number of words per sentence. Defaults to 30.
+    Returns:
+        dict: Linked-DocRED document
+    """
+    sents = [[f'w{i}' for i in range(sentence_length)] for _ in range(n_sentences)]
+    entities = []
+    for entity_id in range(n_entities):
+        mentions = []
+        for _ in range(n_mentions):
+            sent_id = rng.randrange(n_sentences)
+            start = rng.randrange(sentence_length - 3)
+            mentions.append({'name': f'e{entity_id}', 'sent_id': sent_id, 'pos': [start, start + rng.randint(1, 3)]})
+        entities.append({
+            'type': rng.choice(ENTITY_TAGS),
+            'mentions': mentions,
+            'entity_linking': {'wikipedia_resource': f'R{doc_id}_{entity_id}', 'confidence': 'A'},
+        })
+    relations = []
+    if n_entities > 0:
+        relations = [{'h': rng.randrange(n_entities), 't': rng.randrange(n_entities), 'r': rng.choice(RELATION_TAGS),
+                      'evidence': []} for _ in range(n_relations)]
+    return {'title': f'doc{doc_id}', 'sents': sents, 'entities': entities, 'relations': relations}
+
+
+def predict_document(rng: random.Random, doc_id: int, instance: dict, noise: float, n_candidates: int = 10) -> dict:
+    """Generate a prediction for a ground truth document.
+    With probability `noise`, each mention is dropped or displaced, each entity gets a wrong type, each
+    relation is replaced by a random one, and the true wikipedia resource is missing from the candidates.
+    Args:
+        rng (random.Random): random generator
+        doc_id (int): index of the document
+        instance (dict): ground truth document
+        noise (float): noise rate, between 0 and 1
+        n_candidates (int, optional): number of entity linking candidates per entity. Defaults to 10.
+    Returns:
+        dict: predicted Linked-DocRED document
+    """
+    n_sentences = len(instance['sents'])
+    n_entities = len(instance['entities'])
+    entities = []
+    for entity in instance['entities']:
+        mentions = []
+        for mention in entity['mentions']:
+            if rng.random() >= noise:
+                mentions.append(mention)
+            elif rng.random() < 0.5:
+                start = rng.randrange(len(instance['sents'][0]) - 3)
+                mentions.append({'name': mention['name'], 'sent_id': rng.randrange(n_sentences), 'pos': [start, start + 1]})
+        candidates = [f'R{doc_id}_{rng.randrange(max(1, 2 * n_entities))}' for _ in range(n_candidates)]
+        if rng.random() >= noise and candidates:
+            candidates[rng.randrange(len(candidates))] = entity['entity_linking']['wikipedia_resource']
+        entities.append({
+            'type': entity['type'] if rng.random() >= noise else rng.choice(ENTITY_TAGS),
+            'mentions': mentions,
+            'predicted_entity_linking': list(dict.fromkeys(candidates)),
+        })
+    relations = []
+    for relation in instance['relations']:
+        if rng.random() >= noise:
+            relations.append({'h': relation['h'], 't': relation['t'], 'r': relation['r']})
+        else:
+            relations.append({'h': rng.randrange(n_entities), 't': rng.randrange(n_entities),
+                              'r': rng.choice(RELATION_TAGS)})
+    return {'title': instance['title'], 'sents': instance['sents'], 'entities': entities, 'relations': relations}
+
+
+def generate_files(truth_file: str, pred_file: str, n_docs: int, n_entities: int, n_mentions: int, n_relations: int,
+                   noise: float, n_candidates: int = 10, seed: int = 0):
+    """Write synthetic ground truth and predicted files, one document at a time
+    Args:
+        truth_file (str): path of the ground truth file
+        pred_file (str): path of the predicted file
+        n_docs (int): number of documents
+        n_entities (int): number of entities per document
+        n_mentions (int): number of mentions per entity
+        n_relations (int): number of relations per document
+        noise (float): noise rate of the predictions (see `predict_document`)
+        n_candidates (int, optional): number of entity linking candidates per entity. Defaults to 10.
+        seed (int, optional): random seed. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    with open(truth_file, 'w', encoding='utf-8') as f_truth, open(pred_file, 'w', encoding='utf-8') as f_pred:
+        f_truth.write('[')
+        f_pred.write('[')
+        for doc_id in range(n_docs):
+            instance = generate_document(rng, doc_id, n_entities, n_mentions, n_relations)
+            instance_pred = predict_document(rng, doc_id, instance, noise, n_candidates)
+            if doc_id > 0:
+                f_truth.write(',')
+                f_pred.write(',')
+            json.dump(instance, f_truth)
+            json.dump(instance_pred, f_pred)
+        f_truth.write(']')
+        f_pred.write(']')
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the current process or of its terminated children (e.g., the --jobs workers),
+    whichever is larger, in bytes"""
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _run_metric(metric: str, truth_file: str, pred_file: str, jobs: int, vectorized: bool, queue):
+    """Evaluate a metric and report its scores, wall time and peak memory, or the traceback of its failure
+    (run in a fresh process)"""
+    try:
+        start = time.perf_counter()
+        accumulator = get_accumulator(metric, keep_documents=False).update_from_files(truth_file, pred_file, jobs,
+                                                                                    vectorized=vectorized)
+        scores = accumulator.compute()
+        wall_time = time.perf_counter() - start
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        return
+    queue.put({'scores': scores, 'wall_time': wall_time, 'peak_rss': peak_rss()})
+
+
+def run_metric(metric: str, truth_file: str, pred_file: str, n_docs: int, jobs: int = 1, vectorized: bool = False) -> dict:
+    """Benchmark a metric in a separate process, so that peak memory is measured for this metric only.
+    A RuntimeError is raised if the metric fails, or if its process exits without results.
+    Args:
+        metric (str): name of the metric (see METRICS)
+        truth_file (str): path to ground truth data
+        pred_file (str): path to predicted data
+        n_docs (int): number of documents in the files
+        jobs (int, optional): number of processes used by the metric. Defaults to 1.
+        vectorized (bool, optional): wether to use the vectorized path of the metric. Defaults to False.
+    Returns:
+        dict: scores, wall time (s), peak RSS (bytes) and throughput (documents/s)
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_metric, args=(metric, truth_file, pred_file, jobs, vectorized, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except queue_module.Empty:
+            if process.is_alive():
+                continue
+            # The results may have been sent just before the process exited
+            try:
+                result = queue.get(timeout=1)
+            except queue_module.Empty:
+                process.join()
+                raise RuntimeError(f'{metric}: the benchmark process exited with code {process.exitcode} '
+                                   'without results') from None
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f"{metric}: the metric failed in the benchmark process\n{result['error']}")
+    result['docs_per_sec'] = n_docs / result['wall_time'] if result['wall_time'] > 0 else float('inf')
+    return result
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare benchmark results with a baseline
+    Args:
+        results (dict): benchmark results (metric -> result of `run_metric`)
+        baseline (dict): previous benchmark results
+        tolerance (float): allowed relative degradation
+    Returns:
+        list: description of each regression
+    """
+    regressions = []
+    for metric, result in results.items():
+        if metric not in baseline:
+            continue
+        reference = baseline[metric]
+        if result['docs_per_sec'] < reference['docs_per_sec'] * (1 - tolerance):
+            regressions.append(f"{metric}: {result['docs_per_sec']:.1f} docs/s (baseline {reference['docs_per_sec']:.1f})")
+        if result['peak_rss'] > reference['peak_rss'] * (1 + tolerance):
+            regressions.append(f"{metric}: peak RSS {result['peak_rss'] / 2**20:.1f} MiB "
+                               f"(baseline {reference['peak_rss'] / 2**20:.1f} MiB)")
+    return regressions
+
+
+def main(metrics: list, n_docs: int, n_entities: int, n_mentions: int, n_relations: int, noise: float,
+         n_candidates: int = 10, seed: int = 0, jobs: int = 1, output_file: str = None, baseline_file: str = None,
+         tolerance: float = 0.2, data_dir: str = None, vectorized: bool = False) -> int:
+    """Main entrypoint
+    Args:
+        metrics (list): names of the metrics to benchmark (see METRICS)
+        n_docs (int): number of documents
+        n_entities (int): number of entities per document
+        n_mentions (int): number of mentions per entity
+        n_relations (int): number of relations per document
+        noise (float): noise rate of the predictions
+        n_candidates (int, optional): number of entity linking candidates per entity. Defaults to 10.
+        seed (int, optional): random seed. Defaults to 0.
+        jobs (int, optional): number of processes used by the metrics. Defaults to 1.
+        output_file (str, optional): path where the results are saved (JSON). Defaults to None.
+        baseline_file (str, optional): path to previous results, to detect regressions. Defaults to None.
+        tolerance (float, optional): allowed relative degradation compared to the baseline. Defaults to 0.2.
+        data_dir (str, optional): directory of the generated files (temporary if not given). Defaults to None.
+        vectorized (bool, optional): wether to use the vectorized path of the metrics providing it. Defaults to False.
+    Returns:
+        int: exit status (1 if regressions were found)
+    """
+    config = {'n_docs': n_docs, 'n_entities': n_entities, 'n_mentions': n_mentions, 'n_relations': n_relations,
+              'noise': noise, 'n_candidates': n_candidates, 'seed': seed, 'jobs': jobs,
+              'vectorized': vectorized}
+
+    with tempfile.TemporaryDirectory(dir=data_dir) as tmp_dir:
+        truth_file = os.path.join(tmp_dir, 'truth.json')
+        pred_file = os.path.join(tmp_dir, 'pred.json')
+        generate_files(truth_file, pred_file, n_docs, n_entities, n_mentions, n_relations, noise, n_candidates, seed)
+
+        results = {}
+        for metric in metrics:
+            result = run_metric(metric, truth_file, pred_file, n_docs, jobs, vectorized)
+            results[metric] = result
+            print(f"{metric}: {result['wall_time']:.2f}s, {result['docs_per_sec']:.1f} docs/s, "
+                  f"peak RSS {result['peak_rss'] / 2**20:.1f} MiB")
+
+    if output_file is not None:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'python': platform.python_version(), 'results': results}, f, indent=2)
+
+    if baseline_file is None:
+        return 0
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline['config'] != config:
+        print(f'Warning: the baseline was computed with another configuration ({baseline["config"]})')
+    regressions = find_regressions(results, baseline['results'], tolerance)
+    for regression in regressions:
+        print(f'Regression - {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Benchmark')
+    parser.add_argument('--metrics', help='Metrics to benchmark', choices=METRICS, nargs='+', default=METRICS)
+    parser.add_argument('--n_docs', help='Number of documents', type=int, default=1000)
+    parser.add_argument('--n_entities', help='Number of entities per document', type=int, default=20)
+    parser.add_argument('--n_mentions', help='Number of mentions per entity', type=int, default=3)
+    parser.add_argument('--n_relations', help='Number of relations per document', type=int, default=10)
+    parser.add_argument('--noise', help='Noise rate of the predictions (0: perfect predictions)', type=float, default=0.2)
+    parser.add_argument('--n_candidates', help='Number of entity linking candidates per entity', type=int, default=10)
+    parser.add_argument('--seed', help='Random seed', type=int, default=0)
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--output_file', help='Path where the results are saved (JSON)', type=str, default=None)
+    parser.add_argument('--baseline_file', help='Path to previous results, to detect regressions', type=str, default=None)
+    parser.add_argument('--tolerance', help='Allowed relative degradation compared to the baseline', type=float, default=0.2)
+    parser.add_argument('--data_dir', help='Directory of the generated files (temporary directory by default)',
+                        type=str, default=None)
+    parser.add_argument('--vectorized', help='Use the vectorized path of the metrics providing it', action='store_true')
+    args = parser.parse_args()
+
+    sys.exit(main(args.metrics, args.n_docs, args.n_entities, args.n_mentions, args.n_relations, args.noise,
+                  args.n_candidates, args.seed, args.jobs, args.output_file, args.baseline_file, args.tolerance,
+                  args.data_dir, args.vectorized))
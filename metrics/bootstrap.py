@@ -0,0 +1,164 @@
+"""Bootstrap confidence intervals and paired bootstrap test for the metrics
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import numpy as np
+from coref_b3 import CorefB3Accumulator
+from entity_f1 import EntityF1Accumulator
+from entity_linking import EntityLinkingAccumulator
+from ner_f1 import NerF1Accumulator
+from profiling import Profiler
+from relation_f1 import RelationF1Accumulator
+
+METRICS = ['ner_f1', 'coref_b3', 'entity_f1', 'relation_f1', 'entity_linking']
+
+
+def get_accumulator(metric: str, hard_aggregation: bool = False, keep_documents: bool = True):
+    """Accumulator of a metric
+    Args:
+        metric (str): name of the metric (see METRICS)
+        hard_aggregation (bool, optional): wether to use soft or hard aggregation (entity_f1 and relation_f1). Defaults to False.
+        keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to True.
+    Returns:
+        MetricAccumulator: accumulator
+    """
+    if metric == 'ner_f1':
+        return NerF1Accumulator(keep_documents=keep_documents)
+    if metric == 'coref_b3':
+        return CorefB3Accumulator(keep_documents=keep_documents)
+    if metric == 'entity_f1':
+        return EntityF1Accumulator(hard_aggregation, keep_documents=keep_documents)
+    if metric == 'relation_f1':
+        return RelationF1Accumulator(hard_aggregation, keep_documents=keep_documents)
+    if metric == 'entity_linking':
+        return EntityLinkingAccumulator(keep_documents=keep_documents)
+    raise ValueError(f'Unknown metric {metric}')
+
+
+def resampled_statistics(statistics: list, n_resamples: int, seed: int = 0, block_size: int = 2**24):
+    """Sum the statistics of documents resampled with replacement.
+    All systems are resampled with the same documents (paired bootstrap).
+    Args:
+        statistics (list): per-document statistics of each system, matrices of shape (#documents, #statistics)
+        n_resamples (int): number of resamples
+        seed (int, optional): random seed. Defaults to 0.
+        block_size (int, optional): maximum number of sampled indices held in memory at once. Defaults to 2**24.
+    Returns:
+        list: summed statistics of each system, matrices of shape (n_resamples, #statistics)
+    """
+    n_docs = len(statistics[0])
+    assert all(len(s) == n_docs for s in statistics), 'Systems must be evaluated on the same documents'
+    rng = np.random.default_rng(seed)
+
+    sums = [np.empty((n_resamples, s.shape[1])) for s in statistics]
+    resamples_per_block = max(1, block_size // max(1, n_docs))
+    for start in range(0, n_resamples, resamples_per_block):
+        end = min(n_resamples, start + resamples_per_block)
+        # Number of times each document is drawn in each resample
+        weights = np.stack([np.bincount(indexes, minlength=n_docs)
+                            for indexes in rng.integers(0, n_docs, size=(end - start, n_docs))])
+        for s, out in zip(statistics, sums):
+            out[start:end] = weights @ s
+    return sums
+
+
+def confidence_interval(samples: np.ndarray, confidence: float):
+    """Percentile confidence interval
+    Args:
+        samples (np.ndarray): bootstrapped scores
+        confidence (float): confidence level
+    Returns:
+        Tuple[float, float]: lower and upper bounds
+    """
+    alpha = (1 - confidence) / 2
+    lower, upper = np.nanquantile(samples, [alpha, 1 - alpha])
+    return lower.item(), upper.item()
+
+
+def main(metric: str, truth_file: str, pred_file: str, other_pred_file: str = None, hard_aggregation: bool = False,
+         n_resamples: int = 1000, confidence: float = 0.95, seed: int = 0, jobs: int = 1, profile: str = None):
+    """Main entrypoint
+    Args:
+        metric (str): name of the metric (see METRICS)
+        truth_file (str): path to ground truth data
+        pred_file (str): path to predicted data
+        other_pred_file (str, optional): path to data predicted by another system, to compare with. Defaults to None.
+        hard_aggregation (bool, optional): wether to use soft or hard aggregation. Defaults to False.
+        n_resamples (int, optional): number of resamples. Defaults to 1000.
+        confidence (float, optional): confidence level. Defaults to 0.95.
+        seed (int, optional): random seed. Defaults to 0.
+        jobs (int, optional): number of processes. Defaults to 1.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
+    """
+    profiler = Profiler(enabled=profile is not None)
+    pred_files = [pred_file] if other_pred_file is None else [pred_file, other_pred_file]
+    accumulators = [get_accumulator(metric, hard_aggregation).update_from_files(truth_file, file, jobs, profiler)
+                    for file in pred_files]
+    with profiler.stage('resample'):
+        statistics = [accumulator.statistics_matrix() for accumulator in accumulators]
+        sums = resampled_statistics(statistics, n_resamples, seed)
+    with profiler.stage('bootstrap_scores'):
+        samples = [accumulator.scores_from_statistics(s) for accumulator, s in zip(accumulators, sums)]
+    profiler.count('resamples', n_resamples)
+
+    for file, accumulator, system_samples in zip(pred_files, accumulators, samples):
+        print(file)
+        scores = accumulator.compute()
+        for name, score in scores.items():
+            lower, upper = confidence_interval(system_samples[name], confidence)
+            print(f"  {name}={score} ({confidence:.0%} CI: [{lower}, {upper}])")
+
+    if other_pred_file is not None:
+        # Paired bootstrap test: how often is the observed difference not reproduced?
+        print(f"{pred_file} - {other_pred_file}")
+        scores = [accumulator.compute() for accumulator in accumulators]
+        for name in scores[0]:
+            delta = scores[0][name] - scores[1][name]
+            deltas = samples[0][name] - samples[1][name]
+            lower, upper = confidence_interval(deltas, confidence)
+            deltas = deltas[~np.isnan(deltas)]
+            p_value = np.mean(np.sign(deltas) != np.sign(delta)).item() if delta != 0 else 1.0
+            print(f"  {name}: delta={delta} ({confidence:.0%} CI: [{lower}, {upper}]), p={p_value}")
+
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file,
+                      scores={file: accumulator.compute() for file, accumulator in zip(pred_files, accumulators)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Bootstrap')
+    parser.add_argument('--metric', help='Metric to bootstrap', choices=METRICS, type=str, required=True)
+    parser.add_argument('--truth_file', help='Path to ground truth data (in Linked-DocRED format)',
+                        type=str, required=True)
+    parser.add_argument('--pred_file', help='Path to predicted data (in Linked-DocRED format)',
+                        type=str, required=True)
+    parser.add_argument('--other_pred_file', help='Path to data predicted by another system, for a paired bootstrap test',
+                        type=str, default=None)
+    parser.add_argument('--hard', help='Wether to use soft or hard aggregation', action='store_true')
+    parser.add_argument('--n_resamples', help='Number of bootstrap resamples', type=int, default=1000)
+    parser.add_argument('--confidence', help='Confidence level of the intervals', type=float, default=0.95)
+    parser.add_argument('--seed', help='Random seed', type=int, default=0)
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
+    parser.set_defaults(hard=False)
+    args = parser.parse_args()
+
+    main(args.metric, args.truth_file, args.pred_file, args.other_pred_file, args.hard,
+         args.n_resamples, args.confidence, args.seed, args.jobs, args.profile)
@@ -18,33 +18,80 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-import json
+from collections import Counter
 import numpy as np
-from sklearn.metrics.cluster import contingency_matrix
+from profiling import Profiler
+from tables import match_mentions
+from truth_index import evaluate_files
+from utils import MetricAccumulator
 
 
-def bcubed(targets, predictions, beta: float = 1):
-    """B3 metric (see Baldwin1998)
+def bcubed_counts(targets, predictions) -> Counter:
+    """Additive B3 statistics of a document.
+    Clusters are local to the document, except the -1 cluster (unmatched mentions) which is
+    shared by all documents: its contribution is kept as separate sums and resolved in `bcubed_from_counts`.
     Args:
-        targets (torch.Tensor): true labels
-        predictions (torch.Tensor): predicted labels
+        targets (np.array): true clusters
+        predictions (np.array): predicted clusters
+    Returns:
+        Counter: B3 statistics
+    """
+    cells = Counter(zip(targets.tolist(), predictions.tolist()))
+    row_sums = Counter()
+    col_sums = Counter()
+    for (target, prediction), n in cells.items():
+        row_sums[target] += n
+        col_sums[prediction] += n
+
+    counts = Counter(total=len(targets))
+    for (target, prediction), n in cells.items():
+        if prediction == -1:
+            counts['missed'] += n
+            counts['missed_sq'] += n * n
+        else:
+            counts['precision'] += n * n / col_sums[prediction]
+        if target == -1:
+            counts['spurious'] += n
+            counts['spurious_sq'] += n * n
+        else:
+            counts['recall'] += n * n / row_sums[target]
+    return counts
+
+
+def bcubed_from_counts(counts: Counter, beta: float = 1):
+    """B3 metric (see Baldwin1998) from statistics accumulated with `bcubed_counts`
+    Args:
+        counts (Counter): B3 statistics
         beta (float, optional): beta for f_score. Defaults to 1.
     Returns:
         Tuple[float, float, float]: b3 f1, precision and recall
     """
+    precision = counts['precision']
+    if counts['missed'] > 0:
+        precision += counts['missed_sq'] / counts['missed']
+    recall = counts['recall']
+    if counts['spurious'] > 0:
+        recall += counts['spurious_sq'] / counts['spurious']
 
-    cont_mat = contingency_matrix(targets, predictions)
-    cont_mat_norm = cont_mat / cont_mat.sum()
-
-    precision = np.sum(cont_mat_norm * (cont_mat /
-                       cont_mat.sum(axis=0))).item()
-    recall = np.sum(cont_mat_norm * (cont_mat /
-                    np.expand_dims(cont_mat.sum(axis=1), 1))).item()
+    precision /= counts['total']
+    recall /= counts['total']
     f1_score = (1 + beta) * precision * recall / (beta * (precision + recall))
 
     return f1_score, precision, recall
 
 
+def bcubed(targets, predictions, beta: float = 1):
+    """B3 metric (see Baldwin1998)
+    Args:
+        targets (np.array): true labels
+        predictions (np.array): predicted labels
+        beta (float, optional): beta for f_score. Defaults to 1.
+    Returns:
+        Tuple[float, float, float]: b3 f1, precision and recall
+    """
+    return bcubed_from_counts(bcubed_counts(targets, predictions), beta)
+
+
 def compare_instance(ref_entities, pred_entities):
     for mention in ref_entities:
         mention['mark'] = False
@@ -85,68 +132,157 @@ def compare_instance(ref_entities, pred_entities):
     return np.array(y_true), np.array(y_pred)
 
 
-def main(truth_file: str, pred_file: str):
+def instance_mentions(instance: dict) -> list:
+    """Flatten the mentions of a Linked-DocRED instance
+    Args:
+        instance (dict): Linked-DocRED instance
+    Returns:
+        list: mentions, with the index of their entity as cluster
+    """
+    out_instance = []
+    for cluster_id, entity in enumerate(instance['entities']):
+        for mention in entity['mentions']:
+            out_instance.append({
+                'sent_id': mention['sent_id'],
+                'pos': mention['pos'],
+                'type': entity['type'],
+                'cluster': cluster_id
+            })
+    return out_instance
+
+
+def document_counts(ref_instance: dict, pred_instance: dict) -> Counter:
+    """Compare a reference and a predicted Linked-DocRED instance
+    Args:
+        ref_instance (dict): true instance
+        pred_instance (dict): predicted instance
+    Returns:
+        Counter: B3 statistics of the instance
+    """
+    y_true, y_pred = compare_instance(instance_mentions(ref_instance), instance_mentions(pred_instance))
+    return bcubed_counts(y_true, y_pred)
+
+
+def compare_tables(truth_tables: dict, pred_tables: dict) -> Counter:
+    """Compare all the reference and predicted instances at once (vectorized `document_counts`).
+    Clusters are the rows of the entity tables, so they never span several documents and the
+    statistics are the sum of those of each instance.
+    Args:
+        truth_tables (dict): tables of the true instances (see `tables.build_tables`)
+        pred_tables (dict): tables of the predicted instances
+    Returns:
+        Counter: B3 statistics, or None if mentions cannot be matched
+    """
+    matching = match_mentions(truth_tables['mentions'], pred_tables['mentions'])
+    if matching is None:
+        return None
+    truth_match, pred_match = matching
+    truth_clusters = truth_tables['mentions']['entity_id']
+    pred_clusters = pred_tables['mentions']['entity_id']
+
+    unmatched_pred = pred_match < 0
+    # Shifted by one, so that the -1 cluster (unmatched mentions) is 0
+    targets = np.concatenate([truth_clusters, np.full(np.count_nonzero(unmatched_pred), -1)]) + 1
+    predictions = np.concatenate([np.where(truth_match >= 0, pred_clusters[truth_match], -1),
+                                  pred_clusters[unmatched_pred]]) + 1
+
+    n_predictions = int(predictions.max(initial=0)) + 1
+    cells, n = np.unique(targets * n_predictions + predictions, return_counts=True)
+    cell_targets, cell_predictions = np.divmod(cells, n_predictions)
+    row_sums = np.bincount(cell_targets, weights=n)
+    col_sums = np.bincount(cell_predictions, weights=n)
+
+    missed = cell_predictions == 0
+    spurious = cell_targets == 0
+    return Counter(
+        total=len(targets),
+        missed=int(n[missed].sum()),
+        missed_sq=int((n[missed] ** 2).sum()),
+        precision=float((n[~missed] ** 2 / col_sums[cell_predictions[~missed]]).sum()),
+        spurious=int(n[spurious].sum()),
+        spurious_sq=int((n[spurious] ** 2).sum()),
+        recall=float((n[~spurious] ** 2 / row_sums[cell_targets[~spurious]]).sum()),
+    )
+
+
+class CorefB3Accumulator(MetricAccumulator):
+    """Coreference B3 metric, accumulated document by document"""
+    STATISTICS = ['total', 'precision', 'recall', 'missed', 'missed_sq', 'spurious', 'spurious_sq']
+
+    def __init__(self, beta: float = 1, keep_documents: bool = False):
+        """Constructor
+        Args:
+            beta (float, optional): beta for f_score. Defaults to 1.
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+        """
+        super().__init__(document_counts, keep_documents, compare_tables)
+        self.beta = beta
+
+    def compute(self) -> dict:
+        """Compute the metric on the documents seen so far
+        Returns:
+            dict: b3 precision, recall and f1
+        """
+        f1_score, precision, recall = bcubed_from_counts(self.counts, self.beta)
+        return {'precision': precision, 'recall': recall, 'f1': f1_score}
+
+    def document_statistics(self, doc_counts: Counter) -> np.ndarray:
+        return np.array([doc_counts[name] for name in self.STATISTICS])
+
+    def scores_from_statistics(self, statistics: np.ndarray) -> dict:
+        # Same formulas as `bcubed_from_counts`, with the beta of the accumulator
+        total, precision, recall, missed, missed_sq, spurious, spurious_sq = np.moveaxis(statistics, -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = (precision + np.where(missed > 0, missed_sq / missed, 0)) / total
+            recall = (recall + np.where(spurious > 0, spurious_sq / spurious, 0)) / total
+            f1_score = np.where(precision + recall > 0,
+                                (1 + self.beta) * precision * recall / (self.beta * (precision + recall)), 0)
+        return {'precision': precision, 'recall': recall, 'f1': f1_score}
+
+
+def main(truth_file: str, pred_files: list, jobs: int = 1, truth_index: bool = False,
+         profile: str = None, vectorized: bool = False):
     """Main entrypoint
     Args:
         truth_file (str): path to ground truth data
-        pred_file (str): path to predicted data
+        pred_files (list): paths to predicted data
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to cache the ground truth in a binary index. Defaults to False.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
+        vectorized (bool, optional): wether to match all the documents at once with NumPy tables (faster, but loads
+            the files in memory and ignores `jobs`). Defaults to False.
     """
-    with open(truth_file, 'r', encoding='utf-8') as f:
-        ref_linked_docred = json.load(f)
-    ref_linked_docred_entities = []
-    cluster_id = 0
-    for instance in ref_linked_docred:
-        out_instance = []
-        for entity in instance['entities']:
-            for mention in entity['mentions']:
-                out_instance.append({
-                    'name': mention['name'],
-                    'sent_id': mention['sent_id'],
-                    'pos': mention['pos'],
-                    'type': entity['type'],
-                    'cluster': cluster_id
-                })
-                cluster_id += 1
-    ref_linked_docred_entities.append(out_instance)
-
-    with open(pred_file, 'r', encoding='utf-8') as f:
-        pred_linked_docred = json.load(f)
-    pred_linked_docred_entities = []
-    cluster_id = 0
-    for instance in pred_linked_docred:
-        out_instance = []
-        for entity in instance['entities']:
-            for mention in entity['mentions']:
-                out_instance.append({
-                    'name': mention['name'],
-                    'sent_id': mention['sent_id'],
-                    'pos': mention['pos'],
-                    'type': entity['type'],
-                    'cluster': cluster_id
-                })
-                cluster_id += 1
-    pred_linked_docred_entities.append(out_instance)
-
-    ys_true = []
-    ys_pred = []
-    for ref_instance, pred_instance in zip(ref_linked_docred_entities, pred_linked_docred_entities):
-        y_true, y_pred = compare_instance(ref_instance, pred_instance)
-        ys_true.append(y_true)
-        ys_pred.append(y_pred)
-
-    ys_true = np.concatenate(ys_true)
-    ys_pred = np.concatenate(ys_pred)
-
-    f1_score, precision, recall = bcubed(ys_true, ys_pred)
-    print(f"B3 - Prec={precision}, Rec={recall}, F1={f1_score}")
+    profiler = Profiler(enabled=profile is not None)
+    all_scores = {}
+    for pred_file, accumulator in evaluate_files(CorefB3Accumulator, truth_file, pred_files, jobs, truth_index, profiler,
+                                                 vectorized):
+        with profiler.stage('compute'):
+            scores = accumulator.compute()
+        all_scores[pred_file] = scores
+        if len(pred_files) > 1:
+            print(pred_file)
+        print(f"B3 - Prec={scores['precision']}, Rec={scores['recall']}, F1={scores['f1']}")
+
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file, scores=all_scores)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='Coref B3')
     parser.add_argument('--truth_file', help='Path to ground truth entities (in Linked-DocRED format)',
                         type=str, required=True)
-    parser.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
-                        type=str, required=True)
+    pred_group = parser.add_mutually_exclusive_group(required=True)
+    pred_group.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
+                            type=str)
+    pred_group.add_argument('--pred_files', help='Paths to several files of predicted entities, evaluated against the same ground truth',
+                            type=str, nargs='+')
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--truth_index', help='Cache the ground truth in a binary index next to it, and reuse it', action='store_true')
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
+    parser.add_argument('--vectorized', help='Match all the documents at once with NumPy tables (faster, but loads both files in memory and ignores --jobs)',
+                        action='store_true')
     args = parser.parse_args()
 
-    main(args.truth_file, args.pred_file)
+    main(args.truth_file, args.pred_files or [args.pred_file], args.jobs, args.truth_index, args.profile,
+         args.vectorized)
@@ -18,9 +18,16 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-import json
-from tqdm.auto import tqdm
+from collections import Counter
+from functools import partial
 import math
+import numpy as np
+from profiling import Profiler
+from tables import pack_keys
+from truth_index import evaluate_files
+from utils import MetricAccumulator
+
+TAGS = ['NUM', 'TIME', 'ORG', 'LOC', 'PER', 'MISC']
 
 def compare_entity_mentions(m1, m2):
     # Types are supposed equal (guaranteed by formula)
@@ -60,95 +67,179 @@ def tp_g_cluster(g_c, P_M_type, hard_aggregation):
     else:
         return None
 
-def main(truth_file: str, pred_file: str, hard_aggregation: bool):
+def compare_instance(instance, instance_pred, hard_aggregation):
+    """Compare the entities of the reference and predicted Linked-DocRED instance
+    Args:
+        instance (dict): true instance
+        instance_pred (dict): predicted instance
+        hard_aggregation (bool): wether to use soft or hard aggregation
+    Returns:
+        Counter: TP_P, P_C, TP_G and G_C of the instance, indexed by (counter, type)
+    """
+    # Tag > Cluster > Mention
+    P_C_inst = {t:[] for t in TAGS}
+    G_C_inst = {t:[] for t in TAGS}
+    # Tag > Mention
+    P_M_inst = {t:[] for t in TAGS}
+    G_M_inst = {t:[] for t in TAGS}
+
+    # Predicted
+    for entity in instance_pred['entities']:
+        P_C_inst[entity['type']].append(entity)
+        P_M_inst[entity['type']].extend(entity['mentions'])
+
+    # Ground truth
+    for entity in instance['entities']:
+        G_C_inst[entity['type']].append(entity)
+        G_M_inst[entity['type']].extend(entity['mentions'])
+
+    counts = Counter()
+    for type in P_C_inst:
+        for p_cluster in P_C_inst[type]:
+            tp_p = tp_p_cluster(p_cluster, G_M_inst[type], hard_aggregation)
+            if tp_p is not None:
+                counts['TP_P', type] += tp_p
+        counts['P_C', type] += len(P_C_inst[type])
+
+    for type in G_C_inst:
+        for g_cluster in G_C_inst[type]:
+            tp_g = tp_g_cluster(g_cluster, P_M_inst[type], hard_aggregation)
+            if tp_g is not None:
+                counts['TP_G', type] += tp_g
+        counts['G_C', type] += len(G_C_inst[type])
+    return counts
+
+def compare_tables(truth_tables, pred_tables, hard_aggregation):
+    """Compare all the reference and predicted instances at once (vectorized `compare_instance`)
+    Args:
+        truth_tables (dict): tables of the true instances (see `tables.build_tables`)
+        pred_tables (dict): tables of the predicted instances
+        hard_aggregation (bool): wether to use soft or hard aggregation
+    Returns:
+        Counter: TP_P, P_C, TP_G and G_C, indexed by (counter, type), or None if mentions cannot be compared
+    """
+    if any(t not in TAGS for t in truth_tables['type_names'] + pred_tables['type_names']):
+        # Let compare_instance fail on unknown types
+        return None
+    truth_tags = np.array([TAGS.index(t) for t in truth_tables['type_names']], dtype=np.int64)
+    pred_tags = np.array([TAGS.index(t) for t in pred_tables['type_names']], dtype=np.int64)
+
+    # A mention is found if the other side has a mention of the same type at the same place
+    fields = ['doc_id', 'sent_id', 'start', 'end']
+    keys = pack_keys([truth_tags[truth_tables['mentions']['type_id']]] + [truth_tables['mentions'][f] for f in fields],
+                     [pred_tags[pred_tables['mentions']['type_id']]] + [pred_tables['mentions'][f] for f in fields])
+    if keys is None:
+        return None
+    truth_keys, pred_keys = keys
+
+    counts = Counter()
+    for tp_name, c_name, tables, tags, found in [
+            ('TP_P', 'P_C', pred_tables, pred_tags, np.isin(pred_keys, truth_keys)),
+            ('TP_G', 'G_C', truth_tables, truth_tags, np.isin(truth_keys, pred_keys))]:
+        entities = tables['entities']
+        entity_tags = tags[entities['type_id']]
+        intersection = np.bincount(tables['mentions']['entity_id'], weights=found, minlength=len(entities))
+        valid = entities['n_mentions'] > 0
+        res = intersection[valid] / entities['n_mentions'][valid]
+        if hard_aggregation:
+            res = np.floor(res)
+        tp = np.bincount(entity_tags[valid], weights=res, minlength=len(TAGS))
+        n_clusters = np.bincount(entity_tags, minlength=len(TAGS))
+        for tag_id, tag in enumerate(TAGS):
+            counts[tp_name, tag] += tp[tag_id].item()
+            counts[c_name, tag] += n_clusters[tag_id].item()
+    return counts
+
+class EntityF1Accumulator(MetricAccumulator):
+    """Entity-centric Entity F1 score, accumulated document by document"""
+
+    STATISTICS = ['TP_P', 'P_C', 'TP_G', 'G_C']
+
+    def __init__(self, hard_aggregation: bool = False, keep_documents: bool = False):
+        """Constructor
+        Args:
+            hard_aggregation (bool, optional): wether to use soft or hard aggregation. Defaults to False.
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+        """
+        super().__init__(partial(compare_instance, hard_aggregation=hard_aggregation), keep_documents,
+                         partial(compare_tables, hard_aggregation=hard_aggregation))
+
+    def compute(self) -> dict:
+        """Compute the metric on the documents seen so far
+        Returns:
+            dict: precision, recall and f1
+        """
+        TP_P = {t:self.counts['TP_P', t] for t in TAGS}
+        FP = {t:self.counts['P_C', t] - TP_P[t] for t in TAGS}
+        TP_G = {t:self.counts['TP_G', t] for t in TAGS}
+        FN = {t:self.counts['G_C', t] - TP_G[t] for t in TAGS}
+
+        P = sum(TP_P.values()) / (sum(TP_P.values()) + sum(FP.values()))
+        R = sum(TP_G.values()) / (sum(TP_G.values()) + sum(FN.values()))
+        F1 = 2 * (P * R) / (P + R)
+        return {'precision': P, 'recall': R, 'f1': F1}
+
+    def document_statistics(self, doc_counts):
+        # Sum over types
+        statistics = dict.fromkeys(self.STATISTICS, 0)
+        for (name, _), value in doc_counts.items():
+            statistics[name] += value
+        return np.array([statistics[name] for name in self.STATISTICS])
+
+    @staticmethod
+    def scores_from_statistics(statistics):
+        TP_P, P_C, TP_G, G_C = np.moveaxis(statistics, -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            P = TP_P / P_C
+            R = TP_G / G_C
+            F1 = np.where(P + R > 0, 2 * (P * R) / (P + R), 0)
+        return {'precision': P, 'recall': R, 'f1': F1}
+
+def main(truth_file: str, pred_files: list, hard_aggregation: bool, jobs: int = 1, truth_index: bool = False,
+         profile: str = None, vectorized: bool = False):
     """Main entrypoint
     Args:
         truth_file (str): path to ground truth data
-        pred_file (str): path to predicted data
+        pred_files (list): paths to predicted data
         hard_aggregation (bool): wether to use soft or hard aggregation
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to cache the ground truth in a binary index. Defaults to False.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
+        vectorized (bool, optional): wether to match all the documents at once with NumPy tables (faster, but loads
+            the files in memory and ignores `jobs`). Defaults to False.
     """
-    with open(truth_file, 'r', encoding='utf-8') as f:
-        ref_linked_docred = json.load(f)
-        
-    with open(pred_file, 'r', encoding='utf-8') as f:
-        pred_linked_docred = json.load(f)
-    
-    tags = ['NUM', 'TIME', 'ORG', 'LOC', 'PER', 'MISC']
-    # Instance > Tag > Cluster > Mention
-    P_C = []
-    G_C = []
-    # Instance > Tag > Mention
-    P_M = []
-    G_M = []
-
-    for instance, instance_pred in zip(ref_linked_docred, pred_linked_docred):
-        # Predicted
-        P_C_inst = {t:[] for t in tags}
-        P_M_inst = {t:[] for t in tags}
-        for entity in instance_pred['entities']:
-            P_C_type = P_C_inst[entity['type']]
-            P_C_type.append(entity)
-            
-            P_M_type = P_M_inst[entity['type']]
-            P_M_type.extend(entity['mentions'])
-        P_C.append(P_C_inst)
-        P_M.append(P_M_inst)
-            
-        # Ground truth
-        G_C_inst = {t:[] for t in tags}
-        G_M_inst = {t:[] for t in tags}
-        for entity in instance['entities']:
-            G_C_type = G_C_inst[entity['type']]
-            G_C_type.append(entity)
-            
-            G_M_type = G_M_inst[entity['type']]
-            G_M_type.extend(entity['mentions'])
-        G_C.append(G_C_inst)
-        G_M.append(G_M_inst)
-    
-    TP_P = {t:0 for t in tags}
-    P_C_count = {t:0 for t in tags}
-    FP = {t:0 for t in tags}
-    for p_c_inst, g_m_inst in tqdm(zip(P_C, G_M)):
-        for type in p_c_inst:
-            for p_cluster in p_c_inst[type]:
-                tp_p = tp_p_cluster(p_cluster, g_m_inst[type], hard_aggregation)
-                if tp_p is not None:
-                    TP_P[type] += tp_p
-            P_C_count[type] += len(p_c_inst[type])
-
-    for type in FP:
-        FP[type] = P_C_count[type] - TP_P[type]
-    
-    TP_G = {t:0 for t in tags}
-    G_C_count = {t:0 for t in tags}
-    FN = {t:0 for t in tags}
-
-    for g_c_inst, p_m_inst in tqdm(zip(G_C, P_M)):
-        for type in g_c_inst:
-            for p_cluster in g_c_inst[type]:
-                tp_p = tp_g_cluster(p_cluster, p_m_inst[type], hard_aggregation)
-                if tp_p is not None:
-                    TP_G[type] += tp_p
-            G_C_count[type] += len(g_c_inst[type])
-
-    for type in FN:
-        FN[type] = G_C_count[type] - TP_G[type]
-        
-    P = sum(TP_P.values()) / (sum(TP_P.values()) + sum(FP.values()))
-    R = sum(TP_G.values()) / (sum(TP_G.values()) + sum(FN.values()))
-    F1 = 2 * (P * R) / (P + R)
-    print(f"Prec={P}, Rec={R}, F1={F1}")
+    profiler = Profiler(enabled=profile is not None)
+    all_scores = {}
+    for pred_file, accumulator in evaluate_files(partial(EntityF1Accumulator, hard_aggregation), truth_file, pred_files, jobs, truth_index, profiler,
+                                                 vectorized):
+        with profiler.stage('compute'):
+            scores = accumulator.compute()
+        all_scores[pred_file] = scores
+        if len(pred_files) > 1:
+            print(pred_file)
+        print(f"Prec={scores['precision']}, Rec={scores['recall']}, F1={scores['f1']}")
 
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file, scores=all_scores)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='Entity F1')
     parser.add_argument('--truth_file', help='Path to ground truth entities (in Linked-DocRED format)',
                         type=str, required=True)
-    parser.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
-                        type=str, required=True)
+    pred_group = parser.add_mutually_exclusive_group(required=True)
+    pred_group.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
+                            type=str)
+    pred_group.add_argument('--pred_files', help='Paths to several files of predicted entities, evaluated against the same ground truth',
+                            type=str, nargs='+')
     parser.add_argument('--hard', help='Wether to use soft or hard aggregation', action='store_true')
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--truth_index', help='Cache the ground truth in a binary index next to it, and reuse it', action='store_true')
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
+    parser.add_argument('--vectorized', help='Match all the documents at once with NumPy tables (faster, but loads both files in memory and ignores --jobs)',
+                        action='store_true')
     parser.set_defaults(hard=False)
     args = parser.parse_args()
 
-    main(args.truth_file, args.pred_file, args.hard)
\ No newline at end of file
+    main(args.truth_file, args.pred_files or [args.pred_file], args.hard, args.jobs, args.truth_index, args.profile,
+         args.vectorized)
\ No newline at end of file
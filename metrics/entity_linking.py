@@ -18,108 +18,165 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-import json
+from collections import Counter
 import numpy as np
-import pandas as pd
+from profiling import Profiler
+from truth_index import evaluate_files
+from utils import MetricAccumulator
 
 
-def compare_entity_mentions(m1, m1_type, m2, m2_type):
-    return m1_type == m2_type and m1['sent_id'] == m2['sent_id'] and m1['pos'][0] == m2['pos'][0] and m1['pos'][1] == m2['pos'][1]
+def instance_candidates(instance: dict) -> dict:
+    """Index the predicted mentions of a Linked-DocRED instance by type and position
+    Args:
+        instance (dict): predicted Linked-DocRED instance
+    Returns:
+        dict: candidates of the predicted mentions at each (type, sent_id, start, end), in document order
+    """
+    mentions = {}
+    for entity in instance['entities']:
+        candidates = entity['predicted_entity_linking']
+        for mention in entity['mentions']:
+            key = (entity['type'], mention['sent_id'], mention['pos'][0], mention['pos'][1])
+            mentions.setdefault(key, []).append(candidates)
+    return mentions
 
 
-def main(truth_file: str, pred_file: str):
-    """Main entrypoint
+def compare_instance(instance: dict, instance_pred: dict) -> Counter:
+    """Rank the true wikipedia resource of each entity among the predicted candidates
     Args:
-        truth_file (str): path to ground truth data
-        pred_file (str): path to predicted data
+        instance (dict): true instance
+        instance_pred (dict): predicted instance
+    Returns:
+        Counter: number of entities, hits and sum of the ranks of the instance
     """
-    with open(truth_file, 'r', encoding='utf-8') as f:
-        ref_linked_docred = json.load(f)
-
-    with open(pred_file, 'r', encoding='utf-8') as f:
-        pred_linked_docred = json.load(f)
-    pred_linked_docred_mentions = []
-    for instance in pred_linked_docred:
-        out_mentions = []
-        for entity in instance['entities']:
-            candidates = entity['predicted_entity_linking']
-            for mention in entity['mentions']:
-                out_mentions.append({
-                    'sent_id': mention['sent_id'],
-                    'pos': mention['pos'],
-                    'candidates': candidates,
-                    'type': entity['type']
-                })
-        pred_linked_docred_mentions.append(out_mentions)
-
-    results = []
-    for instance, mentions_pred in zip(ref_linked_docred, pred_linked_docred_mentions):
-        for entity in instance['entities']:
-            wiki_resources = {}
-
-            # Merge candidates using all mentions
-            entity_type = entity['type']
-
-            if entity_type in ['NUM', 'TIME']:
-                continue
+    mentions_pred = instance_candidates(instance_pred)
+    ranks = []
+    for entity in instance['entities']:
+        wiki_resources = {}
 
-            for mention in entity['mentions']:
-                marked_cands = {k: False for k in wiki_resources}
+        # Merge candidates using all mentions
+        entity_type = entity['type']
 
-                for mention_pred in mentions_pred:
-                    if compare_entity_mentions(mention, entity_type, mention_pred, mention_pred['type']):
-                        num_candidates = len(mention_pred['candidates'])
+        if entity_type in ['NUM', 'TIME']:
+            continue
 
-                        for i, cand in enumerate(mention_pred['candidates']):
-                            if cand in wiki_resources:
-                                wiki_resources[cand] = wiki_resources[cand] + i
-                                marked_cands[cand] = True
-                            else:
-                                wiki_resources[cand] = + i
+        for mention in entity['mentions']:
+            key = (entity_type, mention['sent_id'], mention['pos'][0], mention['pos'][1])
+            if key not in mentions_pred:
+                continue
+            previous = list(wiki_resources)
+            marked_cands = set()
 
-                        for k, marked in marked_cands.items():
-                            if not marked:
-                                wiki_resources[k] += num_candidates
+            for candidates in mentions_pred[key]:
+                for i, cand in enumerate(candidates):
+                    if cand in wiki_resources:
+                        wiki_resources[cand] += i
+                        marked_cands.add(cand)
+                    else:
+                        wiki_resources[cand] = i
 
-            # Compute ranking
-            wiki_scores = [v for k, v in wiki_resources.items()]
-            wiki_resources = [k for k, v in wiki_resources.items()]
+                # Previous candidates missing from this mention get its number of candidates
+                for k in previous:
+                    if k not in marked_cands:
+                        wiki_resources[k] += len(candidates)
 
-            indexes = np.argsort(wiki_scores)
-            wiki_resources = [wiki_resources[i] for i in indexes]
+        # Compute ranking
+        wiki_scores = list(wiki_resources.values())
+        wiki_resources = list(wiki_resources.keys())
 
-            results.append({
-                'entity': entity,
-                'candidates': wiki_resources
-            })
+        indexes = np.argsort(wiki_scores)
+        wiki_resources = [wiki_resources[i] for i in indexes]
 
-    out = []
-    for res in results:
         try:
-            rank = res['candidates'].index(
-                res['entity']['entity_linking']['wikipedia_resource']) + 1
+            rank = wiki_resources.index(
+                entity['entity_linking']['wikipedia_resource']) + 1
         except ValueError:
             rank = -1
-        out.append({
-            'rank': rank,
-            'confidence': res['entity']['entity_linking']['confidence']
-        })
-    out = pd.DataFrame(out)
+        ranks.append(rank)
+
+    ranks = np.array(ranks, dtype=np.int64)
+    found = ranks > 0
+    return Counter({
+        'entities': len(ranks),
+        'not_found': int(np.count_nonzero(~found)),
+        'found': int(np.count_nonzero(found)),
+        'rank_sum': int(ranks[found].sum()),
+        'hit@1': int(np.count_nonzero(ranks == 1)),
+        'hit@5': int(np.count_nonzero(found & (ranks <= 5))),
+    })
+
+
+class EntityLinkingAccumulator(MetricAccumulator):
+    """Entity-centric entity-linking metrics, accumulated document by document"""
+    STATISTICS = ['entities', 'hit@1', 'hit@5', 'not_found', 'found', 'rank_sum']
+
+    def __init__(self, keep_documents: bool = False):
+        """Constructor
+        Args:
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+        """
+        super().__init__(compare_instance, keep_documents)
+
+    def compute(self) -> dict:
+        """Compute the metrics on the documents seen so far
+        Returns:
+            dict: hit@1, hit@5, mean rank and not found
+        """
+        hit_at_1 = self.counts['hit@1'] / self.counts['entities']
+        hit_at_5 = self.counts['hit@5'] / self.counts['entities']
+        mean_rank = self.counts['rank_sum'] / self.counts['found'] if self.counts['found'] > 0 else float('nan')
+        not_found = self.counts['not_found'] / self.counts['entities']
+        return {'hit@1': hit_at_1, 'hit@5': hit_at_5, 'mean_rank': mean_rank, 'not_found': not_found}
+
+    def document_statistics(self, doc_counts: Counter) -> np.ndarray:
+        return np.array([doc_counts[name] for name in self.STATISTICS])
+
+    @staticmethod
+    def scores_from_statistics(statistics: np.ndarray) -> dict:
+        entities, hit_at_1, hit_at_5, not_found, found, rank_sum = np.moveaxis(statistics, -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {'hit@1': hit_at_1 / entities, 'hit@5': hit_at_5 / entities,
+                    'mean_rank': rank_sum / found, 'not_found': not_found / entities}
+
+
+def main(truth_file: str, pred_files: list, jobs: int = 1, truth_index: bool = False,
+         profile: str = None):
+    """Main entrypoint
+    Args:
+        truth_file (str): path to ground truth data
+        pred_files (list): paths to predicted data
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to cache the ground truth in a binary index. Defaults to False.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
+    """
+    profiler = Profiler(enabled=profile is not None)
+    all_scores = {}
+    for pred_file, accumulator in evaluate_files(EntityLinkingAccumulator, truth_file, pred_files, jobs, truth_index, profiler):
+        with profiler.stage('compute'):
+            scores = accumulator.compute()
+        all_scores[pred_file] = scores
+        if len(pred_files) > 1:
+            print(pred_file)
+        print(
+            f"Hit@1={scores['hit@1']}, Hit@5={scores['hit@5']}, Mean Rank={scores['mean_rank']}, Not Found={scores['not_found']}")
 
-    hit_at_1 = len(out[out['rank'] == 1]) / len(out)
-    hit_at_5 = len(out[(out['rank'] <= 5) & (out['rank'] > -1)]) / len(out)
-    mean_rank = out.loc[out['rank'] != -1, 'rank'].mean()
-    not_found = len(out[out['rank'] == -1]) / len(out)
-    print(
-        f"Hit@1={hit_at_1}, Hit@5={hit_at_5}, Mean Rank={mean_rank}, Not Found={not_found}")
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file, scores=all_scores)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='Entity F1')
     parser.add_argument('--truth_file', help='Path to ground truth entities (in Linked-DocRED format)',
                         type=str, required=True)
-    parser.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
-                        type=str, required=True)
+    pred_group = parser.add_mutually_exclusive_group(required=True)
+    pred_group.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
+                            type=str)
+    pred_group.add_argument('--pred_files', help='Paths to several files of predicted entities, evaluated against the same ground truth',
+                            type=str, nargs='+')
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--truth_index', help='Cache the ground truth in a binary index next to it, and reuse it', action='store_true')
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
     args = parser.parse_args()
 
-    main(args.truth_file, args.pred_file)
+    main(args.truth_file, args.pred_files or [args.pred_file], args.jobs, args.truth_index, args.profile)
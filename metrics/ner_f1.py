@@ -18,9 +18,13 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-import json
+from collections import Counter
 import numpy as np
 from sklearn.metrics import precision_recall_fscore_support, accuracy_score
+from profiling import Profiler
+from tables import match_mentions
+from truth_index import evaluate_files
+from utils import MetricAccumulator
 
 
 def compare_instance(ref_mentions: list, pred_mentions: list) -> np.array:
@@ -70,66 +74,150 @@ def compare_instance(ref_mentions: list, pred_mentions: list) -> np.array:
     return np.array(y_true), np.array(y_pred)
 
 
-def main(truth_file: str, pred_file: str):
+def instance_mentions(instance: dict) -> list:
+    """Flatten the mentions of a Linked-DocRED instance
+    Args:
+        instance (dict): Linked-DocRED instance
+    Returns:
+        list: mentions, with the type of their entity
+    """
+    out_instance = []
+    for entity in instance['entities']:
+        for mention in entity['mentions']:
+            out_instance.append({
+                'sent_id': mention['sent_id'],
+                'pos': mention['pos'],
+                'type': entity['type'],
+            })
+    return out_instance
+
+
+def document_counts(ref_instance: dict, pred_instance: dict) -> Counter:
+    """Compare a reference and a predicted Linked-DocRED instance
+    Args:
+        ref_instance (dict): true instance
+        pred_instance (dict): predicted instance
+    Returns:
+        Counter: number of mentions per (true type, predicted type)
+    """
+    y_true, y_pred = compare_instance(instance_mentions(ref_instance), instance_mentions(pred_instance))
+    return Counter(zip(y_true.tolist(), y_pred.tolist()))
+
+
+def compare_tables(truth_tables: dict, pred_tables: dict) -> Counter:
+    """Compare all the reference and predicted instances at once (vectorized `document_counts`)
+    Args:
+        truth_tables (dict): tables of the true instances (see `tables.build_tables`)
+        pred_tables (dict): tables of the predicted instances
+    Returns:
+        Counter: number of mentions per (true type, predicted type), or None if mentions cannot be matched
+    """
+    matching = match_mentions(truth_tables['mentions'], pred_tables['mentions'])
+    if matching is None:
+        return None
+    truth_match, pred_match = matching
+
+    # Shared label ids for the types of both files, and 'na'
+    labels = {}
+    truth_label_ids = np.array([labels.setdefault(t, len(labels)) for t in truth_tables['type_names']], dtype=np.int64)
+    pred_label_ids = np.array([labels.setdefault(t, len(labels)) for t in pred_tables['type_names']], dtype=np.int64)
+    na = labels.setdefault('na', len(labels))
+    truth_labels = truth_label_ids[truth_tables['mentions']['type_id']]
+    pred_labels = pred_label_ids[pred_tables['mentions']['type_id']]
+
+    unmatched_pred = pred_match < 0
+    y_true = np.concatenate([truth_labels, np.full(np.count_nonzero(unmatched_pred), na)])
+    y_pred = np.concatenate([np.where(truth_match >= 0, pred_labels[truth_match], na), pred_labels[unmatched_pred]])
+
+    names = list(labels.keys())
+    pairs, counts = np.unique(y_true * len(names) + y_pred, return_counts=True)
+    return Counter({(names[pair // len(names)], names[pair % len(names)]): n
+                    for pair, n in zip(pairs.tolist(), counts.tolist())})
+
+
+class NerF1Accumulator(MetricAccumulator):
+    """Mention-level NER metrics, accumulated document by document"""
+    STATISTICS = ['correct', 'total']
+
+    def __init__(self, keep_documents: bool = False):
+        """Constructor
+        Args:
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+        """
+        super().__init__(document_counts, keep_documents, compare_tables)
+
+    def compute(self) -> dict:
+        """Compute the metric on the documents seen so far
+        Returns:
+            dict: precision, recall, f1 (micro) and accuracy
+        """
+        # (true type, predicted type) -> number of mentions
+        pairs = list(self.counts.keys())
+        ys_true = np.array([y_true for y_true, _ in pairs])
+        ys_pred = np.array([y_pred for _, y_pred in pairs])
+        weights = np.array([self.counts[pair] for pair in pairs])
+
+        precision, recall, fscore, _ = precision_recall_fscore_support(
+            ys_true, ys_pred, average='micro', sample_weight=weights)
+        accuracy = accuracy_score(ys_true, ys_pred, sample_weight=weights)
+        return {'precision': precision, 'recall': recall, 'f1': fscore, 'accuracy': accuracy}
+
+    def document_statistics(self, doc_counts: Counter) -> np.ndarray:
+        correct = sum(n for (y_true, y_pred), n in doc_counts.items() if y_true == y_pred)
+        return np.array([correct, sum(doc_counts.values())])
+
+    @staticmethod
+    def scores_from_statistics(statistics: np.ndarray) -> dict:
+        # 'na' is one of the labels, so micro-averaged scores are all equal to the accuracy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accuracy = statistics[..., 0] / statistics[..., 1]
+        return {'precision': accuracy, 'recall': accuracy, 'f1': accuracy, 'accuracy': accuracy}
+
+
+def main(truth_file: str, pred_files: list, jobs: int = 1, truth_index: bool = False,
+         profile: str = None, vectorized: bool = False):
     """Main entrypoint
     Args:
         truth_file (str): path to ground truth data
-        pred_file (str): path to predicted data
+        pred_files (list): paths to predicted data
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to cache the ground truth in a binary index. Defaults to False.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
+        vectorized (bool, optional): wether to match all the documents at once with NumPy tables (faster, but loads
+            the files in memory and ignores `jobs`). Defaults to False.
     """
-    # Load mentions
-    with open(truth_file, 'r', encoding='utf-8') as f:
-        ref_linked_docred = json.load(f)
-    ref_linked_docred_mentions = []
-    for instance in ref_linked_docred:
-        out_instance = []
-        for entity in instance['entities']:
-            for mention in entity['mentions']:
-                out_instance.append({
-                    'name': mention['name'],
-                    'sent_id': mention['sent_id'],
-                    'pos': mention['pos'],
-                    'type': entity['type'],
-                })
-    ref_linked_docred_mentions.append(out_instance)
-
-    with open(pred_file, 'r', encoding='utf-8') as f:
-        pred_linked_docred = json.load(f)
-    pred_linked_docred_mentions = []
-    for instance in pred_linked_docred:
-        out_instance = []
-        for entity in instance['entities']:
-            for mention in entity['mentions']:
-                out_instance.append({
-                    'name': mention['name'],
-                    'sent_id': mention['sent_id'],
-                    'pos': mention['pos'],
-                    'type': entity['type'],
-                })
-    pred_linked_docred_mentions.append(out_instance)
-
-    ys_true = []
-    ys_pred = []
-    for ref_instance, pred_instance in zip(ref_linked_docred_mentions, pred_linked_docred_mentions):
-        y_true, y_pred = compare_instance(ref_instance, pred_instance)
-        ys_true.append(y_true)
-        ys_pred.append(y_pred)
-
-    ys_true = np.concatenate(ys_true)
-    ys_pred = np.concatenate(ys_pred)
-
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        ys_true, ys_pred, average='micro')
-    accuracy = accuracy_score(ys_true, ys_pred)
-    print(
-        f"Prec={precision}, Rec={recall}, F1(micro)={fscore}, Accuracy={accuracy}")
+    profiler = Profiler(enabled=profile is not None)
+    all_scores = {}
+    for pred_file, accumulator in evaluate_files(NerF1Accumulator, truth_file, pred_files, jobs, truth_index, profiler,
+                                                 vectorized):
+        with profiler.stage('compute'):
+            scores = accumulator.compute()
+        all_scores[pred_file] = scores
+        if len(pred_files) > 1:
+            print(pred_file)
+        print(
+            f"Prec={scores['precision']}, Rec={scores['recall']}, F1(micro)={scores['f1']}, Accuracy={scores['accuracy']}")
+
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file, scores=all_scores)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='NER F1')
     parser.add_argument('--truth_file', help='Path to ground truth entities (in Linked-DocRED format)',
                         type=str, required=True)
-    parser.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
-                        type=str, required=True)
+    pred_group = parser.add_mutually_exclusive_group(required=True)
+    pred_group.add_argument('--pred_file', help='Path to predicted entities (in Linked-DocRED format)',
+                            type=str)
+    pred_group.add_argument('--pred_files', help='Paths to several files of predicted entities, evaluated against the same ground truth',
+                            type=str, nargs='+')
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--truth_index', help='Cache the ground truth in a binary index next to it, and reuse it', action='store_true')
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
+    parser.add_argument('--vectorized', help='Match all the documents at once with NumPy tables (faster, but loads both files in memory and ignores --jobs)',
+                        action='store_true')
     args = parser.parse_args()
 
-    main(args.truth_file, args.pred_file)
+    main(args.truth_file, args.pred_files or [args.pred_file], args.jobs, args.truth_index, args.profile,
+         args.vectorized)
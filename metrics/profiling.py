@@ -0,0 +1,198 @@
+"""Per-stage timing and memory instrumentation of the metrics
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import json
+import time
+import tracemalloc
+
+
+class Profiler:
+    """Record wall time, CPU time and allocated memory of named stages, and counters.
+    A stage entered several times accumulates its times; its memory is the peak memory allocated
+    (tracemalloc) above the memory allocated when it was entered. A disabled profiler records nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        """Constructor
+        Args:
+            enabled (bool, optional): wether to record anything. Defaults to True.
+        """
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = Counter()
+        # Stages currently entered: [name, memory when entered, peak memory]
+        self._active = []
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stage_record(self, name: str) -> dict:
+        return self.stages.setdefault(name, {'calls': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_memory': 0})
+
+    def _update_peaks(self):
+        # tracemalloc has a single peak: fold it into all the active stages before it is reset
+        _, peak = tracemalloc.get_traced_memory()
+        for frame in self._active:
+            frame[2] = max(frame[2], peak)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Record a stage
+        Args:
+            name (str): name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+        self._update_peaks()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        frame = [name, current, current]
+        self._active.append(frame)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            self._update_peaks()
+            self._active.pop()
+            self.add_time(name, wall_time, cpu_time)
+            record = self.stages[name]
+            record['peak_memory'] = max(record['peak_memory'], frame[2] - frame[1])
+
+    def add_time(self, name: str, wall_time: float, cpu_time: float, calls: int = 1):
+        """Add times measured elsewhere (e.g., in a worker process) to a stage
+        Args:
+            name (str): name of the stage
+            wall_time (float): wall time (s)
+            cpu_time (float): CPU time (s)
+            calls (int, optional): number of calls. Defaults to 1.
+        """
+        if not self.enabled:
+            return
+        record = self._stage_record(name)
+        record['calls'] += calls
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time
+
+    def iterate(self, name: str, iterable):
+        """Iterate, recording the time spent producing each item as a stage (e.g., parsing)
+        Args:
+            name (str): name of the stage
+            iterable (Iterable): items
+        Yields:
+            Any: items of `iterable`
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        """Increment a counter
+        Args:
+            name (str): name of the counter
+            n (int, optional): increment. Defaults to 1.
+        """
+        if self.enabled:
+            self.counters[name] += n
+
+    def update_counters(self, counters: Counter):
+        """Increment several counters
+        Args:
+            counters (Counter): increments
+        """
+        if self.enabled:
+            self.counters.update(counters)
+
+    def trace(self, **fields) -> dict:
+        """Machine-readable trace of the recorded stages and counters
+        Args:
+            **fields: additional fields of the trace (e.g., scores)
+        Returns:
+            dict: trace
+        """
+        return {**fields, 'stages': self.stages, 'counters': dict(self.counters)}
+
+    def save(self, path: str, **fields):
+        """Write the trace in JSON
+        Args:
+            path (str): path of the trace, or '-' for the standard output
+            **fields: additional fields of the trace (e.g., scores)
+        """
+        trace = self.trace(**fields)
+        if path == '-':
+            print(json.dumps(trace))
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, indent=2)
+
+
+def document_counters(instance: dict, instance_pred: dict) -> Counter:
+    """Size of a pair of ground truth and predicted documents, as profiling counters
+    Args:
+        instance (dict): true instance
+        instance_pred (dict): predicted instance
+    Returns:
+        Counter: number of documents, entities, mentions and relations compared
+    """
+    counters = Counter(documents=1)
+    for side, doc in [('truth', instance), ('pred', instance_pred)]:
+        counters[f'{side}_entities'] += len(doc['entities'])
+        counters[f'{side}_mentions'] += sum(len(entity['mentions']) for entity in doc['entities'])
+        counters[f'{side}_relations'] += len(doc['relations'])
+    return counters
+
+
+def table_counters(truth_tables: dict, pred_tables: dict) -> Counter:
+    """Size of the tables of ground truth and predicted files, as profiling counters (see `document_counters`)
+    Args:
+        truth_tables (dict): tables of the true instances (see `tables.build_tables`)
+        pred_tables (dict): tables of the predicted instances
+    Returns:
+        Counter: number of documents, entities, mentions and relations compared
+    """
+    counters = Counter(documents=len(truth_tables['documents']))
+    for side, tables in [('truth', truth_tables), ('pred', pred_tables)]:
+        for name in ['entities', 'mentions', 'relations']:
+            counters[f'{side}_{name}'] += len(tables[name])
+    return counters
+
+
+def profiled_compare(func, instance: dict, instance_pred: dict):
+    """Apply `func` to a pair of documents, measuring it (picklable with `functools.partial`)
+    Args:
+        func (Callable[[dict, dict], Any]): comparison of a document pair
+        instance (dict): true instance
+        instance_pred (dict): predicted instance
+    Returns:
+        Tuple[Any, float, float, Counter]: result of `func`, wall time, CPU time and counters
+    """
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    result = func(instance, instance_pred)
+    wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return result, wall_time, cpu_time, document_counters(instance, instance_pred)
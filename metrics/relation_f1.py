@@ -18,9 +18,22 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import argparse
-import json
-from tqdm.auto import tqdm
+from collections import Counter
+from functools import partial
 import math
+import numpy as np
+from profiling import Profiler
+from truth_index import evaluate_files
+from utils import MetricAccumulator
+
+TAGS = ["P6", "P17", "P19", "P20", "P22", "P25", "P26", "P27", "P30", "P31", "P35", "P36", "P37", 
+    "P39", "P40", "P50", "P54", "P57", "P58", "P69", "P86", "P102", "P108", "P112", "P118", "P123", 
+    "P127", "P131", "P136", "P137", "P140", "P150", "P155", "P156", "P159", "P161", "P162", "P166", 
+    "P170", "P171", "P172", "P175", "P176", "P178", "P179", "P190", "P194", "P205", "P206", "P241", 
+    "P264", "P272", "P276", "P279", "P355", "P361", "P364", "P400", "P403", "P449", "P463", "P488", 
+    "P495", "P527", "P551", "P569", "P570", "P571", "P576", "P577", "P580", "P582", "P585", "P607", 
+    "P674", "P676", "P706", "P710", "P737", "P740", "P749", "P800", "P807", "P840", "P937", "P1001", 
+    "P1056", "P1198", "P1336", "P1344", "P1365", "P1366", "P1376", "P1412", "P1441", "P3373"]
 
 def generate_relation_mentions_from_entity(h_entity, relation, t_entity):
     for h_mention in h_entity['mentions']:
@@ -82,117 +95,142 @@ def tp_g_cluster(g_c, P_M_type, hard_aggregation):
     else:
         return None
 
-def main(truth_file: str, pred_file: str, hard_aggregation: bool):
+def instance_relations(instance):
+    """Group the relations of a Linked-DocRED instance by type
+    Args:
+        instance (dict): Linked-DocRED instance
+    Returns:
+        Tuple[dict, dict]: relation clusters (Tag > Cluster) and relation mentions (Tag > Mention)
+    """
+    C_inst = {t:[] for t in TAGS}
+    M_inst = {t:[] for t in TAGS}
+    entities = instance['entities']
+    for relation in instance['relations']:
+        h_entity = entities[relation['h']]
+        t_entity = entities[relation['t']]
+
+        C_type = C_inst[relation['r']]
+        C_type.append({
+            'h': h_entity,
+            'r': relation,
+            't': t_entity
+        })
+
+        M_type = M_inst[relation['r']]
+        M_type.extend(generate_relation_mentions_from_entity(h_entity, relation, t_entity))
+    return C_inst, M_inst
+
+def compare_instance(instance, instance_pred, hard_aggregation):
+    """Compare the relations of the reference and predicted Linked-DocRED instance
+    Args:
+        instance (dict): true instance
+        instance_pred (dict): predicted instance
+        hard_aggregation (bool): wether to use soft or hard aggregation
+    Returns:
+        Counter: TP_P, P_C, TP_G and G_C of the instance, indexed by (counter, type)
+    """
+    P_C_inst, P_M_inst = instance_relations(instance_pred)
+    G_C_inst, G_M_inst = instance_relations(instance)
+
+    counts = Counter()
+    for type in P_C_inst:
+        for p_cluster in P_C_inst[type]:
+            tp_p = tp_p_cluster(p_cluster, G_M_inst[type], hard_aggregation)
+            if tp_p is not None:
+                counts['TP_P', type] += tp_p
+        counts['P_C', type] += len(P_C_inst[type])
+
+    for type in G_C_inst:
+        for g_cluster in G_C_inst[type]:
+            tp_g = tp_g_cluster(g_cluster, P_M_inst[type], hard_aggregation)
+            if tp_g is not None:
+                counts['TP_G', type] += tp_g
+        counts['G_C', type] += len(G_C_inst[type])
+    return counts
+
+class RelationF1Accumulator(MetricAccumulator):
+    """Entity-centric Relation F1 score, accumulated document by document"""
+
+    STATISTICS = ['TP_P', 'P_C', 'TP_G', 'G_C']
+
+    def __init__(self, hard_aggregation: bool = False, keep_documents: bool = False):
+        """Constructor
+        Args:
+            hard_aggregation (bool, optional): wether to use soft or hard aggregation. Defaults to False.
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+        """
+        super().__init__(partial(compare_instance, hard_aggregation=hard_aggregation), keep_documents)
+
+    def compute(self) -> dict:
+        """Compute the metric on the documents seen so far
+        Returns:
+            dict: precision, recall and f1
+        """
+        TP_P = {t:self.counts['TP_P', t] for t in TAGS}
+        FP = {t:self.counts['P_C', t] - TP_P[t] for t in TAGS}
+        TP_G = {t:self.counts['TP_G', t] for t in TAGS}
+        FN = {t:self.counts['G_C', t] - TP_G[t] for t in TAGS}
+
+        P = sum(TP_P.values()) / (sum(TP_P.values()) + sum(FP.values()))
+        R = sum(TP_G.values()) / (sum(TP_G.values()) + sum(FN.values()))
+        F1 = 2 * (P * R) / (P + R)
+        return {'precision': P, 'recall': R, 'f1': F1}
+
+    def document_statistics(self, doc_counts):
+        # Sum over types
+        statistics = dict.fromkeys(self.STATISTICS, 0)
+        for (name, _), value in doc_counts.items():
+            statistics[name] += value
+        return np.array([statistics[name] for name in self.STATISTICS])
+
+    @staticmethod
+    def scores_from_statistics(statistics):
+        TP_P, P_C, TP_G, G_C = np.moveaxis(statistics, -1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            P = TP_P / P_C
+            R = TP_G / G_C
+            F1 = np.where(P + R > 0, 2 * (P * R) / (P + R), 0)
+        return {'precision': P, 'recall': R, 'f1': F1}
+
+def main(truth_file: str, pred_files: list, hard_aggregation: bool, jobs: int = 1, truth_index: bool = False,
+         profile: str = None):
     """Main entrypoint
     Args:
         truth_file (str): path to ground truth data
-        pred_file (str): path to predicted data
+        pred_files (list): paths to predicted data
         hard_aggregation (bool): wether to use soft or hard aggregation
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to cache the ground truth in a binary index. Defaults to False.
+        profile (str, optional): path of a JSON trace of the stages of the evaluation ('-' for the standard output). Defaults to None.
     """
-    with open(truth_file, 'r', encoding='utf-8') as f:
-        ref_linked_docred = json.load(f)
-        
-    with open(pred_file, 'r', encoding='utf-8') as f:
-        pred_linked_docred = json.load(f)
-    
-    tags = ["P6", "P17", "P19", "P20", "P22", "P25", "P26", "P27", "P30", "P31", "P35", "P36", "P37", 
-        "P39", "P40", "P50", "P54", "P57", "P58", "P69", "P86", "P102", "P108", "P112", "P118", "P123", 
-        "P127", "P131", "P136", "P137", "P140", "P150", "P155", "P156", "P159", "P161", "P162", "P166", 
-        "P170", "P171", "P172", "P175", "P176", "P178", "P179", "P190", "P194", "P205", "P206", "P241", 
-        "P264", "P272", "P276", "P279", "P355", "P361", "P364", "P400", "P403", "P449", "P463", "P488", 
-        "P495", "P527", "P551", "P569", "P570", "P571", "P576", "P577", "P580", "P582", "P585", "P607", 
-        "P674", "P676", "P706", "P710", "P737", "P740", "P749", "P800", "P807", "P840", "P937", "P1001", 
-        "P1056", "P1198", "P1336", "P1344", "P1365", "P1366", "P1376", "P1412", "P1441", "P3373"]
-    # Instance > Tag > Cluster > Mention
-    P_C = []
-    G_C = []
-    # Instance > Tag > Mention
-    P_M = []
-    G_M = []
-
-    for instance_pred in tqdm(pred_linked_docred):
-        # Predicted relations
-        P_C_inst = {t:[] for t in tags}
-        P_M_inst = {t:[] for t in tags}
-        entities = instance_pred['entities']
-        for relation in instance_pred['relations']:
-            h_entity = entities[relation['h']]
-            t_entity = entities[relation['t']]
-            
-            P_C_type = P_C_inst[relation['r']]
-            P_C_type.append({
-                'h': h_entity,
-                'r': relation,
-                't': t_entity
-            })
-            
-            P_M_type = P_M_inst[relation['r']]
-            P_M_type.extend(generate_relation_mentions_from_entity(h_entity, relation, t_entity))
-        P_C.append(P_C_inst)
-        P_M.append(P_M_inst)
-        
-    for instance in tqdm(ref_linked_docred):
-        # Ground truth
-        G_C_inst = {t:[] for t in tags}
-        G_M_inst = {t:[] for t in tags}
-        entities = instance['entities']
-        for relation in instance['relations']:
-            h_entity = entities[relation['h']]
-            t_entity = entities[relation['t']]
-            
-            G_C_type = G_C_inst[relation['r']]
-            G_C_type.append({
-                'h': h_entity,
-                'r': relation,
-                't': t_entity
-            })
-            
-            G_M_type = G_M_inst[relation['r']]
-            G_M_type.extend(generate_relation_mentions_from_entity(h_entity, relation, t_entity))
-        G_C.append(G_C_inst)
-        G_M.append(G_M_inst)
-    
-    TP_P = {t:0 for t in tags}
-    P_C_count = {t:0 for t in tags}
-    FP = {t:0 for t in tags}
-    for p_c_inst, g_m_inst in tqdm(zip(P_C, G_M)):
-        for type in p_c_inst:
-            for p_cluster in p_c_inst[type]:
-                tp_p = tp_p_cluster(p_cluster, g_m_inst[type], hard_aggregation)
-                if tp_p is not None:
-                    TP_P[type] += tp_p
-            P_C_count[type] += len(p_c_inst[type])
-
-    for type in FP:
-        FP[type] = P_C_count[type] - TP_P[type]
-        
-    TP_G = {t:0 for t in tags}
-    G_C_count = {t:0 for t in tags}
-    FN = {t:0 for t in tags}
-    for g_c_inst, p_m_inst in tqdm(zip(G_C, P_M)):
-        for type in g_c_inst:
-            for g_cluster in g_c_inst[type]:
-                tp_g = tp_g_cluster(g_cluster, p_m_inst[type], hard_aggregation)
-                if tp_g is not None:
-                    TP_G[type] += tp_g
-            G_C_count[type] += len(g_c_inst[type])
-
-    for type in FN:
-        FN[type] = G_C_count[type] - TP_G[type]
-    
-    P = sum(TP_P.values()) / (sum(TP_P.values()) + sum(FP.values()))
-    R = sum(TP_G.values()) / (sum(TP_G.values()) + sum(FN.values()))
-    F1 = 2 * (P * R) / (P + R)
-    print(f"Prec={P}, Rec={R}, F1={F1}")
+    profiler = Profiler(enabled=profile is not None)
+    all_scores = {}
+    for pred_file, accumulator in evaluate_files(partial(RelationF1Accumulator, hard_aggregation), truth_file, pred_files, jobs, truth_index, profiler):
+        with profiler.stage('compute'):
+            scores = accumulator.compute()
+        all_scores[pred_file] = scores
+        if len(pred_files) > 1:
+            print(pred_file)
+        print(f"Prec={scores['precision']}, Rec={scores['recall']}, F1={scores['f1']}")
+
+    if profile is not None:
+        profiler.save(profile, truth_file=truth_file, scores=all_scores)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='Relation F1')
     parser.add_argument('--truth_file', help='Path to ground truth relations (in Linked-DocRED format)',
                         type=str, required=True)
-    parser.add_argument('--pred_file', help='Path to predicted relations (in Linked-DocRED format)',
-                        type=str, required=True)
+    pred_group = parser.add_mutually_exclusive_group(required=True)
+    pred_group.add_argument('--pred_file', help='Path to predicted relations (in Linked-DocRED format)',
+                            type=str)
+    pred_group.add_argument('--pred_files', help='Paths to several files of predicted relations, evaluated against the same ground truth',
+                            type=str, nargs='+')
     parser.add_argument('--hard', help='Wether to use soft or hard aggregation', action='store_true')
+    parser.add_argument('--jobs', help='Number of processes used to compare documents', type=int, default=1)
+    parser.add_argument('--truth_index', help='Cache the ground truth in a binary index next to it, and reuse it', action='store_true')
+    parser.add_argument('--profile', help='Write a JSON trace of the time and memory of each stage to this file (standard output if no file is given)',
+                        type=str, nargs='?', const='-', default=None)
     parser.set_defaults(hard=False)
     args = parser.parse_args()
 
-    main(args.truth_file, args.pred_file, args.hard)
\ No newline at end of file
+    main(args.truth_file, args.pred_files or [args.pred_file], args.hard, args.jobs, args.truth_index, args.profile)
\ No newline at end of file
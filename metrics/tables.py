@@ -0,0 +1,171 @@
+"""Columnar tables of Linked-DocRED documents, and vectorized matching of mentions
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+DOCUMENT_DTYPE = np.dtype([('first_entity', 'i8'), ('n_entities', 'i4'),
+                           ('first_relation', 'i8'), ('n_relations', 'i4')])
+ENTITY_DTYPE = np.dtype([('doc_id', 'i4'), ('type_id', 'i2'), ('resource_id', 'i4'),
+                         ('first_mention', 'i8'), ('n_mentions', 'i4')])
+MENTION_DTYPE = np.dtype([('doc_id', 'i4'), ('entity_id', 'i8'), ('type_id', 'i2'),
+                          ('sent_id', 'i4'), ('start', 'i4'), ('end', 'i4')])
+RELATION_DTYPE = np.dtype([('doc_id', 'i4'), ('h', 'i4'), ('t', 'i4'), ('relation_id', 'i2')])
+
+# Structured arrays
+TABLES = ['documents', 'entities', 'mentions', 'relations']
+# Lists of names, indexed by type_id, relation_id and resource_id
+VOCABS = ['type_names', 'relation_names', 'resource_names']
+
+
+def build_tables(documents) -> dict:
+    """Convert Linked-DocRED documents into flat tables.
+    Entities are stored in document order, and mentions in entity order, so that each document
+    (resp. entity) owns a contiguous range of entities (resp. mentions). `doc_id` and `entity_id` are
+    row numbers in the tables; `h` and `t` of relations are indexes of entities in their document.
+    Args:
+        documents (Iterable[dict]): Linked-DocRED documents (e.g., `utils.iter_documents`)
+    Returns:
+        dict: structured arrays (see TABLES) and vocabularies (see VOCABS)
+    """
+    vocabs = {name: {} for name in VOCABS}
+
+    def get_id(vocab, key):
+        return vocabs[vocab].setdefault(key, len(vocabs[vocab]))
+
+    document_rows, entities, mentions, relations = [], [], [], []
+    for doc_id, instance in enumerate(documents):
+        document_rows.append((len(entities), len(instance['entities']),
+                          len(relations), len(instance['relations'])))
+        for entity in instance['entities']:
+            type_id = get_id('type_names', entity['type'])
+            resource_id = -1
+            if 'entity_linking' in entity:
+                resource_id = get_id('resource_names', entity['entity_linking']['wikipedia_resource'])
+            entity_id = len(entities)
+            entities.append((doc_id, type_id, resource_id, len(mentions), len(entity['mentions'])))
+            for mention in entity['mentions']:
+                mentions.append((doc_id, entity_id, type_id, mention['sent_id'],
+                                 mention['pos'][0], mention['pos'][1]))
+        for relation in instance['relations']:
+            relations.append((doc_id, relation['h'], relation['t'], get_id('relation_names', relation['r'])))
+
+    tables = {
+        'documents': np.array(document_rows, dtype=DOCUMENT_DTYPE),
+        'entities': np.array(entities, dtype=ENTITY_DTYPE),
+        'mentions': np.array(mentions, dtype=MENTION_DTYPE),
+        'relations': np.array(relations, dtype=RELATION_DTYPE),
+    }
+    for name, ids in vocabs.items():
+        tables[name] = list(ids.keys())
+    return tables
+
+
+def truncate_tables(tables: dict, n_docs: int) -> dict:
+    """Keep the first documents of tables (rows are sorted by document)
+    Args:
+        tables (dict): output of `build_tables`
+        n_docs (int): number of documents to keep
+    Returns:
+        dict: tables of the first `n_docs` documents
+    """
+    out = dict(tables)
+    out['documents'] = tables['documents'][:n_docs]
+    for name in ['entities', 'mentions', 'relations']:
+        out[name] = tables[name][:np.searchsorted(tables[name]['doc_id'], n_docs)]
+    return out
+
+
+def pack_keys(columns_a: list, columns_b: list):
+    """Pack columns of non-negative integers into int64 keys, with the same layout for both sides
+    Args:
+        columns_a (list): integer arrays of the first side
+        columns_b (list): integer arrays of the second side, in the same order
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray]]: keys of both sides, or None if they do not fit in 63 bits
+    """
+    keys_a = np.zeros(len(columns_a[0]), dtype=np.int64)
+    keys_b = np.zeros(len(columns_b[0]), dtype=np.int64)
+    total_bits = 0
+    for column_a, column_b in zip(columns_a, columns_b):
+        column_a = np.asarray(column_a, dtype=np.int64)
+        column_b = np.asarray(column_b, dtype=np.int64)
+        low = min(column_a.min(initial=0), column_b.min(initial=0))
+        if low < 0:
+            return None
+        bits = max(1, int(max(column_a.max(initial=0), column_b.max(initial=0))).bit_length())
+        total_bits += bits
+        if total_bits > 63:
+            return None
+        keys_a = (keys_a << bits) | column_a
+        keys_b = (keys_b << bits) | column_b
+    return keys_a, keys_b
+
+
+def occurrence_rank(keys: np.ndarray) -> np.ndarray:
+    """Rank of each key among the equal keys that precede it
+    Args:
+        keys (np.ndarray): keys
+    Returns:
+        np.ndarray: 0 for the first occurrence of a key, 1 for the second, etc.
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    positions = np.arange(len(keys))
+    is_first = np.ones(len(keys), dtype=bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_start = np.maximum.accumulate(np.where(is_first, positions, 0))
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = positions - group_start
+    return rank
+
+
+def match_mentions(truth_mentions: np.ndarray, pred_mentions: np.ndarray):
+    """Match mentions one-to-one on (document, sentence, start, end).
+    The k-th true mention of a span is matched with the k-th predicted mention of the same span, as the
+    greedy in-order matching of the metrics (`compare_instance`) does.
+    Args:
+        truth_mentions (np.ndarray): true mentions (MENTION_DTYPE)
+        pred_mentions (np.ndarray): predicted mentions (MENTION_DTYPE)
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray]]: for each true (resp. predicted) mention, the row of the matched
+            predicted (resp. true) mention or -1; None if the keys do not fit in 63 bits
+    """
+    fields = ['doc_id', 'sent_id', 'start', 'end']
+    keys = pack_keys([truth_mentions[f] for f in fields], [pred_mentions[f] for f in fields])
+    if keys is None:
+        return None
+    keys = pack_keys([keys[0], occurrence_rank(keys[0])], [keys[1], occurrence_rank(keys[1])])
+    if keys is None:
+        return None
+    truth_keys, pred_keys = keys
+
+    truth_match = np.full(len(truth_keys), -1, dtype=np.int64)
+    pred_match = np.full(len(pred_keys), -1, dtype=np.int64)
+    if len(truth_keys) == 0 or len(pred_keys) == 0:
+        return truth_match, pred_match
+
+    # Sort-merge: keys are unique on each side, thanks to the occurrence rank
+    pred_order = np.argsort(pred_keys)
+    sorted_pred_keys = pred_keys[pred_order]
+    positions = np.minimum(np.searchsorted(sorted_pred_keys, truth_keys), len(pred_keys) - 1)
+    found = sorted_pred_keys[positions] == truth_keys
+
+    truth_match[found] = pred_order[positions[found]]
+    pred_match[truth_match[found]] = np.nonzero(found)[0]
+    return truth_match, pred_match
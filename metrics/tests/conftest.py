@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+
+# The metrics are scripts importing each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import generate_files
+from bootstrap import get_accumulator
+
+# More documents than a chunk of `utils.map_document_pairs`, so that several chunks are in flight with --jobs
+N_DOCS = 300
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """Generated ground truth and prediction files"""
+    tmp_dir = tmp_path_factory.mktemp('corpus')
+    truth_file, pred_file = str(tmp_dir / 'truth.json'), str(tmp_dir / 'pred.json')
+    generate_files(truth_file, pred_file, N_DOCS, n_entities=8, n_mentions=3, n_relations=5, noise=0.3,
+                   n_candidates=5, seed=0)
+    return truth_file, pred_file
+
+
+def evaluate(metric, truth, pred_file, hard_aggregation=False, **kwargs):
+    accumulator = get_accumulator(metric, hard_aggregation, keep_documents=False)
+    return accumulator.update_from_files(truth, pred_file, **kwargs).compute()
+
+
+@pytest.fixture
+def scores():
+    """Scores of a metric on files (keyword arguments are passed to `update_from_files`)"""
+    return evaluate
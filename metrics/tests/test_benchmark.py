@@ -0,0 +1,18 @@
+"""Regression tests: the benchmark reports the results of a metric, or its failure"""
+import pytest
+from benchmark import generate_files, run_metric
+
+
+def test_run_metric(corpus, scores):
+    truth_file, pred_file = corpus
+    result = run_metric('coref_b3', truth_file, pred_file, n_docs=300, jobs=2)
+    assert result['scores'] == scores('coref_b3', truth_file, pred_file)
+    assert result['peak_rss'] > 0 and result['docs_per_sec'] > 0
+
+
+def test_run_metric_failure(tmp_path):
+    # Without relations, the relation F1 divides by zero: the error is raised instead of waiting for results
+    truth_file, pred_file = str(tmp_path / 'truth.json'), str(tmp_path / 'pred.json')
+    generate_files(truth_file, pred_file, 5, n_entities=8, n_mentions=3, n_relations=0, noise=0.3)
+    with pytest.raises(RuntimeError, match='(?s)relation_f1.*ZeroDivisionError'):
+        run_metric('relation_f1', truth_file, pred_file, n_docs=5)
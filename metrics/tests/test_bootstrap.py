@@ -0,0 +1,22 @@
+"""Regression tests: the bootstrap scores are computed from the statistics of the documents"""
+import pytest
+from bootstrap import METRICS, get_accumulator
+from coref_b3 import CorefB3Accumulator
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_statistics(corpus, metric):
+    # Scores from the summed statistics of the documents are the reported scores
+    accumulator = get_accumulator(metric).update_from_files(*corpus)
+    expected = accumulator.compute()
+    from_statistics = accumulator.scores_from_statistics(accumulator.statistics_matrix().sum(axis=0))
+    for name, value in expected.items():
+        if name in from_statistics:
+            assert from_statistics[name] == pytest.approx(value)
+
+
+@pytest.mark.parametrize('beta', [0.5, 2])
+def test_coref_b3_beta(corpus, beta):
+    accumulator = CorefB3Accumulator(beta=beta, keep_documents=True).update_from_files(*corpus)
+    from_statistics = accumulator.scores_from_statistics(accumulator.statistics_matrix().sum(axis=0))
+    assert {name: from_statistics[name] for name in ['precision', 'recall', 'f1']} == pytest.approx(accumulator.compute())
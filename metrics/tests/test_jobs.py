@@ -0,0 +1,9 @@
+"""Regression tests: metrics computed in a process pool give the scores of the serial run"""
+import pytest
+from bootstrap import METRICS
+
+
+@pytest.mark.parametrize('hard_aggregation', [False, True])
+@pytest.mark.parametrize('metric', METRICS)
+def test_jobs(corpus, metric, hard_aggregation, scores):
+    assert scores(metric, *corpus, hard_aggregation, jobs=3) == scores(metric, *corpus, hard_aggregation)
@@ -0,0 +1,45 @@
+"""Regression tests: files are parsed incrementally and compared document by document"""
+import json
+import pytest
+from bootstrap import METRICS, get_accumulator
+from utils import iter_document_pairs, iter_documents
+
+
+def test_iter_documents(corpus):
+    for path in corpus:
+        with open(path, 'r', encoding='utf-8') as f:
+            assert list(iter_documents(path)) == json.load(f)
+
+
+def test_incremental_parsing(tmp_path):
+    # Documents are yielded before the end of the file is read
+    path = tmp_path / 'truncated.json'
+    path.write_text('[{"entities": [], "relations": []}, {"entities": [], "relations": []}, {"entit')
+    documents = iter_documents(str(path))
+    assert next(documents) == {'entities': [], 'relations': []}
+    assert next(documents) == {'entities': [], 'relations': []}
+    with pytest.raises(Exception):
+        next(documents)
+
+
+def test_document_pairs(corpus, tmp_path):
+    truth_file, pred_file = corpus
+    with open(pred_file, 'r', encoding='utf-8') as f:
+        predictions = json.load(f)
+    short_pred_file = tmp_path / 'short_pred.json'
+    short_pred_file.write_text(json.dumps(predictions[:10]))
+    # The i-th predicted document is compared to the i-th ground truth document, trailing documents are ignored
+    pairs = list(iter_document_pairs(truth_file, str(short_pred_file)))
+    assert [pred for _, pred in pairs] == predictions[:10]
+    assert [truth for truth, _ in pairs] == list(iter_documents(truth_file))[:10]
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_streaming_matches_loaded_files(corpus, metric, scores):
+    truth_file, pred_file = corpus
+    with open(truth_file, 'r', encoding='utf-8') as f_truth, open(pred_file, 'r', encoding='utf-8') as f_pred:
+        truth, pred = json.load(f_truth), json.load(f_pred)
+    accumulator = get_accumulator(metric, keep_documents=False)
+    for instance, instance_pred in zip(truth, pred):
+        accumulator.update(instance, instance_pred)
+    assert scores(metric, truth_file, pred_file) == accumulator.compute()
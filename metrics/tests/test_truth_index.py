@@ -0,0 +1,36 @@
+"""Regression tests: the ground truth index gives the scores of the JSON file"""
+import pytest
+from bootstrap import METRICS
+from conftest import N_DOCS
+from coref_b3 import CorefB3Accumulator
+from truth_index import TruthIndex, evaluate_files
+from utils import iter_documents
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_truth_index(corpus, metric, scores):
+    truth_file, pred_file = corpus
+    expected = scores(metric, truth_file, pred_file)
+    # Built, then memory-mapped from the saved index
+    assert scores(metric, TruthIndex.load(truth_file), pred_file) == expected
+    assert scores(metric, TruthIndex.load(truth_file), pred_file, jobs=2) == expected
+
+
+def test_truth_index_documents(corpus):
+    truth_file, _ = corpus
+    index = TruthIndex.load(truth_file, save=False)
+    assert len(index) == N_DOCS
+    for instance, rebuilt in zip(iter_documents(truth_file), index.documents()):
+        assert [{'sent_id': m['sent_id'], 'pos': m['pos']} for e in instance['entities'] for m in e['mentions']] == \
+            [m for e in rebuilt['entities'] for m in e['mentions']]
+        assert [e['type'] for e in instance['entities']] == [e['type'] for e in rebuilt['entities']]
+        assert [(r['h'], r['t'], r['r']) for r in instance['relations']] == \
+            [(r['h'], r['t'], r['r']) for r in rebuilt['relations']]
+
+
+def test_evaluate_files(corpus, scores):
+    truth_file, pred_file = corpus
+    results = list(evaluate_files(CorefB3Accumulator, truth_file, [pred_file, truth_file]))
+    assert [file for file, _ in results] == [pred_file, truth_file]
+    assert results[0][1].compute() == scores('coref_b3', truth_file, pred_file)
+    assert results[1][1].compute() == pytest.approx({'precision': 1., 'recall': 1., 'f1': 1.})
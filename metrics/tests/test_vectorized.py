@@ -0,0 +1,15 @@
+"""Regression tests: the vectorized path gives the scores of the document-by-document path"""
+import pytest
+from truth_index import TruthIndex
+
+VECTORIZED_METRICS = ['ner_f1', 'coref_b3', 'entity_f1']
+
+
+@pytest.mark.parametrize('hard_aggregation', [False, True])
+@pytest.mark.parametrize('metric', VECTORIZED_METRICS)
+def test_vectorized(corpus, metric, hard_aggregation, scores):
+    truth_file, pred_file = corpus
+    expected = scores(metric, truth_file, pred_file, hard_aggregation)
+    assert scores(metric, truth_file, pred_file, hard_aggregation, vectorized=True) == pytest.approx(expected)
+    assert scores(metric, TruthIndex.load(truth_file, save=False), pred_file, hard_aggregation,
+                  vectorized=True) == pytest.approx(expected)
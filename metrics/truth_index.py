@@ -0,0 +1,179 @@
+"""Binary index of a ground truth file, shared by repeated evaluations
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+from profiling import Profiler
+from tables import TABLES, VOCABS, build_tables
+from utils import iter_documents
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path: str) -> str:
+    """Hash of the content of a file
+    Args:
+        path (str): path to the file
+    Returns:
+        str: hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TruthIndex:
+    """Ground truth file stored as flat tables (see `build_tables`).
+    The index is saved next to the ground truth file, keyed by the hash of its content, and
+    memory-mapped when the same file is evaluated again.
+    """
+
+    def __init__(self, tables: dict):
+        """Constructor
+        Args:
+            tables (dict): output of `build_tables`
+        """
+        self.tables = tables
+
+    @staticmethod
+    def index_path(truth_file: str, digest: str) -> str:
+        """Directory of the index of a ground truth file"""
+        return f'{truth_file}.{digest[:16]}.index'
+
+    @classmethod
+    def load(cls, truth_file: str, save: bool = True, profiler: Profiler = None) -> 'TruthIndex':
+        """Load the index of a ground truth file, building it if necessary
+        Args:
+            truth_file (str): path to ground truth data
+            save (bool, optional): wether to save a newly built index next to the ground truth file. Defaults to True.
+            profiler (Profiler, optional): records the stages of the loading. Defaults to None.
+        Returns:
+            TruthIndex: index
+        """
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        with profiler.stage('hash_truth'):
+            path = cls.index_path(truth_file, file_hash(truth_file))
+        if os.path.isdir(path):
+            with profiler.stage('load_index'):
+                tables = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in TABLES}
+                with open(os.path.join(path, 'vocabs.json'), 'r', encoding='utf-8') as f:
+                    tables.update(json.load(f))
+            return cls(tables)
+
+        with profiler.stage('build_index'):
+            index = cls(build_tables(iter_documents(truth_file)))
+        if save:
+            try:
+                with profiler.stage('save_index'):
+                    index.save(path)
+            except OSError as e:
+                logger.warning('Could not save the index of %s: %s', truth_file, e)
+        return index
+
+    def save(self, path: str):
+        """Save the index
+        Args:
+            path (str): directory of the index
+        """
+        # Write in a temporary directory first, so that concurrent runs never see a partial index
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            for name in TABLES:
+                np.save(os.path.join(tmp_path, f'{name}.npy'), self.tables[name])
+            with open(os.path.join(tmp_path, 'vocabs.json'), 'w', encoding='utf-8') as f:
+                json.dump({name: self.tables[name] for name in VOCABS}, f)
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+
+    def __len__(self):
+        return len(self.tables['documents'])
+
+    def document(self, doc_id: int) -> dict:
+        """Rebuild a ground truth document
+        Args:
+            doc_id (int): index of the document
+        Returns:
+            dict: document, with the fields of Linked-DocRED used by the metrics
+        """
+        type_names = self.tables['type_names']
+        resource_names = self.tables['resource_names']
+        relation_names = self.tables['relation_names']
+
+        first_entity, n_entities, first_relation, n_relations = self.tables['documents'][doc_id].tolist()
+        entity_rows = self.tables['entities'][first_entity:first_entity + n_entities].tolist()
+        if entity_rows:
+            first_mention = entity_rows[0][3]
+            last_mention = entity_rows[-1][3] + entity_rows[-1][4]
+            mention_rows = self.tables['mentions'][first_mention:last_mention].tolist()
+
+        entities = []
+        for _, type_id, resource_id, entity_first_mention, entity_n_mentions in entity_rows:
+            offset = entity_first_mention - first_mention
+            entity = {
+                'type': type_names[type_id],
+                'mentions': [{'sent_id': sent_id, 'pos': [start, end]}
+                             for _, _, _, sent_id, start, end in mention_rows[offset:offset + entity_n_mentions]]
+            }
+            if resource_id >= 0:
+                entity['entity_linking'] = {'wikipedia_resource': resource_names[resource_id]}
+            entities.append(entity)
+
+        relations = [{'h': h, 't': t, 'r': relation_names[relation_id]}
+                     for _, h, t, relation_id in self.tables['relations'][first_relation:first_relation + n_relations].tolist()]
+        return {'entities': entities, 'relations': relations}
+
+    def documents(self):
+        """Iterate over the ground truth documents
+        Yields:
+            dict: document (see `document`)
+        """
+        for doc_id in range(len(self)):
+            yield self.document(doc_id)
+
+
+def evaluate_files(make_accumulator, truth_file: str, pred_files: list, jobs: int = 1, truth_index: bool = False,
+                   profiler: Profiler = None, vectorized: bool = False):
+    """Evaluate several prediction files against the same ground truth.
+    With several prediction files (or `truth_index`), the ground truth is read from its index.
+    Args:
+        make_accumulator (Callable[[], MetricAccumulator]): builds the accumulator of the metric
+        truth_file (str): path to ground truth data
+        pred_files (list): paths to predicted data
+        jobs (int, optional): number of processes. Defaults to 1.
+        truth_index (bool, optional): wether to use the index of the ground truth. Defaults to False.
+        profiler (Profiler, optional): records the stages of the evaluations. Defaults to None.
+        vectorized (bool, optional): wether to use the vectorized path of the metric (see
+            `MetricAccumulator.update_from_files`). Defaults to False.
+    Yields:
+        Tuple[str, MetricAccumulator]: prediction file and its accumulator
+    """
+    truth = TruthIndex.load(truth_file, profiler=profiler) if truth_index or len(pred_files) > 1 else truth_file
+    for pred_file in pred_files:
+        yield pred_file, make_accumulator().update_from_files(truth, pred_file, jobs, profiler, vectorized)
@@ -0,0 +1,260 @@
+"""Shared helpers for the metrics
+
+---
+Linked-DocRED
+Copyright (C) 2023 Alteca.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from collections import Counter, deque
+from functools import partial
+from itertools import islice
+import logging
+import multiprocessing
+import ijson
+import numpy as np
+from tqdm.auto import tqdm
+from profiling import Profiler, profiled_compare, table_counters
+from tables import build_tables, truncate_tables
+
+logger = logging.getLogger(__name__)
+
+def iter_documents(path: str):
+    """Iterate over the documents of a Linked-DocRED file, one at a time.
+    The file is parsed incrementally, so only the current document is kept in memory.
+    Args:
+        path (str): path to a Linked-DocRED file (JSON list of documents)
+    Yields:
+        dict: Linked-DocRED document
+    """
+    with open(path, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
+
+
+def iter_document_pairs(truth_file, pred_file: str):
+    """Iterate over ground truth and predicted documents in lockstep
+    Args:
+        truth_file (Union[str, TruthIndex]): path to ground truth data, or its index
+        pred_file (str): path to predicted data
+    Returns:
+        Iterator[Tuple[dict, dict]]: (ground truth document, predicted document)
+    """
+    truth_documents = iter_documents(truth_file) if isinstance(truth_file, str) else truth_file.documents()
+    return zip(truth_documents, iter_documents(pred_file))
+
+
+def _compare_chunk(func, chunk: list) -> list:
+    """Apply `func` to a chunk of (ground truth document, predicted document)"""
+    return [func(instance, instance_pred) for instance, instance_pred in chunk]
+
+
+def map_document_pairs(func, truth_file, pred_file: str, jobs: int = 1, chunksize: int = 64, profiler: Profiler = None):
+    """Apply `func` to each pair of ground truth and predicted documents.
+    With several jobs, chunks of documents are compared in a process pool. Results are yielded in
+    document order, so merging them gives exactly the result of the serial run.
+    Args:
+        func (Callable[[dict, dict], Any]): comparison of a document pair (must be picklable)
+        truth_file (Union[str, TruthIndex]): path to ground truth data, or its index
+        pred_file (str): path to predicted data
+        jobs (int, optional): number of processes. Defaults to 1.
+        chunksize (int, optional): number of documents sent at once to a process. Defaults to 64.
+        profiler (Profiler, optional): records the parsing of the files. Defaults to None.
+    Yields:
+        Any: result of `func` for each document pair
+    """
+    pairs = iter_document_pairs(truth_file, pred_file)
+    if profiler is not None:
+        pairs = profiler.iterate('parse', pairs)
+    if jobs <= 1:
+        for instance, instance_pred in pairs:
+            yield func(instance, instance_pred)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        # Bound the number of chunks in flight, so that files are not loaded ahead of the workers
+        pending = deque()
+        while True:
+            chunk = list(islice(pairs, chunksize))
+            if not chunk:
+                break
+            pending.append(pool.apply_async(_compare_chunk, (func, chunk)))
+            if len(pending) >= 2 * jobs:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+class MetricAccumulator:
+    """Accumulate the statistics of a metric, document by document.
+    Statistics of a document are computed by `compare` (a picklable function of the ground truth and
+    predicted documents returning a Counter) and summed into `counts`; subclasses define `compute`.
+
+    Subclasses also reduce the statistics of a document to a vector of additive sufficient statistics
+    (named in `STATISTICS`, see `document_statistics`) from which `scores_from_statistics` computes the
+    scores. With `keep_documents`, one such vector is kept per document, e.g., for bootstrapping.
+
+    Metrics may also provide `compare_tables`, computing the summed statistics of whole files at once
+    from their columnar tables (see `tables.build_tables`). Files can then be evaluated with this vectorized
+    path, which is faster but holds both files in memory and runs in a single process.
+    """
+    STATISTICS = []
+
+    def __init__(self, compare, keep_documents: bool = False, compare_tables=None):
+        """Constructor
+        Args:
+            compare (Callable[[dict, dict], Counter]): statistics of a document pair
+            keep_documents (bool, optional): wether to keep the statistics of each document. Defaults to False.
+            compare_tables (Callable[[dict, dict], Optional[Counter]], optional): statistics of all the documents,
+                from the tables of the ground truth and predicted files (None if it cannot handle them). Defaults to None.
+        """
+        self.compare = compare
+        self.keep_documents = keep_documents
+        self.compare_tables = compare_tables
+        self.reset()
+
+    def reset(self):
+        """Forget all the documents seen so far"""
+        self.counts = Counter()
+        self.documents = []
+
+    def add_counts(self, doc_counts: Counter):
+        """Add the statistics of a document
+        Args:
+            doc_counts (Counter): statistics of the document (output of `compare`)
+        """
+        self.counts.update(doc_counts)
+        if self.keep_documents:
+            self.documents.append(self.document_statistics(doc_counts))
+
+    def update(self, truth_doc: dict, pred_doc: dict):
+        """Add a document to the evaluation
+        Args:
+            truth_doc (dict): ground truth document (in Linked-DocRED format)
+            pred_doc (dict): predicted document (in Linked-DocRED format)
+        """
+        self.add_counts(self.compare(truth_doc, pred_doc))
+
+    def merge(self, other: 'MetricAccumulator') -> 'MetricAccumulator':
+        """Add the documents seen by another accumulator of the same metric
+        Args:
+            other (MetricAccumulator): other accumulator
+        Returns:
+            MetricAccumulator: self
+        """
+        self.counts.update(other.counts)
+        self.documents.extend(other.documents)
+        return self
+
+    def update_from_files(self, truth_file, pred_file: str, jobs: int = 1,
+                          profiler: Profiler = None, vectorized: bool = False) -> 'MetricAccumulator':
+        """Add all the documents of a ground truth and a predicted file to the evaluation
+        Args:
+            truth_file (Union[str, TruthIndex]): path to ground truth data, or its index
+            pred_file (str): path to predicted data
+            jobs (int, optional): number of processes. Defaults to 1.
+            profiler (Profiler, optional): records the stages of the evaluation. Defaults to None.
+            vectorized (bool, optional): wether to use the vectorized path (see `update_from_tables`), when the
+                metric provides it and per-document statistics are not kept. Defaults to False.
+        Returns:
+            MetricAccumulator: self
+        """
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        if vectorized and self.compare_tables is not None and not self.keep_documents:
+            if jobs > 1:
+                logger.warning('The vectorized path runs in a single process: jobs=%d is ignored', jobs)
+            if self.update_from_tables(truth_file, pred_file, profiler):
+                return self
+
+        if not profiler.enabled:
+            for doc_counts in tqdm(map_document_pairs(self.compare, truth_file, pred_file, jobs)):
+                self.add_counts(doc_counts)
+            return self
+
+        # With several jobs, compare times are summed over the processes
+        compare = partial(profiled_compare, self.compare)
+        with profiler.stage('documents'):
+            for doc_counts, wall_time, cpu_time, counters in tqdm(
+                    map_document_pairs(compare, truth_file, pred_file, jobs, profiler=profiler)):
+                profiler.add_time('compare', wall_time, cpu_time)
+                profiler.update_counters(counters)
+                with profiler.stage('aggregate'):
+                    self.add_counts(doc_counts)
+        return self
+
+    def update_from_tables(self, truth_file, pred_file: str, profiler: Profiler = None) -> bool:
+        """Add all the documents of a ground truth and a predicted file with the vectorized path.
+        Both files are loaded in memory as tables (only the prediction file with a `TruthIndex`).
+        Args:
+            truth_file (Union[str, TruthIndex]): path to ground truth data, or its index
+            pred_file (str): path to predicted data
+            profiler (Profiler, optional): records the stages of the evaluation. Defaults to None.
+        Returns:
+            bool: wether the files were evaluated (False if the vectorized path is not available)
+        """
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        if isinstance(truth_file, str):
+            with profiler.stage('truth_tables'):
+                truth_tables = build_tables(iter_documents(truth_file))
+        else:
+            truth_tables = truth_file.tables
+        with profiler.stage('pred_tables'):
+            pred_tables = build_tables(iter_documents(pred_file))
+        # Documents are compared in lockstep: ignore the trailing documents of the longest file
+        n_docs = min(len(truth_tables['documents']), len(pred_tables['documents']))
+        truth_tables = truncate_tables(truth_tables, n_docs)
+        pred_tables = truncate_tables(pred_tables, n_docs)
+        with profiler.stage('compare_tables'):
+            counts = self.compare_tables(truth_tables=truth_tables, pred_tables=pred_tables)
+        if counts is None:
+            return False
+        profiler.update_counters(table_counters(truth_tables, pred_tables))
+        self.counts.update(counts)
+        return True
+
+    def compute(self) -> dict:
+        """Compute the metric on the documents seen so far
+        Returns:
+            dict: scores
+        """
+        raise NotImplementedError
+
+    def document_statistics(self, doc_counts: Counter) -> np.ndarray:
+        """Sufficient statistics of a document
+        Args:
+            doc_counts (Counter): statistics of the document (output of `compare`)
+        Returns:
+            np.ndarray: vector of the statistics named in `STATISTICS`
+        """
+        raise NotImplementedError
+
+    def statistics_matrix(self) -> np.ndarray:
+        """Sufficient statistics of the documents seen so far (requires `keep_documents`)
+        Returns:
+            np.ndarray: matrix of shape (#documents, len(STATISTICS))
+        """
+        if not self.keep_documents:
+            raise ValueError('Statistics of the documents are only kept with keep_documents=True')
+        return np.array(self.documents, dtype=np.float64).reshape(-1, len(self.STATISTICS))
+
+    @staticmethod
+    def scores_from_statistics(statistics: np.ndarray) -> dict:
+        """Compute the scores from summed sufficient statistics
+        Args:
+            statistics (np.ndarray): statistics summed over documents, of shape (..., len(STATISTICS))
+        Returns:
+            dict: scores, of shape (...)
+        """
+        raise NotImplementedError